@@ -10,6 +10,7 @@ Annotation class handles user video annotation actions:
 import time
 import ast
 import logging
+from functools import partial
 
 from PySide.QtGui import *
 from PySide.QtCore import *
@@ -17,6 +18,7 @@ from PySide.QtCore import *
 from tovian.gui.dialogs.attribselect import AttribSelectionDialog
 from tovian import models
 from tovian.models import repository
+from tovian.models import executor
 from tovian.gui.dialogs.mask import MaskDialog
 import graphics
 
@@ -68,6 +70,8 @@ class Annotation(QObject):
     selected_object_msg = u"Selected object type '%s' id: %s"
     no_next_annotation_msg = u"There is no next annotation to jump"
     no_prev_annotation_msg = u"There is no previous annotation to jump"
+    no_next_keyframe_msg = u"There is no next keyframe of selected object to jump"
+    no_prev_keyframe_msg = u"There is no previous keyframe of selected object to jump"
 
     action_edit_on_msg = u"Edit object"
     action_edit_off_msg = u"Leave edit mode"
@@ -86,6 +90,7 @@ class Annotation(QObject):
     NON_VIS_TYPE = u'nonvisual'
     NON_VIS_POS_ATTRIB = u'position_nonvisual'
     WAIT_TIMEOUT = 1                    # time in sec
+    COMPLETER_SIZE = 700                # max. number of values offered by completer
 
     error = Signal()
 
@@ -133,6 +138,7 @@ class Annotation(QObject):
         self.selected_graphics_object = None
         self.video_attributes = self.video.annotation_attributes
         self.completers = {}
+        self.ranked_completers = set()     # attributes with more values than completer holds
         self.initCompleters()
 
         self.nonvis_table_records = []
@@ -193,15 +199,49 @@ class Annotation(QObject):
             self.scene.clearScene(self.scene_items)
             self.scene_items = []
 
+        # warm buffer serves all objects and values from memory, frames not buffered yet can be loaded from database
+        frame_from, frame_to = self.getProcessedFrameInterval(current_frame)
+        max_queries = 0 if self.buffer.isCached(frame_from, frame_to) else None
+
+        with models.database.db.operation('gui.process_objects', max_queries=max_queries):
+            self.processObjectsInFrame(current_frame, draw)
+
+        self.processing_objects = False
+
+        # t11 = time.time() * 1000
+        # print "ProcessObjects: ", t11 - t01
+
+    def getProcessedFrameInterval(self, current_frame):
+        """
+        Returns frame interval of annotation objects processed by processObjects, i.e. frames of non-visual
+        annotation table (if enabled) or the current frame.
+        :type current_frame: int
+        :rtype: (int, int)
+        """
+        if not self.nonvis_annotation_enabled:
+            return current_frame, current_frame
+
+        frame_from = current_frame - ((self.nonvis_column_count - 1) / 2)
+        frame_to = current_frame + ((self.nonvis_column_count - 1) / 2)
+        frame_from = 0 if frame_from < 0 else frame_from
+        frame_to = 0 if frame_to < 0 else frame_to
+        frame_from = self.video.frame_count if frame_from > self.video.frame_count else frame_from
+        frame_to = self.video.frame_count if frame_to > self.video.frame_count else frame_to
+
+        return frame_from, frame_to
+
+    def processObjectsInFrame(self, current_frame, draw):
+        """
+        Draws annotation objects retrieved from buffer, fills annotation table and attribute table for selected object.
+        Called by processObjects.
+        :type current_frame: int
+        :param draw: tells to skip drawing
+        :type draw: bool
+        """
         try:
             # --- GET ANNOTATION OBJECTS FROM BUFFER ---
             if self.nonvis_annotation_enabled:
-                frame_from = current_frame - ((self.nonvis_column_count - 1) / 2)
-                frame_to = current_frame + ((self.nonvis_column_count - 1) / 2)
-                frame_from = 0 if frame_from < 0 else frame_from
-                frame_to = 0 if frame_to < 0 else frame_to
-                frame_from = self.video.frame_count if frame_from > self.video.frame_count else frame_from
-                frame_to = self.video.frame_count if frame_to > self.video.frame_count else frame_to
+                frame_from, frame_to = self.getProcessedFrameInterval(current_frame)
                 retrieved_objects = self.buffer.getObjectsInFrameInterval(frame_from, frame_to)
             else:
                 retrieved_objects = self.buffer.getObjectsInFrame(current_frame)
@@ -278,11 +318,6 @@ class Annotation(QObject):
         if self.nonvis_annotation_enabled:
             self.displayNonVisAnnotations(current_frame)
 
-        self.processing_objects = False
-
-        # t11 = time.time() * 1000
-        # print "ProcessObjects: ", t11 - t01
-
     def getLocalAttributes(self, an_object, current_frame, draw):
         """
         Gets local attributes for given frame and object and draws annotation objects on the scene.
@@ -564,6 +599,9 @@ class Annotation(QObject):
                 else:
                     valueEdit.setCompleter(completer)
 
+                    if attrib.annotation_attribute.name in self.ranked_completers:
+                        valueEdit.textEdited.connect(partial(self.updateRankedCompleter, valueEdit, attrib.annotation_attribute))
+
                 if not attrib.is_interpolated:
                     font = name.font()
                     font.setBold(True)
@@ -593,7 +631,7 @@ class Annotation(QObject):
             self.remaining_local_attribs = []
             # get only valid used annotation attributes
             for value in self.local_attribs_in_table:
-                if type(value) is models.entity.AnnotationValue:
+                if type(value) in (models.entity.AnnotationValue, models.entity.InterpolatedValue, models.entity.PackedValue):
                     used_attribs.append(value.annotation_attribute)
 
             # find unused attributes
@@ -705,6 +743,9 @@ class Annotation(QObject):
                 else:
                     valueEdit.setCompleter(completer)
 
+                    if attrib.annotation_attribute.name in self.ranked_completers:
+                        valueEdit.textEdited.connect(partial(self.updateRankedCompleter, valueEdit, attrib.annotation_attribute))
+
                 valueEdit.editingFinished.connect(self.processChanges)
                 self.globalTable.setCellWidget(i, 1, valueEdit)
             # ----------------------
@@ -775,6 +816,30 @@ class Annotation(QObject):
             self.parent().addLocalAttribAction.setEnabled(False)
         # -----------------------------------------------------------------------------------------------------------
 
+    @Slot(int, int)
+    def missingObjectsBuffered(self, frame_from, frame_to):
+        """
+        Called when objects, which were not buffered when displayed, have been buffered.
+        Displayed frame is processed again, when the player is not playing (otherwise the next frame does it).
+        :type frame_from: int
+        :type frame_to: int
+        """
+        current_frame = self.player.getCurrentFrame()
+
+        if not self.player.isPlaying and frame_from <= current_frame <= frame_to:
+            logger.debug("Objects in frame %s have been buffered, processing them again", current_frame)
+            self.processObjects()
+
+    @Slot(object)
+    def expireRemovedObjects(self, annotation_objects):
+        """
+        Called when annotation objects have been removed from buffer. Objects are expired in the session, so they
+        can be garbage collected, except displayed objects and objects with changes not committed yet.
+        :type annotation_objects: list of tovian.models.entity.AnnotationObject
+        """
+        expired = executor.expire_unchanged(annotation_objects, keep_ids=self.frame_cache.keys())
+        logger.debug("Expired %s of %s objects removed from buffer", len(expired), len(annotation_objects))
+
     def displayNonVisAnnotations(self, current_frame=None):
         """
         Displays nonVisual objects (annotations) in table
@@ -1557,13 +1622,8 @@ class Annotation(QObject):
         an_object = self.selected_object_tuple[0][0]
 
         try:
-            if attrib in models.database.db.session.new:
-                logger.debug("Deleted attrib is in session.new => trying to expunge the attrib")
-                models.database.db.session.expunge(attrib)
-            else:
-                logger.debug("Trying to delete the attrib")
-                models.database.db.session.delete(attrib)
-            #models.database.db.session.flush()
+            logger.debug("Trying to delete the attrib")
+            models.repository.annotation_values.delete(attrib)
             models.database.db.session.refresh(an_object)
         except:
             logger.exception("Error when deleting an_value from database")
@@ -1610,13 +1670,8 @@ class Annotation(QObject):
 
         try:
             for value in to_delete:
-                if value in models.database.db.session.new:
-                    logger.debug("Deleted attrib is in session.new => trying to expunge the attrib")
-                    models.database.db.session.expunge(value)
-                else:
-                    logger.debug("Trying to delete the attrib")
-                    models.database.db.session.delete(value)
-                #models.database.db.session.flush()
+                logger.debug("Trying to delete the attrib")
+                models.repository.annotation_values.delete(value)
                 models.database.db.session.refresh(an_object)
                 l_values.remove(value)
         except:
@@ -1744,6 +1799,38 @@ class Annotation(QObject):
 
         self.player.resetPerFrameSlider()
 
+    def goToNextKeyframe(self, to_future=True):
+        """
+        Goes (seeks) to next keyframe (frame with local annotation value) of selected object
+        """
+        if self.selected_object_tuple is None:
+            QApplication.beep()
+            return
+
+        frame = self.player.getCurrentFrame()
+        an_object = self.selected_object_tuple[0][0]
+        logger.debug("Trying to jump to %s keyframe of object %s from frame '%s'...", 'next' if to_future else 'previous', an_object.id, frame)
+
+        keyframe = an_object.keyframe_next(frame, to_future)
+
+        if keyframe is None:
+            logger.debug("There is no %s keyframe.", 'next' if to_future else 'previous')
+            QApplication.beep()
+            self.statusbar.showMessage(self.no_next_keyframe_msg if to_future else self.no_prev_keyframe_msg, self.SHORT_MSG_DURATION)
+            return
+
+        frameDuration = 1000.0 / self.video.fps
+        logger.debug("Seeking to keyframe on target frame: %s", keyframe)
+        self.player.seek(keyframe * frameDuration)
+
+        self.player.resetPerFrameSlider()
+
+    def goToPrevKeyframe(self):
+        """
+        Goes (seeks) to previous keyframe (frame with local annotation value) of selected object
+        """
+        self.goToNextKeyframe(to_future=False)
+
     def startEditMode(self, graphics_object=None, nonvis_id=None):
         """
         Starts edit mode, which allows to change the start and end of annotations
@@ -1977,16 +2064,40 @@ class Annotation(QObject):
 
         # EDIT CURRENT VALUE
         else:
-            self.position_an_value.value = pos_value
-            if self.position_an_value.is_interpolated:
-                logger.debug("Value is interpolated, adding session and flushing...")
-                self.position_an_value.database_session_add()
+            if self.position_an_value.is_interpolated or self.position_an_value.is_packed:
+                logger.debug("Value is interpolated or packed, adding session and flushing...")
+                self.promoteReadOnlyValue(self.position_an_value)
+                self.position_an_value.value = pos_value
                 models.database.db.session.flush()
                 gra_object.drawSolid()
+            else:
+                self.position_an_value.value = pos_value
 
         self.statusbar.showMessage(self.geometry_changes_processed_msg, self.SHORT_MSG_DURATION)
         self.un_committed_changes = True
 
+    def promoteReadOnlyValue(self, an_value):
+        """
+        Stores interpolated or packed value as an editable annotation value (keyframe) and replaces it in selected object's
+        values, in attribute table and in frame cache. Interpolated and packed values are read-only, they have to be promoted
+        before editing (packed track is unpacked).
+        :type an_value: tovian.models.entity.InterpolatedValue or tovian.models.entity.PackedValue
+        :return: new annotation value added to session
+        :rtype: tovian.models.entity.AnnotationValue
+        """
+        new_value = an_value.database_session_add()
+
+        # selected object's values are shared with the frame cache
+        for values in (self.selected_object_tuple[1], self.local_attribs_in_table):
+            for i, value in enumerate(values):
+                if value is an_value:
+                    values[i] = new_value
+
+        if self.position_an_value is an_value:
+            self.position_an_value = new_value
+
+        return new_value
+
     def applyChanges(self, i, local):
         """
         Process changes in given attribute table for given attributes
@@ -2055,13 +2166,17 @@ class Annotation(QObject):
                 # if an_object is active or global, write changes
                 if is_active or not local:
                     logger.debug("%s has been changed, now writing changes...", an_value.annotation_attribute.name)
+                    is_interpolated = an_value.is_interpolated or an_value.is_packed
+
+                    # needs to be add as new value to SQLAlchemy if interpolated
+                    if is_interpolated:
+                        an_value = self.promoteReadOnlyValue(an_value)
+
                     an_value.value = table_value_parsed
                     an_value.modified_by = self.user
 
-                    # needs to be add as new value to SQLAlchemy if interpolated
-                    if an_value.is_interpolated:
+                    if is_interpolated:
                         logger.debug("Adding value to session -> flushing...")
-                        an_value.database_session_add()
                         models.database.db.session.flush()
 
                         graObjects = self.scene.selectedItems()
@@ -2224,13 +2339,16 @@ class Annotation(QObject):
                 for an_value in local_values:
                     if an_value.annotation_attribute.name == old_an_value.annotation_attribute.name:
                         logger.debug("%s has been changed - writing changes", an_value.annotation_attribute.name)
+                        is_interpolated = an_value.is_interpolated or an_value.is_packed
+
+                        if is_interpolated:
+                            an_value = self.promoteReadOnlyValue(an_value)
 
                         an_value.value = new_value
                         an_value.modified_by = self.user
 
-                        if an_value.is_interpolated:
+                        if is_interpolated:
                             logger.debug("Changed value is interpolated - adding to session and flushing...")
-                            an_value.database_session_add()
                             models.database.db.session.flush()
 
                             graObjects = self.scene.selectedItems()
@@ -2288,6 +2406,7 @@ class Annotation(QObject):
 
         logger.debug("Committing changes")
         try:
+            self.simplifyChangedObjects()
             models.database.db.session.commit()
             models.repository.logs.insert('gui.save', annotator_id=self.user.id)
         except Exception:
@@ -2304,6 +2423,22 @@ class Annotation(QObject):
             self.buffer.resetBuffer(self.player.getCurrentFrame(), clear_all=True)
             self.committing = False
 
+    def simplifyChangedObjects(self):
+        """
+        Removes keyframes, which are reproduced by interpolation (option gui.simplify_tolerance), of objects
+        whose values were edited since last save. Objects not edited by the user are never rewritten.
+        """
+        for an_object in executor.annotation_objects_with_changed_values():
+            tolerance = an_object.get_option('gui.simplify_tolerance')
+
+            if tolerance is None:
+                continue
+
+            removed, max_error = an_object.simplify_keyframes(tolerance)
+
+            if removed:
+                logger.info("Simplified object %s: %d keyframes removed, maximum error %1.2f px", an_object.id, removed, max_error)
+
     def undo(self):
         """
         Reverts all changes from last db.session.commit() calling
@@ -2345,10 +2480,37 @@ class Annotation(QObject):
             if an_attrib.name in position_attribs or an_attrib.allowed_values:
                 continue
 
-            strings = an_attrib.autocomplete_values()
+            strings = an_attrib.autocomplete_values(limit=self.COMPLETER_SIZE)
 
             if strings:
                 completer = QCompleter(strings, self)
                 completer.setCaseSensitivity(Qt.CaseInsensitive)
 
-                self.completers[an_attrib.name] = completer
\ No newline at end of file
+                self.completers[an_attrib.name] = completer
+
+                if len(an_attrib.value_dictionary()) > self.COMPLETER_SIZE:
+                    # only the most frequent values are in the completer, others are looked up when text is edited
+                    self.ranked_completers.add(an_attrib.name)
+
+    def updateRankedCompleter(self, valueEdit, an_attrib, text):
+        """
+        Fills completer of the line edit by the best ranked values of the attribute matching edited text
+        :type valueEdit: PySide.QtGui.QLineEdit
+        :type an_attrib: tovian.models.entity.AnnotationAttribute
+        """
+        strings = an_attrib.autocomplete_values(text, self.COMPLETER_SIZE)
+
+        completer = valueEdit.completer()
+
+        if completer is None or completer.parent() is not valueEdit:
+            # line edit gets its own completer on the first edit (shared completer of the attribute is left untouched),
+            # it is destroyed together with the line edit, later edits only replace its values
+            completer = QCompleter(QStringListModel(valueEdit), valueEdit)
+            completer.setCaseSensitivity(Qt.CaseInsensitive)
+            completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)     # values are already filtered and ranked
+            valueEdit.setCompleter(completer)
+
+        completer.model().setStringList(strings)
+
+        if strings:
+            completer.complete()
\ No newline at end of file
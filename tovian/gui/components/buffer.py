@@ -6,15 +6,59 @@ Buffer module:
 """
 
 import logging
-import sys
+import time
+from functools import partial
 from PySide.QtCore import QObject, Signal, Slot, QMutex
 from tovian import models
+from tovian.models import executor
+from tovian.gui.components.prefetch import Prefetcher, missing_intervals, clip_segments
 
 
 logger = logging.getLogger(__name__)
 logger.debug('Import ' + __name__)
 
 
+class MainThreadCall(QObject):
+    """
+    Calls functions in the thread, where it was created (the main thread). Functions emitted from other threads
+    are queued to the event loop of the main thread, functions emitted from the main thread are called immediately.
+    """
+
+    call = Signal(object)
+
+    def __init__(self):
+        super(MainThreadCall, self).__init__()
+        self.call.connect(self.__call)
+
+    @Slot(object)
+    def __call(self, function):
+        function()
+
+
+class Fill():
+    """
+    Frame intervals loaded by the buffer thread, which are merged into the main session and published by the main thread.
+    :param intervals: loaded frame intervals [(frame_from, frame_to), ...]
+    :param segments: buffered frame intervals, see Buffer.__publishIndex (as well as replace, window and window_version)
+    :param filter_object_ids: only given annotation objects are loaded
+    :param done: called by the main thread with True when objects are published, with False when buffering failed
+    or the window was reset meanwhile
+    """
+
+    def __init__(self, intervals, segments, replace=False, window=None, window_version=None, filter_object_ids=None,
+                 done=None):
+        self.intervals = intervals
+        self.segments = segments
+        self.replace = replace
+        self.window = window
+        self.window_version = window_version
+        self.filter_object_ids = filter_object_ids
+        self.done = done
+
+        self.rows = None        # detached objects loaded by the database executor, None when they were not loaded
+        self.failed = False
+
+
 class Buffer(QObject):
     """
     Class buffers annotation objects to cache from database for given frame or frame interval.
@@ -28,26 +72,52 @@ class Buffer(QObject):
     buffering = Signal()
     buffered = Signal()
     initialized = Signal()
+    fillMissing = Signal(int, int)          # requests frame interval missing in buffer to be buffered by buffer thread
+    reset = Signal(int, bool, object)       # requests reset of buffer to be done by buffer thread (see resetBuffer)
+    missingBuffered = Signal(int, int)      # frame interval, which was missing when accessed, has been buffered
+    objectsRemoved = Signal(object)         # annotation objects dropped from buffer, expired by the main thread
 
-    MAX_MEMORY_USAGE = 52428800     # 50MB
+    MAX_MEMORY_USAGE = 52428800     # 50MB, approximate size of buffered objects with their loaded values
 
     def __init__(self, video, user_id, parent=None):
         super(Buffer, self).__init__(parent)
         self.mutex = QMutex()
         self.video = video
+        self.video_id = self.video.id
         self.last_frame_accessed = (0, 0)
         self.displayed_frames_range = 1     # must be odd
         self.video_frame_count = self.video.frame_count
         self.video_frame_fps = self.video.fps
         self.user_id = user_id
 
-        self.cache = {}
+        # buffered objects, one span record per object, with approximate memory usage
+        self.index = models.entity.SpanIndex(memory_usage=lambda row: row[0].memory_usage())
+        self.cached = False                     # cached_min_frame and cached_max_frame are valid
         self.cached_min_frame = 0
         self.cached_max_frame = 0
-        self.cached_time = 10               # seconds
-        self.cached_time_border = 0.25      # 25 percent from cached interval, where it starts to buffer new objects
+
+        # buffered window is made of segments (one per fill), sorted by frames: [frame_from, frame_to, last access, bytes]
+        self.segments = []
+        self.access_clock = 0
+
+        # fills build a new index without lock and publish it by a swap (see __publishIndex)
+        self.index_version = 0                  # incremented by every change of the index
+        self.window_version = 0                 # incremented when the buffered window is replaced (reset)
+        self.missing = []                       # missing frame intervals requested to be buffered
+
+        # buffer thread does not use the main session, fills are published by the main thread (see __fill)
+        self.main_thread_call = MainThreadCall()
+        self.pending_fills = 0
+
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted_bytes': 0, 'bytes': 0}
+        self.cached_time = 10               # seconds, the first fill
+
+        # size and timing of next fills
+        self.prefetcher = Prefetcher(self.video_frame_fps, self.cached_time)
 
         self.checkBufferState.connect(self.__checkBuffer)
+        self.fillMissing.connect(self.__bufferMissing)
+        self.reset.connect(self.__resetBuffer)
 
     def initBuffer(self):
         """
@@ -58,8 +128,7 @@ class Buffer(QObject):
         new_stop = new_stop if new_stop < self.video_frame_count else self.video_frame_count
 
         logger.debug("Filling buffer on interval [%s, %s]", new_start, new_stop)
-        self.__bufferObjects(new_start, new_stop)
-        self.initialized.emit()
+        self.__bufferObjects(new_start, new_stop, done=lambda published: self.initialized.emit())
 
     def setDisplayedFrameRange(self, length):
         """
@@ -76,6 +145,8 @@ class Buffer(QObject):
     def getObjectsInFrame(self, frame):
         """
         Returns list of annotation objects for given frame. When accessing to cache, cached is locked for other access.
+        When the frame is not buffered, objects available in buffer are returned immediately, the frame is buffered
+        by buffer thread and missingBuffered is emitted then.
         :type frame: int
         :rtype: tuple of (tovian.models.entity.AnnotationObject, int, int)
         :raise AttributeError: if given frame number is out of range [0, video.frame_count]
@@ -85,30 +156,37 @@ class Buffer(QObject):
         if frame < 0 or frame > self.video_frame_count:
             raise AttributeError("Given frame number %s is out of range [0, %s]" % (frame, self.video_frame_count))
 
+        missing = False
+
         # --- locked ----
         self.mutex.lock()
         try:
-            objects = self.cache[frame]
-        except KeyError:
-            logger.error("Buffer objects could not be found for frame: %s", frame)
-            models.repository.logs.insert('gui.exception.get_obj_from_buffer_error',
-                                          "Buffer objects could not be found for frame: %s" % frame,
-                                          annotator_id=self.user_id)
-            objects = self.video.annotation_objects_in_frame(frame)
-        else:
-            objects = objects.values()
-
+            if self.isCached(frame, frame):
+                objects = self.index.in_frame(frame)
+                self.__touchSegments(frame, frame)
+            else:
+                self.stats['misses'] += 1
+                logger.warning("Buffer objects could not be found for frame: %s", frame)
+                models.repository.logs.insert('gui.exception.get_obj_from_buffer_error',
+                                              "Buffer objects could not be found for frame: %s" % frame,
+                                              annotator_id=self.user_id)
+                objects = self.index.in_frame(frame)
+                missing = self.__requestMissing(frame, frame)
         finally:
             self.last_frame_accessed = (frame, frame)
+            self.prefetcher.access(frame)
             self.mutex.unlock()                 # don't forget to release lock
         # ---------------
 
+        if missing:
+            self.fillMissing.emit(frame, frame)
+
         self.checkBufferState.emit()
         return tuple(objects)
 
     def getObjectsInFrameInterval(self, frame_from, frame_to):
         """
-        Returns list of annotation objects for given frame interval.
+        Returns list of annotation objects for given frame interval (see getObjectsInFrame when it is not buffered).
         :type frame_from: int
         :type frame_to: int
         :rtype: tuple of (tovian.models.entity.AnnotationObject, int, int)
@@ -127,53 +205,114 @@ class Buffer(QObject):
             objects = self.getObjectsInFrame(frame_from)
             return objects
 
-        objects = []
+        missing = False
+
         self.mutex.lock()
         try:
-            for frame in range(frame_from, frame_to + 1):
-                try:
-                    data = self.cache[frame]
-                except KeyError:
-                    logger.error("Buffer objects could not be found for frame: %s", frame)
-                    models.repository.logs.insert('gui.exception.get_obj_from_buffer_error',
-                                                  "Buffer objects could not be found for frame: %s" % frame,
-                                                  annotator_id=self.user_id)
-                    data = self.video.annotation_objects_in_frame(frame)
-                else:
-                    data = data.values()
-
-                objects.extend(data)       # converts iterator to values
+            if self.isCached(frame_from, frame_to):
+                objects = self.index.in_interval(frame_from, frame_to)
+                self.__touchSegments(frame_from, frame_to)
+            else:
+                self.stats['misses'] += 1
+                logger.warning("Buffer objects could not be found for frame interval [%s, %s]", frame_from, frame_to)
+                models.repository.logs.insert('gui.exception.get_obj_from_buffer_error',
+                                              "Buffer objects could not be found for frame interval [%s, %s]" % (frame_from, frame_to),
+                                              annotator_id=self.user_id)
+                objects = self.index.in_interval(frame_from, frame_to)
+                missing = self.__requestMissing(frame_from, frame_to)
         finally:
             self.last_frame_accessed = (frame_from, frame_from)
+            self.prefetcher.access(frame_from)
             self.mutex.unlock()
 
+        if missing:
+            self.fillMissing.emit(frame_from, frame_to)
+
         self.checkBufferState.emit()
-        return tuple(set(objects))
+        return tuple(objects)
+
+    def isCached(self, frame_from, frame_to):
+        """
+        Tells if all objects in given frame interval are buffered.
+        :type frame_from: int
+        :type frame_to: int
+        :rtype: bool
+        """
+        return self.cached and self.cached_min_frame <= frame_from and frame_to <= self.cached_max_frame
+
+    def __requestMissing(self, frame_from, frame_to):
+        """
+        Records missing frame interval, returns False when it is already requested. Called with locked mutex.
+        :rtype: bool
+        """
+        for missing_from, missing_to in self.missing:
+            if missing_from <= frame_from and frame_to <= missing_to:
+                return False
+
+        self.missing.append((frame_from, frame_to))
+        return True
+
+    def __touchSegments(self, frame_from, frame_to):
+        """
+        Counts buffer hit and marks segments overlapping given interval as recently used. Called with locked mutex.
+        """
+        self.stats['hits'] += 1
+        self.access_clock += 1
+
+        for segment in self.segments:
+            if segment[0] <= frame_to and segment[1] >= frame_from:
+                segment[2] = self.access_clock
 
     def resetBuffer(self, frame, clear_all=False, clear_object=None):
         """
         Reset buffer - loads new objects depending on given frame number (i.e. when seeking to new frame).
-        Method requests lock when clearing cache!
+        Reset is done by buffer thread (the reset signal), missingBuffered is emitted for the frame then
+        (reading the frame from buffer meanwhile does not request it again).
+        Buffer is cleared immediately, when there are changes flushed but not committed (after edits): they are visible
+        only to the main session, which loads the objects, and callers read the edited objects from buffer right away.
         :param frame: target frame
         :type frame: int
         :param clear_all: manually clears buffer
         :type clear_all: bool
         :param clear_object:  object that has to be refreshed in buffer (object_id, old_start_frame, old_end_frame)
-        :raise ValueError: if given frame number is out of range [0, video.frame_count] |
-        when new min and max cached frame are equaled or invalid
+        :raise ValueError: if given frame number is out of range [0, video.frame_count]
         """
-        #logger.debug("Locking thread")
-        #self.mutex.lock()
-        #self.last_frame_accessed = (min_frame_interval, max_frame_interval)
-        #self.mutex.unlock()
-        #logger.debug("Thread unlocked")
-
         if frame < 0 or frame > self.video_frame_count:
             raise ValueError("Given frame number %s is out of range [0, %s]" % (frame, self.video_frame_count))
 
+        if clear_all:
+            # next/previous object is searched among objects committed by other annotators meanwhile too
+            models.entity.invalidate_timeline_indexes()
+
+        if (clear_all or clear_object) and models.database.db.uncommitted_flush:
+            self.__reset(frame, clear_all, clear_object)
+            return
+
+        self.mutex.lock()
+        self.__requestMissing(frame, frame)
+        self.mutex.unlock()
+
+        self.reset.emit(frame, clear_all, clear_object)
+
+    @Slot(int, bool, object)
+    def __resetBuffer(self, frame, clear_all, clear_object):
+        """
+        Resets buffer by buffer thread (see resetBuffer) and emits missingBuffered for the frame, when objects are buffered.
+        """
+        self.__reset(frame, clear_all, clear_object,
+                     done=lambda published: self.__missingBuffered(frame, frame, published))
+
+    def __reset(self, frame, clear_all=False, clear_object=None, done=None):
+        """
+        Resets buffer for given frame (see resetBuffer).
+        When seeking, objects of the old window overlapping the new one are kept and only the rest is loaded.
+        Method requests lock when clearing cache!
+        :param done: called when the fill is published (see Fill), with False when no fill is needed
+        :raise ValueError: when new min and max cached frame are equaled or invalid
+        """
         if not clear_all and not clear_object:
             # if new frame has been already cached
-            if frame in self.cache:
+            if self.isCached(frame, frame):
                 min_frame = frame - ((self.displayed_frames_range - 1) / 2.0)
                 max_frame = frame + ((self.displayed_frames_range - 1) / 2.0)
 
@@ -183,20 +322,23 @@ class Buffer(QObject):
                 # if new frame display frame range is also cached
                 if self.cached_min_frame <= min_frame and self.cached_max_frame >= max_frame:
                     logger.debug("New frame and displayed frame interval is cached and no need to reset")
+                    if done is not None:
+                        done(False)
                     return
                 else:
                     logger.debug("Target frame is cached, but displayed frame range isn't.")
             else:
                 logger.debug("Target frame is not cached.")
-        # calculate new start_frame and stop_frame
-        new_start_frame = frame - int((self.cached_time / 2.0) * self.video_frame_fps)
-        new_stop_frame = frame + int((self.cached_time / 2.0) * self.video_frame_fps)
+        # calculate new start_frame and stop_frame, mostly in the direction of travel
+        new_start_frame, new_stop_frame = self.prefetcher.window(frame)
         new_start_frame = 0 if new_start_frame < 0 else new_start_frame
         new_stop_frame = self.video_frame_count if new_stop_frame > self.video_frame_count else new_stop_frame
 
         if new_stop_frame == new_start_frame or new_stop_frame < new_start_frame:
             logger.error("New start_frame '%s' and stop_frame '%s' are equal or invalid.",
                          new_start_frame, new_stop_frame)
+            if done is not None:
+                done(False)
             raise ValueError("New start_frame '%s' and stop_frame '%s' are equal or invalid."
                              % (new_start_frame, new_stop_frame))
 
@@ -205,143 +347,327 @@ class Buffer(QObject):
 
             logger.debug("Deleting old object data from cache")
             self.mutex.lock()
-            for i in range(old_start, old_end + 1):
-                cache_data = self.cache[i]
-                del cache_data[object_id]
+            self.index.remove(object_id)
+            self.index_version += 1
+            self.stats['bytes'] = self.index.size
             self.mutex.unlock()
             logger.debug("Thread unlocked")
 
-            ## TODO DELETE !!!!!!!!!!!!!!!!!!!!!!!! FOR DEBUGGING PURPOSES
-            #for key, value in self.cache.iteritems():
-            #    if object_id in value:
-            #        print key, value
-            #        raise Exception()
-
             logger.debug("Clearing object id '%s' from buffer and resetting for new frame: %s", object_id, frame)
-            self.__bufferObjectByID(frame, object_id)
+            self.__bufferObjectByID(frame, object_id, done=done)
 
-        else:
+        elif clear_all:
             logger.debug("Resetting and clearing whole buffer for new frame: %s", frame)
 
-            self.mutex.lock()
-            self.cache = {}
-            self.mutex.unlock()
-            self.__bufferObjects(new_start_frame, new_stop_frame)       # manually invoked buffering
+            # manually invoked buffering, the old window is readable until the new one is swapped in
+            self.__bufferObjects(new_start_frame, new_stop_frame, replace=True, done=done)
+
+        else:
+            logger.debug("Moving buffer window for new frame: %s", frame)
+            self.__moveWindow(new_start_frame, new_stop_frame, done=done)
 
-    def __bufferObjects(self, frame_from, frame_to):
+    def __loadObjects(self, intervals, filter_object_ids=None):
         """
-        Called to buffer new objects from database for given frame interval.
-        Method requests lock when writing to cache!
-        :type frame_from: int
-        :type frame_to: int
-        :raise ValueError: When frame_from or frame_to has invalid value (out of range, etc.)
+        Loads annotation objects in given frame intervals from database by the database executor (own connection
+        and session), buffer thread never uses the main session. Loaded objects are detached, they are merged into
+        the main session by the main thread (see __publishFill). Changes flushed but not committed yet are visible
+        only to the main session, in such case objects are not loaded (None is returned) and the main thread loads them.
+        :type intervals: list of (int, int)
+        :type filter_object_ids: list of int
+        :rtype: list of (tovian.models.entity.AnnotationObject, int, int) or None
         """
-        logger.debug("Tries buffer new frame interval [%s, %s]...", frame_from, frame_to)
-        if frame_from > frame_to or frame_from < 0 or frame_to > self.video_frame_count:
-            raise ValueError("Invalid frame_from '%s' and frame_to values '%s'", frame_from, frame_to)
+        if models.database.db.uncommitted_flush:
+            return None
 
-        self.mutex.lock()
+        def load(session, video_id):
+            video = session.query(models.entity.Video).get(video_id)
+            return video.annotation_objects_in_frame_intervals(intervals, filter_object_ids, session=session)
+
+        return executor.executor.submit(load, self.video_id).result()
+
+    def __fill(self, fill):
+        """
+        Loads objects of the fill and passes it to the main thread, which merges them into the main session
+        and publishes them (see __publishFill). Called by the buffer thread (or by the main thread, the fill is published
+        immediately then).
+        :type fill: Fill
+        """
         try:
-            objectsTuples = self.video.annotation_objects_in_frame_intervals([(frame_from, frame_to)])
+            fill_start = time.time()
+            fill.rows = self.__loadObjects(fill.intervals, fill.filter_object_ids) if fill.intervals else []
+
+            if fill.rows is not None and fill.filter_object_ids is None:
+                self.prefetcher.filled(sum(stop - start + 1 for start, stop in fill.intervals), time.time() - fill_start)
         except Exception:
             # TODO display error to user
-            logger.exception("Error when buffering new objects from database on interval [%s, %s]", frame_from, frame_to)
+            logger.exception("Error when buffering new objects from database on intervals %s", fill.intervals)
             models.repository.logs.insert('gui.exception.buffering_new_obj_error',
-                                          "Error when buffering new objects from database on interval [%s, %s]" %
-                                          (frame_from, frame_to),
+                                          "Error when buffering new objects from database on intervals %s" % fill.intervals,
                                           annotator_id=self.user_id)
-            self.mutex.unlock()         # don't forget to release lock
-            return
+            fill.failed = True
+
+        if fill.intervals and not fill.failed:
+            self.buffering.emit()
+
+        self.mutex.lock()
+        self.pending_fills += 1
+        self.mutex.unlock()
 
-        cleared = not self.cache
-        self.buffering.emit()
+        self.main_thread_call.call.emit(partial(self.__publishFill, fill))
+
+    def __publishFill(self, fill):
+        """
+        Called by the main thread: merges objects of the fill into the main session without SQL (or loads them
+        by the main session, when there are changes flushed but not committed) and publishes them.
+        :type fill: Fill
+        """
+        published = False
 
-        #logger.debug("Locking thread -> adding new data to cache")
-        #self.mutex.lock()               # request lock
         try:
-            for frame in range(frame_from, frame_to + 1):
+            if not fill.failed:
                 try:
-                    frame_dict = self.cache[frame]
-                except KeyError:
-                    self.cache[frame] = {}
-                    frame_dict = self.cache[frame]
-
-                # add record to cache
-                for objectTuple in objectsTuples:
-                    an_object, start_frame, end_frame = objectTuple
-                    if start_frame <= frame <= end_frame:
-                        frame_dict[an_object.id] = objectTuple
-
-            # if cache has been cleared when method called, set min and max pointers as usually
-            if cleared:
-                self.cached_max_frame = frame_to
-                self.cached_min_frame = frame_from
-
-            # if don't, cache has been extended, so moves pointer a bit
+                    if fill.intervals and (fill.rows is None or models.database.db.uncommitted_flush):
+                        objectsTuples = self.video.annotation_objects_in_frame_intervals(fill.intervals,
+                                                                                         fill.filter_object_ids)
+                    else:
+                        objectsTuples = executor.merge_into_session(fill.rows)
+                except Exception:
+                    # TODO display error to user
+                    logger.exception("Error when buffering new objects from database on intervals %s", fill.intervals)
+                    models.repository.logs.insert('gui.exception.buffering_new_obj_error',
+                                                  "Error when buffering new objects from database on intervals %s" %
+                                                  fill.intervals,
+                                                  annotator_id=self.user_id)
+                    fill.failed = True
+
+            if fill.failed:
+                if fill.replace:
+                    # buffered objects are not valid any more, reading from buffer requests them again
+                    self.__publishIndex([], replace=True)
+
             else:
-                if frame_from < self.cached_min_frame:
-                    self.cached_min_frame = frame_from
-                if frame_to > self.cached_max_frame:
-                    self.cached_max_frame = frame_to
+                if fill.filter_object_ids and not objectsTuples:
+                    logger.warning("No objects %s for frame intervals %s in database!", fill.filter_object_ids, fill.intervals)
 
+                published = self.__publishIndex(objectsTuples, fill.segments, fill.replace, fill.window, fill.window_version)
+
+                if published:
+                    logger.debug("Buffered new frame intervals %s", fill.intervals)
+                else:
+                    logger.debug("Buffer has been reset while buffering intervals %s, objects are dropped", fill.intervals)
         finally:
-            self.mutex.unlock()         # don't forget to release lock
+            self.mutex.lock()
+            self.pending_fills -= 1
+            self.mutex.unlock()
+
+            if fill.intervals:
+                self.buffered.emit()
 
-        self.buffered.emit()
-        logger.debug("Buffered new time interval [%s, %s]", frame_from, frame_to)
+        if fill.done is not None:
+            fill.done(published)
 
-    def __bufferObjectByID(self, target_frame, object_id):
+    def __bufferObjects(self, frame_from, frame_to, replace=False, done=None):
         """
-        Buffer new object by given ID from database on given frame
-        :type target_frame: int
-        :type object_id: int
-        :raise ValueError: When frame is out of range
+        Called to buffer new objects from database for given frame interval.
+        Objects are loaded and the new index is built without lock, lock is requested only to swap it in,
+        so reading from buffer is not blocked by the database query.
+        :type frame_from: int
+        :type frame_to: int
+        :param replace: buffered window is replaced by the interval (otherwise it is extended)
+        :type replace: bool
+        :param done: called when the fill is published (see Fill)
+        :raise ValueError: When frame_from or frame_to has invalid value (out of range, etc.)
         """
-        logger.debug("Trying to buffer new object id '%s' on frame '%s'", object_id, target_frame)
-        if target_frame < 0 or target_frame > self.video_frame_count:
-            raise ValueError("Given frame number is out of video frame count range")
+        logger.debug("Tries buffer new frame interval [%s, %s]...", frame_from, frame_to)
+        if frame_from > frame_to or frame_from < 0 or frame_to > self.video_frame_count:
+            raise ValueError("Invalid frame_from '%s' and frame_to values '%s'", frame_from, frame_to)
 
-        try:
-            objectTuples = self.video.annotation_objects_in_frame_intervals([(target_frame, target_frame)],
-                                                                            [object_id, ])
-        except Exception:
-            # TODO display error to user
-            logger.exception("Error when buffering new object id '%s' from database on on frame '%s'",
-                             object_id, target_frame)
-            models.repository.logs.insert('gui.exception.buffering_new_obj_error',
-                                          "Error when buffering new object id '%s' from database on on frame '%s'" %
-                                          (object_id, target_frame),
-                                          annotator_id=self.user_id)
-            return
+        self.mutex.lock()
+        window_version = self.window_version
+        self.mutex.unlock()
+
+        self.__fill(Fill([(frame_from, frame_to)], [(frame_from, frame_to)], replace,
+                         window_version=None if replace else window_version, done=done))
+
+    def __moveWindow(self, frame_from, frame_to, done=None):
+        """
+        Moves buffered window to given frame interval. Objects overlapping the new window are kept, only its parts
+        not buffered yet are loaded (by one query) and objects outside of it are dropped.
+        Window is replaced, when the old one does not overlap the new one.
+        :type frame_from: int
+        :type frame_to: int
+        :param done: called when the fill is published (see Fill)
+        """
+        self.mutex.lock()
+        overlapping = self.cached and frame_from <= self.cached_max_frame and frame_to >= self.cached_min_frame
+        cached_min_frame, cached_max_frame = self.cached_min_frame, self.cached_max_frame
+        window_version = self.window_version
+        self.mutex.unlock()
 
-        if not objectTuples:
-            logger.warning("No object id '%s' for frame '%s' in database!")
+        if not overlapping:
+            self.__bufferObjects(frame_from, frame_to, replace=True, done=done)
             return
-        elif len(objectTuples) > 1:
-            logger.warning("Returned more than one object by id from database!")
 
-        self.buffering.emit()
+        intervals = missing_intervals(frame_from, frame_to, cached_min_frame, cached_max_frame)
+
+        logger.debug("Moving buffer window [%s, %s] to [%s, %s], loading intervals %s",
+                     cached_min_frame, cached_max_frame, frame_from, frame_to, intervals)
+
+        self.__fill(Fill(intervals, intervals, window=(frame_from, frame_to), window_version=window_version, done=done))
+
+    def __publishIndex(self, objectsTuples, segments=(), replace=False, window=None, window_version=None):
+        """
+        Builds new index with given objects (a copy of the current index, or an empty one when replacing)
+        without lock and swaps it in. When the index is changed meanwhile, it is built again. Called by the main thread.
+        :param segments: buffered frame intervals [(frame_from, frame_to), ...]
+        :param replace: buffered window is replaced (by segments)
+        :param window: buffered window is moved to (frame_from, frame_to), objects outside of it are dropped
+        :param window_version: objects are dropped when the window has been replaced since this version
+        :return: False when objects are dropped
+        :rtype: bool
+        """
+        while True:
+            self.mutex.lock()
+            try:
+                if window_version is not None and window_version != self.window_version:
+                    return False
+
+                index_version = self.index_version
+                index = models.entity.SpanIndex(self.index.memory_usage) if replace else self.index.copy()
+            finally:
+                self.mutex.unlock()
+
+            removed = index.remove_outside(*window) if window is not None else []
+
+            # one record per object, regardless of its length, tree is built here instead of the first query
+            index.add(objectsTuples)
+            index.update()
+
+            segments_sizes = [sum(index.spans[objectTuple[0].id].size for objectTuple in objectsTuples
+                                  if objectTuple[1] <= frame_to and objectTuple[2] >= frame_from)
+                              for frame_from, frame_to in segments]
+
+            self.mutex.lock()
+            try:
+                if index_version != self.index_version:
+                    logger.debug("Buffer index changed while building the new one, building again")
+                    continue
+
+                self.index = index
+                self.index_version += 1
+                self.stats['bytes'] = index.size
+
+                if replace:
+                    self.window_version += 1
+                    self.cached = False
+                    self.segments = []
+
+                if window is not None:
+                    # fills of the old window are not continuous with the new one
+                    self.window_version += 1
+                    self.__clipSegments(*window)
+
+                for (frame_from, frame_to), segment_size in zip(segments, segments_sizes):
+                    self.access_clock += 1
+
+                    # if cache has been cleared, set min and max pointers as usually
+                    if not self.cached:
+                        self.cached = True
+                        self.cached_max_frame = frame_to
+                        self.cached_min_frame = frame_from
+                        self.segments = []
+
+                    # if don't, cache has been extended, so moves pointer a bit
+                    else:
+                        if frame_from < self.cached_min_frame:
+                            self.cached_min_frame = frame_from
+                        if frame_to > self.cached_max_frame:
+                            self.cached_max_frame = frame_to
+
+                    self.segments.append([frame_from, frame_to, self.access_clock, segment_size])
+
+                self.segments.sort()
+                break
+            finally:
+                self.mutex.unlock()         # don't forget to release lock
+
+        if removed:
+            self.objectsRemoved.emit([objectTuple[0] for objectTuple in removed])
+
+        return True
+
+    def __clipSegments(self, frame_from, frame_to):
+        """
+        Drops segments outside of given frame interval and clips the rest to it (their sizes proportionally),
+        the interval becomes the buffered window. Called with locked mutex.
+        """
+        self.segments = clip_segments(self.segments, frame_from, frame_to)
+        self.cached_min_frame = frame_from
+        self.cached_max_frame = frame_to
+
+    @Slot(int, int)
+    def __bufferMissing(self, frame_from, frame_to):
+        """
+        Buffers frame interval, which was not buffered when accessed, and emits missingBuffered.
+        Interval overlapping or next to the buffered window extends it, otherwise the window is replaced.
+        """
+        logger.debug("Buffering missing frame interval [%s, %s]", frame_from, frame_to)
 
-        logger.debug("Locking thread -> adding to cache new data")
         self.mutex.lock()
-        try:
-            an_object, start_frame, end_frame = objectTuples[0]
+        cached = self.isCached(frame_from, frame_to)
+        adjacent = self.cached and frame_from <= self.cached_max_frame + 1 and frame_to >= self.cached_min_frame - 1
+        cached_min_frame, cached_max_frame = self.cached_min_frame, self.cached_max_frame
+        window_version = self.window_version
+        self.mutex.unlock()
 
-            for frame in range(start_frame, end_frame + 1):
-                try:
-                    frame_dict = self.cache[frame]
-                except KeyError:
-                    self.cache[frame] = {}
-                    frame_dict = self.cache[frame]
+        fill_frames = self.prefetcher.fillFrames()
+        done = lambda buffered: self.__missingBuffered(frame_from, frame_to, buffered)
 
-                frame_dict[an_object.id] = objectTuples[0]
+        if cached:
+            done(True)
 
-        finally:
-            self.mutex.unlock()
-            logger.debug("Thread unlocked")
+        elif adjacent:
+            intervals = []
+
+            if frame_to > cached_max_frame:
+                intervals.append((cached_max_frame + 1, min(frame_to + fill_frames, self.video_frame_count)))
+            if frame_from < cached_min_frame:
+                intervals.append((max(frame_from - fill_frames, 0), cached_min_frame - 1))
+
+            self.__fill(Fill(intervals, intervals, window_version=window_version, done=done))
+
+        else:
+            new_start, new_stop = self.prefetcher.window(frame_from)
+            new_start = max(min(new_start, frame_from), 0)
+            new_stop = min(max(new_stop, frame_to), self.video_frame_count)
+
+            self.__bufferObjects(new_start, new_stop, replace=True, done=done)
+
+    def __missingBuffered(self, frame_from, frame_to, buffered):
+        """
+        Called when missing frame interval has been buffered (or buffering failed), emits missingBuffered.
+        """
+        self.mutex.lock()
+        if (frame_from, frame_to) in self.missing:
+            self.missing.remove((frame_from, frame_to))
+        self.mutex.unlock()
 
-        self.buffered.emit()
-        logger.debug("Buffered new by id '%s' on frame '%s'", object_id, target_frame)
+        if buffered:
+            self.missingBuffered.emit(frame_from, frame_to)
+
+    def __bufferObjectByID(self, target_frame, object_id, done=None):
+        """
+        Buffer new object by given ID from database on given frame
+        :type target_frame: int
+        :type object_id: int
+        :param done: called when the fill is published (see Fill)
+        :raise ValueError: When frame is out of range
+        """
+        logger.debug("Trying to buffer new object id '%s' on frame '%s'", object_id, target_frame)
+        if target_frame < 0 or target_frame > self.video_frame_count:
+            raise ValueError("Given frame number is out of video frame count range")
+
+        self.__fill(Fill([(target_frame, target_frame)], [], filter_object_ids=[object_id, ], done=done))
 
     @Slot()
     def __checkBuffer(self):
@@ -349,56 +675,61 @@ class Buffer(QObject):
         Method called when some data in cache has been accessed to check,
         if needs to be loaded new objects from database.
         """
-        memory_usage = sys.getsizeof(self.cache)
+        self.mutex.lock()
+        size = self.index.size
+        self.mutex.unlock()
 
-        if memory_usage > self.MAX_MEMORY_USAGE:
-            logger.warning("Reached maximum allowed memory usage '%s' bytes -> resetting buffer", self.MAX_MEMORY_USAGE)
-            lower_accessed_frame, higher_accessed_frame = self.last_frame_accessed
-            if lower_accessed_frame == higher_accessed_frame:
-                frame = higher_accessed_frame
-            else:
-                frame = ((higher_accessed_frame - lower_accessed_frame) / 2) + lower_accessed_frame
+        if size > self.MAX_MEMORY_USAGE:
+            logger.debug("Reached maximum allowed memory usage '%s' bytes -> evicting segments", self.MAX_MEMORY_USAGE)
+            self.__evictSegments()
 
-            self.resetBuffer(frame, clear_all=True)
-            return
+        # state shared with the main thread is read at once (after the eviction)
+        self.mutex.lock()
+        pending_fills = self.pending_fills
+        cached_min_frame, cached_max_frame = self.cached_min_frame, self.cached_max_frame
+        frame = self.last_frame_accessed[0]
+        self.mutex.unlock()
 
-        cached_min_border = self.cached_min_frame - self.last_frame_accessed[0]
-        cached_max_border = self.cached_max_frame - self.last_frame_accessed[1]
-        allowed_border = self.cached_time_border * self.cached_time * self.video_frame_fps
+        if pending_fills:
+            # buffered window is not moved until fills are published, the next access checks it again
+            logger.debug("Check buffer - waiting for %s fills to be published", pending_fills)
+            return
 
         # ----
-        # If the last_accessed_frame pointer is between borders (typically between 25% and 75% cache), do nothing.
-        # else cache new interval and merge cached data
-        # i.e. cache status  =   |bottom|--------------0current0--|top|   => max border passed, cache new objects =>
+        # Fill in the direction of travel starts, when the playhead is closer to the edge than it travels during
+        # estimated fills (see Prefetcher), the window is extended by a fill of estimated size.
+        # i.e. cache status  =   |bottom|--------------0current0--|top|   => lead passed, cache new objects =>
         #      => new status =   |bottom|--------------0current0--(-----------------------------)|top|
         # ----
+        direction = self.prefetcher.plan(frame, cached_min_frame, cached_max_frame)
+        fill_frames = self.prefetcher.fillFrames()
 
         # bottom border
-        if cached_min_border > -allowed_border:
-            new_stop = self.cached_min_frame - 1
-            new_start = new_stop - int(self.cached_time * self.video_frame_fps)
+        if direction == -1:
+            new_stop = cached_min_frame - 1
+            new_start = new_stop - fill_frames
 
             new_start = 0 if new_start < 0 else new_start
             new_start = self.video_frame_count if new_start > self.video_frame_count else new_start
             new_stop = 0 if new_stop < 0 else new_stop
             new_stop = self.video_frame_count if new_stop > self.video_frame_count else new_stop
 
-            if new_start != new_stop:
+            if new_start < new_stop:
                 logger.debug("Check buffer - buffer needs to load new objects, direction down")
 
                 self.__bufferObjects(new_start, new_stop)
 
         # upper border
-        elif cached_max_border < allowed_border:
-            new_start = self.cached_max_frame + 1
-            new_stop = new_start + int(self.cached_time * self.video_frame_fps)
+        elif direction == 1:
+            new_start = cached_max_frame + 1
+            new_stop = new_start + fill_frames
 
             new_start = 0 if new_start < 0 else new_start
             new_start = self.video_frame_count if new_start > self.video_frame_count else new_start
             new_stop = 0 if new_stop < 0 else new_stop
             new_stop = self.video_frame_count if new_stop > self.video_frame_count else new_stop
 
-            if new_start != new_stop:
+            if new_start < new_stop:
                 logger.debug("Check buffer - buffer needs to load new objects, direction up")
 
                 self.__bufferObjects(new_start, new_stop)
@@ -406,6 +737,80 @@ class Buffer(QObject):
         else:
             logger.debug("Check buffer - status OK")
 
+    def __evictSegments(self):
+        """
+        Evicts least recently used segments (the farthest from the last accessed frame when used at the same time)
+        until approximate memory usage is under MAX_MEMORY_USAGE. Only segments at the ends of the buffered window
+        are evicted (the window stays continuous), never the segment with the last accessed frame.
+        Segments are evicted from a copy of the index without lock, which is swapped in as in __publishIndex.
+        Evicted objects are passed to the main thread by objectsRemoved, which expires them in the session
+        (see executor.expire_unchanged), so they and their loaded values can be garbage collected.
+        """
+        while True:
+            self.mutex.lock()
+            try:
+                index_version = self.index_version
+                index = self.index.copy()
+                segments = list(self.segments)
+                frame = self.last_frame_accessed[0]
+            finally:
+                self.mutex.unlock()
+
+            removed = []
+            evicted = []
+            evicted_bytes = 0
+
+            while index.size > self.MAX_MEMORY_USAGE and len(segments) > 1:
+                candidates = [segment for segment in (segments[0], segments[-1])
+                              if not (segment[0] <= frame <= segment[1])]
+
+                if not candidates:
+                    break
+
+                segment = min(candidates, key=lambda segment: (segment[2], -abs(frame - (segment[0] + segment[1]) / 2)))
+                segments.remove(segment)
+                evicted.append(segment)
+
+                # objects overlapping the rest of the window are kept
+                size = index.size
+                removed.extend(index.remove_outside(segments[0][0], segments[-1][1]))
+                evicted_bytes += size - index.size
+
+                logger.debug("Evicting buffer segment [%s, %s], %s bytes", segment[0], segment[1], size - index.size)
+
+            if not evicted:
+                break
+
+            index.update()
+
+            self.mutex.lock()
+            try:
+                if index_version != self.index_version:
+                    logger.debug("Buffer index changed while evicting segments, evicting again")
+                    continue
+
+                self.index = index
+                self.index_version += 1
+
+                # segments are not changed without changing the index, only their access times
+                self.segments = [segment for segment in self.segments if not any(segment is e for e in evicted)]
+                self.cached_min_frame = self.segments[0][0]
+                self.cached_max_frame = self.segments[-1][1]
+
+                self.stats['evictions'] += len(evicted)
+                self.stats['evicted_bytes'] += evicted_bytes
+                self.stats['bytes'] = index.size
+                break
+            finally:
+                self.mutex.unlock()
+
+        if removed:
+            self.objectsRemoved.emit([objectTuple[0] for objectTuple in removed])
+
+        if index.size > self.MAX_MEMORY_USAGE:
+            logger.warning("Buffer uses %s bytes (maximum %s bytes), no more segments can be evicted",
+                           index.size, self.MAX_MEMORY_USAGE)
+
     @staticmethod
     def bufferFinished():
         """
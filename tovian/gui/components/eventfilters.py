@@ -19,6 +19,8 @@ class GlobalFilter(QObject):
     muteKeyPressed = Signal()
     volumeUpKeyPressed = Signal()
     volumeDownKeyPressed = Signal()
+    nextKeyframeKeyPressed = Signal()
+    prevKeyframeKeyPressed = Signal()
     mouseWheel = Signal(int)
 
     def eventFilter(self, obj, event):
@@ -59,6 +61,14 @@ class GlobalFilter(QObject):
             if event.key() == Qt.Key_Asterisk and modifier == Qt.ControlModifier:
                 self.muteKeyPressed.emit()
                 return True
+                # CTRL + SHIFT + RIGHT key pressed
+            if event.key() == Qt.Key_Right and modifier == Qt.ControlModifier | Qt.ShiftModifier:
+                self.nextKeyframeKeyPressed.emit()
+                return True
+                # CTRL + SHIFT + LEFT key pressed
+            if event.key() == Qt.Key_Left and modifier == Qt.ControlModifier | Qt.ShiftModifier:
+                self.prevKeyframeKeyPressed.emit()
+                return True
 
         return super(GlobalFilter, self).eventFilter(obj, event)
 
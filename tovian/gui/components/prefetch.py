@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Planning of buffer fills (see buffer.Buffer), without Qt, so it can be tested without a GUI:
+    size and timing of fills (Prefetcher), parts of a moved window to load and clipping of buffered segments.
+"""
+
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+logger.debug('Import ' + __name__)
+
+
+class Prefetcher(object):
+    """
+    Plans buffer fills from measured playhead speed and direction, and from measured duration of fills.
+
+    Fill size (in frames) is chosen so that one fill takes about target_fill_time (smaller fills in dense scenes,
+    bigger on empty stretches), fills ahead in the direction of travel start when the playhead is closer to the edge
+    of the buffered window than it travels (at least at 1x speed) during two estimated fills.
+    Jumps longer than seek_time seconds of video are seeks, they do not change the speed.
+    """
+
+    target_fill_time = 0.25     # seconds of a database query
+    min_fill_time = 2           # seconds of video
+    max_fill_time = 60          # seconds of video
+    seek_time = 2               # seconds of video
+    margin_time = 1             # seconds of video, kept buffered behind the playhead and ahead when stepping
+    smoothing = 0.3             # weight of a new measurement
+
+    def __init__(self, fps, cached_time):
+        self.fps = fps
+        self.velocity = 0.0                                 # frames per second, signed
+        self.direction = 1
+        self.seconds_per_frame = self.target_fill_time / (cached_time * fps) # duration of fill per frame, initial fill of cached_time seconds
+        self.last_access = None                             # (time, frame)
+
+    def access(self, frame, now=None):
+        """
+        Called when the playhead moves (frames are read from the buffer).
+        """
+        now = time.time() if now is None else now
+
+        if self.last_access is not None:
+            last_time, last_frame = self.last_access
+            delta_time = now - last_time
+            delta_frames = frame - last_frame
+
+            if delta_frames == 0 or delta_time <= 0:
+                return
+
+            if abs(delta_frames) > self.seek_time * self.fps:
+                # seek, speed is measured again
+                self.velocity = 0.0
+            else:
+                self.velocity += self.smoothing * (delta_frames / delta_time - self.velocity)
+                self.direction = 1 if delta_frames > 0 else -1
+
+        self.last_access = (now, frame)
+
+    def filled(self, frames, duration):
+        """
+        Called after a fill of given number of frames, which took duration seconds.
+        """
+        if frames > 0:
+            self.seconds_per_frame += self.smoothing * (float(duration) / frames - self.seconds_per_frame)
+
+    def fillFrames(self):
+        """
+        :rtype: int
+        """
+        frames = self.target_fill_time / max(self.seconds_per_frame, 1e-9)
+
+        return int(min(max(frames, self.min_fill_time * self.fps), self.max_fill_time * self.fps))
+
+    def leadFrames(self):
+        """
+        Distance from the edge of buffered window, when fill in the direction of travel starts.
+        :rtype: int
+        """
+        speed = max(abs(self.velocity), self.fps)
+
+        return int(speed * 2 * self.fillFrames() * self.seconds_per_frame + self.margin_time * self.fps)
+
+    def plan(self, frame, cached_min_frame, cached_max_frame):
+        """
+        Returns direction of the next fill (1 after cached_max_frame, -1 before cached_min_frame) or None.
+        :rtype: int or None
+        """
+        ahead, behind = (cached_max_frame - frame, frame - cached_min_frame)
+
+        if self.direction < 0:
+            ahead, behind = behind, ahead
+
+        if ahead < self.leadFrames():
+            return self.direction
+
+        if behind < self.margin_time * self.fps:
+            return -self.direction
+
+        return None
+
+    def window(self, frame):
+        """
+        Interval to fill when the buffer is reset in given frame, mostly in the direction of travel.
+        :rtype: (int, int)
+        """
+        frames = self.fillFrames()
+        behind = int(self.margin_time * self.fps)
+
+        if self.direction > 0:
+            return frame - behind, frame + frames
+        else:
+            return frame - frames, frame + behind
+
+
+def missing_intervals(frame_from, frame_to, cached_min_frame, cached_max_frame):
+    """
+    Parts of frame interval [frame_from, frame_to] outside of buffered window [cached_min_frame, cached_max_frame],
+    which overlaps it (i.e. intervals loaded when the window is moved).
+
+    :rtype: list of (int, int)
+    """
+
+    intervals = []
+
+    if frame_from < cached_min_frame:
+        intervals.append((frame_from, cached_min_frame - 1))
+    if frame_to > cached_max_frame:
+        intervals.append((cached_max_frame + 1, frame_to))
+
+    return intervals
+
+
+def clip_segments(segments, frame_from, frame_to):
+    """
+    Drops segments [frame_from, frame_to, last access, bytes] outside of given frame interval and clips the rest to it,
+    their sizes proportionally.
+
+    :rtype: list of list
+    """
+
+    clipped = []
+
+    for segment_from, segment_to, last_access, segment_size in segments:
+        if segment_to < frame_from or segment_from > frame_to:
+            continue
+
+        clipped_from, clipped_to = max(segment_from, frame_from), min(segment_to, frame_to)
+        segment_size = segment_size * (clipped_to - clipped_from + 1) / (segment_to - segment_from + 1)
+
+        clipped.append([clipped_from, clipped_to, last_access, segment_size])
+
+    return clipped
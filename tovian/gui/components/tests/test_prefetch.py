@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import tovian.log as log
+
+
+root_dir = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..')
+log.setup_logging(os.path.join(root_dir, 'data', 'log_testing.json'), log_dir=os.path.join(root_dir, 'log'))
+
+import tovian.gui.components.prefetch as prefetch
+
+
+class PrefetchTestCase(unittest.TestCase):
+    def setUp(self):
+        # 25 fps, the first fill of 10 seconds takes target_fill_time
+        self.prefetcher = prefetch.Prefetcher(25, 10)
+
+    def tearDown(self):
+        pass
+
+    def play(self, frame_from, frames, step, now=0.0):
+        # playhead moves by step frames in every frame (25 fps), returns the last frame and time
+        frame = frame_from
+
+        for i in xrange(frames):
+            self.prefetcher.access(frame, now=now)
+            frame += step
+            now += 1.0 / 25
+
+        return frame - step, now - 1.0 / 25
+
+
+    def test_001a_fill_frames(self):
+        self.assertEqual(self.prefetcher.fillFrames(), 250)
+
+        # fills taking longer are smaller, within min_fill_time and max_fill_time
+        self.prefetcher.filled(250, 0.5)
+        self.assertEqual(self.prefetcher.fillFrames(), 192)
+
+        for i in xrange(50):
+            self.prefetcher.filled(250, 100.0)
+        self.assertEqual(self.prefetcher.fillFrames(), 50)
+
+        for i in xrange(50):
+            self.prefetcher.filled(250, 0.0)
+        self.assertEqual(self.prefetcher.fillFrames(), 1500)
+
+    def test_001b_lead_frames(self):
+        # stopped playhead is planned as 1x speed: two fills (2 * 0.25 s) and margin_time
+        self.assertEqual(self.prefetcher.leadFrames(), int(25 * 0.5 + 25))
+
+        # 1x speed
+        frame, now = self.play(0, 50, 1)
+        self.assertEqual(self.prefetcher.direction, 1)
+        self.assertEqual(self.prefetcher.leadFrames(), 37)
+
+        self.assertIsNone(self.prefetcher.plan(frame, 0, frame + 37))
+        self.assertEqual(self.prefetcher.plan(frame, 0, frame + 36), 1)
+
+        # 4x speed, fill starts earlier
+        frame, now = self.play(frame, 50, 4, now)
+        self.assertAlmostEqual(self.prefetcher.leadFrames(), int(100 * 0.5 + 25), delta=1)
+        self.assertEqual(self.prefetcher.plan(frame, 0, frame + 60), 1)
+
+        # not enough frames buffered behind the playhead
+        self.assertEqual(self.prefetcher.plan(frame, frame - 10, frame + 1000), -1)
+        self.assertIsNone(self.prefetcher.plan(frame, frame - 25, frame + 1000))
+
+    def test_001c_direction_reversal(self):
+        frame, now = self.play(1000, 50, 1)
+        self.assertEqual(self.prefetcher.window(frame), (frame - 25, frame + 250))
+
+        frame, now = self.play(frame - 1, 50, -1, now)
+        self.assertEqual(self.prefetcher.direction, -1)
+        self.assertLess(self.prefetcher.velocity, 0)
+
+        # fills are planned before the buffered window and the reset window is mostly before the frame
+        self.assertEqual(self.prefetcher.plan(frame, frame - 36, frame + 1000), -1)
+        self.assertIsNone(self.prefetcher.plan(frame, frame - 37, frame + 1000))
+        self.assertEqual(self.prefetcher.plan(frame, frame - 1000, frame + 10), 1)
+        self.assertEqual(self.prefetcher.window(frame), (frame - 250, frame + 25))
+
+    def test_001d_seek(self):
+        frame, now = self.play(0, 50, 1)
+        velocity = self.prefetcher.velocity
+
+        # jump longer than seek_time is not measured as speed
+        self.prefetcher.access(frame - 1000, now=now + 0.04)
+        self.assertEqual(self.prefetcher.velocity, 0.0)
+        self.assertEqual(self.prefetcher.direction, 1)
+        self.assertEqual(self.prefetcher.last_access, (now + 0.04, frame - 1000))
+
+        # jump of seek_time is not a seek
+        self.prefetcher.access(frame - 1050, now=now + 0.08)
+        self.assertEqual(self.prefetcher.direction, -1)
+        self.assertLess(self.prefetcher.velocity, -velocity)
+
+        # the same frame or time is ignored
+        last_access = self.prefetcher.last_access
+        self.prefetcher.access(frame - 1050, now=now + 1.0)
+        self.prefetcher.access(frame, now=now + 0.08)
+        self.assertEqual(self.prefetcher.last_access, last_access)
+
+    def test_002a_missing_intervals(self):
+        self.assertEqual(prefetch.missing_intervals(50, 350, 100, 299), [(50, 99), (300, 350)])
+        self.assertEqual(prefetch.missing_intervals(100, 400, 100, 299), [(300, 400)])
+        self.assertEqual(prefetch.missing_intervals(0, 150, 100, 299), [(0, 99)])
+        self.assertEqual(prefetch.missing_intervals(120, 200, 100, 299), [])
+
+    def test_002b_clip_segments(self):
+        segments = [[0, 99, 1, 1000], [100, 199, 2, 500], [200, 299, 3, 300]]
+
+        self.assertEqual(prefetch.clip_segments(segments, 50, 249),
+                         [[50, 99, 1, 500], [100, 199, 2, 500], [200, 249, 3, 150]])
+        self.assertEqual(prefetch.clip_segments(segments, 100, 150), [[100, 150, 2, 255]])
+        self.assertEqual(prefetch.clip_segments(segments, 0, 299), segments)
+        self.assertEqual(prefetch.clip_segments(segments, 300, 400), [])
+
+        # segments are not changed
+        self.assertEqual(segments, [[0, 99, 1, 1000], [100, 199, 2, 500], [200, 299, 3, 300]])
+
+
+if __name__ == '__main__':
+    unittest.main()
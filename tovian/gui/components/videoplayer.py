@@ -106,7 +106,7 @@ class VideoPlayer(Phonon.MediaObject):
         frame_duration = 1000.0 / self.fps
         newTime = 0 if newTime < 0 else totalTime if newTime > totalTime else round(frame_duration * round(float(newTime)/frame_duration))
         frame = int(round(newTime * self.fps / 1000.0))
-        self.annotationBuffer.resetBuffer(frame)            # buffer new frames in advance
+        self.annotationBuffer.resetBuffer(frame)            # buffer thread buffers new frames in advance
 
         # seek video
         super(VideoPlayer, self).seek(int(newTime))
@@ -300,6 +300,8 @@ class MainApp(QMainWindow, mainform.Ui_MainWindow):
         self.buffer.buffering.connect(self.displayBufferingMsg)
         self.buffer.initialized.connect(self.bufferInitialized)
         self.buffer.buffered.connect(self.statusbar.clearMessage)
+        self.buffer.missingBuffered.connect(self.annotation.missingObjectsBuffered)
+        self.buffer.objectsRemoved.connect(self.annotation.expireRemovedObjects)
 
     def setupFilters(self):
         """
@@ -329,6 +331,8 @@ class MainApp(QMainWindow, mainform.Ui_MainWindow):
         mainUiEventFilter.volumeUpKeyPressed.connect(self.player.volumeUp)
         mainUiEventFilter.volumeDownKeyPressed.connect(self.player.volumeDown)
         mainUiEventFilter.muteKeyPressed.connect(self.player.mute)
+        mainUiEventFilter.nextKeyframeKeyPressed.connect(self.annotation.goToNextKeyframe)
+        mainUiEventFilter.prevKeyframeKeyPressed.connect(self.annotation.goToPrevKeyframe)
         # attributeTableFilter.enterPressed.connect(self.annotation.processChanges)
         perFrameSeekerFilter.LMouseRelease.connect(self.player.perFrameSliderLMouseReleased)
         perFrameSeekerFilter.LMousePress.connect(self.player.perFrameSliderLMousePressed)
@@ -704,6 +708,9 @@ class MainApp(QMainWindow, mainform.Ui_MainWindow):
         self.buffer_thread.quit()
         self.buffer_thread.wait(5000)
 
+        # hits, misses, evictions and memory usage of the buffer
+        models.repository.logs.insert('gui.buffer_stats', dict(self.buffer.stats), annotator_id=self.user.id)
+
         if not self.buffer_thread.isFinished():
             logger.error("Unable to close buffer thread normally")
             self.statusbar.showMessage(self.terminating_buffer_msg)
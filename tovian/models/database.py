@@ -14,6 +14,10 @@ import time
 import entity
 import warnings
 import threading
+import random
+import os
+import sys
+import contextlib
 
 import defaults
 
@@ -22,6 +26,214 @@ logger = logging.getLogger(__name__)
 logger.debug('Import ' + __name__)
 
 
+class StatementStatistics():
+    """
+    Statistics of executed SQL statements grouped by fingerprints (statements without literals and with collapsed
+    lists of parameters). Durations are kept as a random sample of at most max_samples values per fingerprint.
+    """
+
+    max_samples = 1000
+    max_fingerprints_cache = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.fingerprints = {} # statement -> fingerprint
+            self.statements = {} # fingerprint -> dict of statistics
+
+    @classmethod
+    def fingerprint(cls, statement):
+        """
+        :rtype: unicode
+        """
+
+        fingerprint = re.sub(r"'(?:[^']|'')*'", '?', statement)
+        fingerprint = re.sub(r'(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])', '?', fingerprint)
+        fingerprint = re.sub(r'\s+', ' ', fingerprint).strip()
+        fingerprint = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?, ...)', fingerprint)
+
+        return fingerprint
+
+    def add(self, statement, duration_ms, rowcount=None):
+        """
+        rowcount is None or negative, when it is not known (e.g. SELECT statements in SQLite).
+        Returns fingerprint of the statement.
+
+        :rtype: unicode
+        """
+
+        with self.lock:
+            fingerprint = self.fingerprints.get(statement)
+
+            if fingerprint is None:
+                if len(self.fingerprints) >= self.max_fingerprints_cache:
+                    self.fingerprints.clear()
+
+                fingerprint = self.fingerprints[statement] = self.fingerprint(statement)
+
+            stats = self.statements.get(fingerprint)
+
+            if stats is None:
+                stats = self.statements[fingerprint] = {'count': 0, 'total_ms': 0.0, 'rows': None, 'samples': []}
+
+            stats['count'] += 1
+            stats['total_ms'] += duration_ms
+
+            if rowcount is not None and rowcount >= 0:
+                stats['rows'] = (stats['rows'] or 0) + rowcount
+
+            if len(stats['samples']) < self.max_samples:
+                stats['samples'].append(duration_ms)
+            else:
+                # reservoir sampling, each duration has the same probability to be in the sample
+                i = random.randint(0, stats['count'] - 1)
+
+                if i < self.max_samples:
+                    stats['samples'][i] = duration_ms
+
+        return fingerprint
+
+    def snapshot(self, limit=None):
+        """
+        Returns statistics of statements sorted by total duration, the most expensive first.
+
+        :rtype: list of dict
+        """
+
+        with self.lock:
+            items = [(fingerprint, dict(stats, samples=sorted(stats['samples']))) for fingerprint, stats in self.statements.iteritems()]
+
+        items.sort(key=lambda item: item[1]['total_ms'], reverse=True)
+
+        result = []
+
+        for fingerprint, stats in items[:limit]:
+            samples = stats['samples']
+            percentile = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))]
+
+            result.append({
+                'fingerprint': fingerprint,
+                'count': stats['count'],
+                'rows': stats['rows'],
+                'total_ms': round(stats['total_ms'], 3),
+                'mean_ms': round(stats['total_ms'] / stats['count'], 3),
+                'p50_ms': round(percentile(0.50), 3),
+                'p95_ms': round(percentile(0.95), 3),
+                'p99_ms': round(percentile(0.99), 3),
+            })
+
+        return result
+
+
+class QueryInstrumentation():
+    """
+    Attributes executed statements to call sites (the first frame outside SQLAlchemy and this module) and to operations,
+    code blocks declared by Database.operation(). Two kinds of violations are logged and collected:
+    - n+1: the same statement fingerprint executed repeatedly from the same call site within one operation
+      (typically a lazy load of a relationship in a loop)
+    - budget: operation executed more statements than its declared budget
+
+    Operations are tracked per thread. When instrumentation is disabled, operations are not tracked at all.
+    """
+
+    n_plus_one_threshold = 3
+    max_violations = 1000
+
+    ignored_paths = (os.path.dirname(sqlalchemy.__file__), os.path.splitext(__file__)[0])
+
+    def __init__(self):
+        self.enabled = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.violations = []
+
+    def reset(self):
+        with self.lock:
+            self.violations = []
+
+    @contextlib.contextmanager
+    def operation(self, name, max_queries=None):
+        if not self.enabled:
+            yield
+            return
+
+        operations = self.operations()
+        operation = {'name': name, 'max_queries': max_queries, 'count': 0, 'sites': {}}
+
+        operations.append(operation)
+
+        try:
+            yield
+        finally:
+            operations.pop()
+
+            if max_queries is not None and operation['count'] > max_queries:
+                self.violation({'type': 'budget', 'operation': name, 'count': operation['count'], 'max_queries': max_queries,
+                                'sites': sorted(set(site for site, fingerprint in operation['sites']))})
+
+    def operations(self):
+        """
+        Stack of operations of the current thread
+
+        :rtype: list of dict
+        """
+
+        try:
+            return self.local.operations
+        except AttributeError:
+            self.local.operations = []
+            return self.local.operations
+
+    def add(self, fingerprint):
+        operations = self.operations()
+
+        if not operations:
+            return
+
+        key = (self.call_site(), fingerprint)
+
+        for operation in operations:
+            operation['count'] += 1
+            count = operation['sites'][key] = operation['sites'].get(key, 0) + 1
+
+        # repeated statements are reported only by the innermost operation
+        if count == self.n_plus_one_threshold:
+            self.violation({'type': 'n+1', 'operation': operation['name'], 'site': key[0], 'fingerprint': fingerprint})
+
+    def call_site(self):
+        """
+        :rtype: str
+        """
+
+        frame = sys._getframe(1)
+
+        while frame is not None and frame.f_code.co_filename.startswith(self.ignored_paths):
+            frame = frame.f_back
+
+        if frame is None:
+            return '?'
+
+        return '%s:%d (%s)' % (os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)
+
+    def violation(self, violation):
+        logger.warning('Query violation: %s' % (violation))
+
+        with self.lock:
+            if len(self.violations) < self.max_violations:
+                self.violations.append(violation)
+
+    def report(self):
+        """
+        :rtype: list of dict
+        """
+
+        with self.lock:
+            return list(self.violations)
+
+
 class Database():
     engine = None
     session = None
@@ -29,13 +241,32 @@ class Database():
     cursor_execute_locked_by_thread = None # to detect parallel calls
 
     profiler = {'sql_count': 0L, 'last_access': None, 'before_cursor_execute_time': 0}
+    statistics = StatementStatistics()
+    instrumentation = QueryInstrumentation()
+
+    # options of sqlalchemy.create_engine(), None means default of SQLAlchemy
+    engine_options = {'pool_size': None, 'max_overflow': None, 'pool_recycle': None, 'pool_pre_ping': False}
+
+    # applied to each new SQLite connection (None is not applied), foreign keys (ON DELETE CASCADE) are enforced only when
+    # enabled in configuration, see foreign_key_violations()
+    # journal mode is kept by default, WAL (with synchronous=NORMAL it does not wait for fsync on each commit) is enabled
+    # in configuration, it is stored in the database file and kept when the option is removed (DELETE switches it back)
+    sqlite_pragmas = {'foreign_keys': None, 'journal_mode': None, 'synchronous': 'NORMAL', 'cache_size': -16000,
+                      'mmap_size': 268435456, 'temp_store': 'MEMORY'}
+
+    # applied instead of sqlite_pragmas by bulk_load()
+    sqlite_pragmas_bulk_load = {'synchronous': 'OFF', 'cache_size': -262144}
+    bulk_load_active = False
+
+    # changes were flushed in the current transaction of the session, other connections (e.g. executor.DatabaseExecutor) do not see them
+    uncommitted_flush = False
 
     def open(self, database_url, echo=False):
         if self.opened_url == database_url:
             # do not open already opened connection to the same url
             return
 
-        self.engine = sqlalchemy.create_engine(database_url, echo=echo)
+        self.engine = self.create_engine(database_url, echo=echo)
 
         # register event handler
         event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
@@ -45,6 +276,35 @@ class Database():
 
         self.opened_url = database_url
 
+    def create_engine(self, database_url, echo=False):
+        """
+        Creates engine with options from configuration (see engine_options, sqlite_pragmas).
+        Engine has no event handlers of this object, it can be used by other threads (e.g. logwriter.LogWriter).
+
+        :rtype: sqlalchemy.engine.Engine
+        """
+
+        url = sqlalchemy.engine.url.make_url(database_url)
+        options = dict((k, v) for k, v in self.engine_options.iteritems() if v is not None)
+
+        if url.drivername.startswith('sqlite'):
+            # SQLite uses single connection pools, without sizes
+            options.pop('pool_size', None)
+            options.pop('max_overflow', None)
+
+        pool_pre_ping = options.pop('pool_pre_ping', False)
+
+        engine = sqlalchemy.create_engine(url, echo=echo, **options)
+
+        if pool_pre_ping:
+            event.listen(engine, "checkout", self._ping_connection)
+
+        if engine.dialect.name == 'sqlite':
+            # pragmas are not persistent (except journal_mode), they are set for each connection
+            event.listen(engine, "connect", self._sqlite_connect)
+
+        return engine
+
     def close(self):
         logger.debug("Closing database connection")
 
@@ -61,6 +321,11 @@ class Database():
 
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        self.uncommitted_flush = False
+
+        event.listen(self.session, "after_flush", self._session_after_flush)
+        event.listen(self.session, "after_commit", self._session_after_transaction)
+        event.listen(self.session, "after_rollback", self._session_after_transaction)
 
         logger.debug("Session was created")
 
@@ -71,10 +336,15 @@ class Database():
         logger.debug("Session was closed")
 
     def open_from_config(self, config, environment):
+        self.load_engine_config(config, environment)
+
         self.open(config.get(environment, 'database.url'), config.getboolean(environment, 'sqlalchemy.engine.echo'))
 
         self.opened_environment = environment
 
+        if config.has_option(environment, 'database.instrumentation'):
+            self.instrumentation.enabled = config.getboolean(environment, 'database.instrumentation')
+
         url = config.get(environment, 'database.url')
         url = re.sub("\:[^/](.*)\@", ":...@", url) # hide password
         logger.debug("Database was opened: %s (%s environment)" % (url, environment))
@@ -84,6 +354,63 @@ class Database():
             warnings.filterwarnings('ignore', '^Object of type .* not in session, add operation along .* will not proceed$', sqlalchemy.exc.SAWarning)
 
 
+    def operation(self, name, max_queries=None):
+        """
+        Context manager declaring an operation (code block) for query instrumentation, optionally with a budget
+        of executed statements, e.g.:
+
+            with db.operation('gui.process_objects', max_queries=0):
+                ...
+        """
+
+        return self.instrumentation.operation(name, max_queries)
+
+    def load_engine_config(self, config, environment):
+        """
+        Reads engine options (database.pool_*) and SQLite pragmas (sqlite.*) from configuration, missing options keep defaults.
+        """
+
+        for option, get in (('pool_size', config.getint), ('max_overflow', config.getint), ('pool_recycle', config.getint),
+                            ('pool_pre_ping', config.getboolean)):
+            if config.has_option(environment, 'database.' + option):
+                self.engine_options[option] = get(environment, 'database.' + option)
+
+        for key in self.sqlite_pragmas.keys():
+            if config.has_option(environment, 'sqlite.' + key):
+                self.sqlite_pragmas[key] = config.get(environment, 'sqlite.' + key)
+
+    @contextlib.contextmanager
+    def bulk_load(self, enabled=True):
+        """
+        Context manager switching SQLite connections to bulk load profile (sqlite_pragmas_bulk_load): no waiting for fsync
+        and bigger page cache. Data committed in the block can be lost by a power failure (not by a crash of the program).
+        Does nothing for other databases or when not enabled.
+        """
+
+        if not enabled or self.engine.dialect.name != 'sqlite' or self.bulk_load_active:
+            yield
+            return
+
+        # new connections are set up by _sqlite_connect(), connection of the session is set up here
+        self.bulk_load_active = True
+        self._sqlite_pragmas(self.session.connection().connection, self.sqlite_pragmas_bulk_load)
+
+        logger.debug("Bulk load profile enabled.")
+
+        try:
+            yield
+        finally:
+            self.bulk_load_active = False
+
+            # the original exception is not hidden, when the connection cannot be used
+            try:
+                self._sqlite_pragmas(self.session.connection().connection,
+                                     dict((key, self.sqlite_pragmas[key]) for key in self.sqlite_pragmas_bulk_load))
+            except Exception:
+                logger.exception("Cannot restore pragmas of the session's connection after bulk load")
+
+            logger.debug("Bulk load profile disabled.")
+
     def recreate_tables(self):
         """
         Drops all tables, creates them again.
@@ -98,6 +425,59 @@ class Database():
 
         logger.debug("Tables were recreated.")
 
+    def upgrade_tables(self):
+        """
+        Creates missing tables, columns and indexes in existing database. Existing data are kept.
+        """
+        import entity
+
+        inspector = sqlalchemy.inspect(self.engine)
+        table_names = inspector.get_table_names()
+
+        for table in entity.Base.metadata.sorted_tables:
+            if table.name not in table_names:
+                table.create(bind=self.engine)
+                logger.info("Table %s was created." % (table.name))
+                continue
+
+            column_names = [c['name'] for c in inspector.get_columns(table.name)]
+
+            for column in table.columns:
+                if column.name not in column_names:
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    self.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column_type))
+                    logger.info("Column %s.%s was added." % (table.name, column.name))
+
+            index_names = [i['name'] for i in inspector.get_indexes(table.name)]
+
+            for index in table.indexes:
+                if index.name not in index_names:
+                    index.create(bind=self.engine)
+                    logger.info("Index %s was created." % (index.name))
+
+        logger.debug("Tables were upgraded.")
+
+    def foreign_key_violations(self):
+        """
+        Returns rows referencing missing rows, e.g. annotation values of objects deleted while SQLite did not enforce
+        foreign keys. Always empty for other databases than SQLite.
+
+        :rtype: list of (unicode, int, unicode) - table name, row ID, referenced table name
+        """
+
+        if self.engine.dialect.name != 'sqlite':
+            return []
+
+        # no result columns are returned when there are no violations, DBAPI cursor handles it
+        cursor = self.session.connection().connection.cursor()
+
+        try:
+            cursor.execute('PRAGMA foreign_key_check')
+
+            return [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
     def insert_default_data(self):
         """
         Insert default data into empty database
@@ -118,6 +498,40 @@ class Database():
         logger.debug("Default data inserted to database.")
 
 
+    def _sqlite_connect(self, dbapi_connection, connection_record):
+        pragmas = dict(self.sqlite_pragmas)
+
+        if self.bulk_load_active:
+            pragmas.update(self.sqlite_pragmas_bulk_load)
+
+        self._sqlite_pragmas(dbapi_connection, pragmas)
+
+    def _sqlite_pragmas(self, dbapi_connection, pragmas):
+        cursor = dbapi_connection.cursor()
+
+        for key, value in sorted(pragmas.iteritems()):
+            if value is not None and value != '':
+                cursor.execute('PRAGMA %s=%s' % (key, value))
+
+        cursor.close()
+
+    def _session_after_flush(self, session, flush_context):
+        self.uncommitted_flush = True
+
+    def _session_after_transaction(self, session):
+        self.uncommitted_flush = False
+
+    def _ping_connection(self, dbapi_connection, connection_record, connection_proxy):
+        # pessimistic disconnect handling, pool replaces connection closed by the server (e.g. MySQL wait_timeout)
+        cursor = dbapi_connection.cursor()
+
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            raise sqlalchemy.exc.DisconnectionError()
+        finally:
+            cursor.close()
+
     def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
         current_thread_name = threading.current_thread().name
 
@@ -139,6 +553,11 @@ class Database():
 
         #logger.debug('SQL execution duration: %4.2f ms' % (duration_ms))
 
+        fingerprint = self.statistics.add(statement, duration_ms, cursor.rowcount)
+
+        if self.instrumentation.enabled:
+            self.instrumentation.add(fingerprint)
+
         if duration_ms > 300:
             logger.warning('Slow SQL (%4.2f ms): %s %s' % (duration_ms, statement, parameters))
 
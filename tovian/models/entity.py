@@ -4,17 +4,24 @@
     Entity classes
 """
 
+import sys
 import logging
+from array import array
+from bisect import bisect_left, bisect_right, insort
 from collections import defaultdict
+from itertools import islice
+from operator import itemgetter
 
 import sqlalchemy
 from sqlalchemy import ForeignKey
-from sqlalchemy import Table
-from sqlalchemy import Column, Integer, Boolean, Float, TIMESTAMP, Unicode, UnicodeText
+from sqlalchemy import Table, Index
+from sqlalchemy import event
+from sqlalchemy import Column, Integer, Boolean, Float, TIMESTAMP, Unicode, UnicodeText, LargeBinary
+from sqlalchemy.dialects.mysql import LONGBLOB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref, synonym, subqueryload
 from sqlalchemy.sql import func
-from sqlalchemy.sql.expression import desc
+from sqlalchemy.sql.expression import desc, or_
 
 import security
 import database
@@ -41,10 +48,479 @@ default_options = {
             'annotation_object_nonvisual_focus': 'lime',
             'annotation_object_nonvisual_focus_not_interpolated': 'darkGreen',
             'annotation_object_nonvisual_edit': 'red'
-        }
+        },
+        # keyframes of selected object reproduced by interpolation within tolerance (in pixels) are removed on save,
+        # None disables it (see AnnotationObject.simplify_keyframes())
+        'simplify_tolerance': None
     }
 }
 
+# incremented whenever span of any annotation object is changed or annotation object is deleted, when transaction
+# of the main session ends (changes committed by other annotators become visible) and when the buffer is reset
+# (see invalidate_timeline_indexes()), invalidates timeline indexes of videos (see Video.timeline_index())
+timeline_version = 0
+
+# spans were changed in the current transaction of the main session, rollback reverts them without attribute events
+_timeline_changed = False
+
+# distinct values of annotation attributes by annotation attribute ID, see AnnotationAttribute.value_dictionary()
+value_dictionaries = {}
+
+# changes of value dictionaries (annotation attribute ID, value, count) and IDs of dictionaries loaded in current transaction
+# of the main session (database.db.session), reverted on rollback, other sessions (e.g. executor.DatabaseExecutor) are ignored
+_value_dictionaries_changes = []
+_value_dictionaries_loaded = set()
+
+
+def resolve_options(entity, cache_key, merge, inherited=()):
+    """
+    Returns options of the entity resolved by merge(), as a read-only dict.
+    Result is cached on the entity under cache_key, until "options" of the entity or of entities it inherits options
+    from (inherited, None is ignored) are changed, expired or refreshed (see _increment_options_version()).
+    """
+
+    entities = (entity,) + tuple(inherited)
+    version = tuple(e._options_version if e is not None else None for e in entities)
+
+    if entity._options_cache is None:
+        entity._options_cache = {}
+
+    cached = entity._options_cache.get(cache_key)
+
+    if cached is None or cached[0] != version:
+        options = util.dict_freeze(merge())
+
+        # options loaded by merge() are refreshed
+        version = tuple(e._options_version if e is not None else None for e in entities)
+        cached = entity._options_cache[cache_key] = (version, options)
+
+    return cached[1]
+
+def select_option(options, key):
+    """
+    Returns nested option from options, by key: list of keys or dotted string
+    """
+
+    if isinstance(key, basestring):
+        key = key.split('.')
+
+    for k in key:
+        options = options[k]
+
+    return options
+
+def value_options(current_annotator, annotation_attribute, annotation_object, use_defaults):
+    """
+    Returns options inherited by annotation values (see AnnotationValue.get_option()), without own options of the value.
+    """
+
+    if use_defaults:
+        options = default_options
+    else:
+        options = {}
+
+    if current_annotator is not None:
+        options = util.dict_merge(options, current_annotator.get_option(use_defaults=False))
+    if annotation_attribute is not None:
+        options = util.dict_merge(options, annotation_attribute.get_option(use_defaults=False))
+    if annotation_object is not None:
+        options = util.dict_merge(options, annotation_object.get_option(use_defaults=False))
+
+    return options
+
+def value_text(annotation_attribute, _value):
+    """
+    Returns text representation of an encoded annotation value, suitable for the user (see AnnotationValue.get_text()).
+    """
+
+    if annotation_attribute is None:
+        return None
+
+    # no text for positional attributes
+    if annotation_attribute.name.startswith('position_'):
+        return None
+
+    data_type = annotation_attribute.data_type
+
+    if data_type == u'bool':
+        text = annotation_attribute.name if _value else None
+    elif data_type in [u'int', u'float']:
+        text = annotation_attribute.name + '=' + unicode(_value)
+    elif data_type == u'unicode':
+        text = _value
+    else:
+        text = None
+
+    return text
+
+def instance_memory_usage(instance):
+    """
+    Approximate memory footprint of a mapped instance in bytes: the instance, its attributes dictionary with scalar values
+    (strings, numbers, tuples) and its SQLAlchemy instance state. Related instances and collections are not included.
+
+    :rtype: int
+    """
+
+    state = sqlalchemy.inspect(instance)
+    size = sys.getsizeof(instance) + sys.getsizeof(instance.__dict__) + sys.getsizeof(state) + sys.getsizeof(state.committed_state)
+
+    for value in instance.__dict__.itervalues():
+        if isinstance(value, (basestring, int, long, float, tuple)):
+            size += sys.getsizeof(value)
+
+    return size
+
+def _annotation_object_id(row):
+    # rows of SpanIndex by default, (AnnotationObject, first frame, last frame)
+    return row[0].id
+
+
+class TimelineIndex(object):
+    """
+    In-memory index of annotation objects of one video, sorted by (first frame, ID) and by (last frame, ID).
+    Next and previous objects are found by binary search, without database queries. Objects in the current frame
+    are found by SpanIndex. Only IDs and spans are kept, not the objects.
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: IDs of annotation objects with first and last frame
+        :type rows: list of (int, int, int)
+        """
+
+        # objects without local values are not in the timeline
+        rows = [tuple(row) for row in rows if row[1] is not None]
+
+        self.rows = dict((row[0], row) for row in rows)
+        self.starts = sorted((first_frame, annotation_object_id) for annotation_object_id, first_frame, last_frame in rows)
+        self.ends = sorted((last_frame, annotation_object_id) for annotation_object_id, first_frame, last_frame in rows)
+
+        self.spans = SpanIndex(row_id=itemgetter(0))
+        self.spans.add(rows)
+
+    def next(self, current_frame, current_id=None):
+        """
+        See Video.annotation_object_next()
+
+        :rtype: (int, int, int)
+        """
+
+        # first object starting in the future
+        i = bisect_right(self.starts, (current_frame, sys.maxint))
+
+        if current_id is not None:
+            # objects in the current frame with higher ID are before all objects in the future
+            rows = [row for row in self.spans.in_frame(current_frame) if row[0] > current_id]
+
+            if len(rows):
+                return min(rows, key=lambda row: (row[1], row[0]))
+
+        if i < len(self.starts):
+            return self.rows[self.starts[i][1]]
+
+        return None
+
+    def previous(self, current_frame, current_id=None):
+        """
+        See Video.annotation_object_previous()
+
+        :rtype: (int, int, int)
+        """
+
+        # first object ending in the current frame or in the future
+        i = bisect_left(self.ends, (current_frame, -sys.maxint - 1))
+
+        if current_id is not None:
+            # objects in the current frame with lower ID are before all objects in the past
+            rows = [row for row in self.spans.in_frame(current_frame) if row[0] < current_id]
+
+            if len(rows):
+                return max(rows, key=lambda row: (row[2], row[0]))
+
+        if i > 0:
+            return self.rows[self.ends[i - 1][1]]
+
+        return None
+
+
+class Span(object):
+    """
+    Record of SpanIndex, annotation object (with first and last frame) and its span used by the index.
+    """
+
+    __slots__ = ('start', 'end', 'row', 'size')
+
+    def __init__(self, start, end, row, size=0):
+        self.start = start
+        self.end = end
+        self.row = row
+        self.size = size
+
+
+class SpanIndex(object):
+    """
+    In-memory index of annotation objects by their spans, one record per object (regardless of its length).
+    Objects in a frame or in a frame interval are found by a centered interval tree in O(log n + k).
+    The tree is built again on the first query after objects were added or removed.
+
+    Tree node is a tuple (center, left node, right node, spans containing center sorted by start,
+    the same spans sorted by end descending).
+
+    With memory_usage function (row => bytes) given, approximate memory footprint of indexed objects is kept in size.
+    With row_id function (row => ID) given, rows do not have to contain annotation objects (e.g. only IDs, see TimelineIndex).
+    """
+
+    def __init__(self, memory_usage=None, row_id=None):
+        self.spans = {}
+        self.tree = None
+        self.dirty = False
+
+        self.memory_usage = memory_usage
+        self.size = 0
+
+        self.row_id = row_id if row_id is not None else _annotation_object_id
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __contains__(self, annotation_object_id):
+        return annotation_object_id in self.spans
+
+    def add(self, rows):
+        """
+        Adds objects, objects with the same ID are replaced.
+
+        :type rows: list of (AnnotationObject, int, int)
+        """
+
+        for row in rows:
+            self.remove(self.row_id(row))
+
+            span = self.spans[self.row_id(row)] = Span(row[1], row[2], row, self.memory_usage(row) if self.memory_usage else 0)
+            self.size += span.size
+
+        self.dirty = True
+
+    def remove(self, annotation_object_id):
+        """
+        :rtype: bool
+        """
+
+        span = self.spans.pop(annotation_object_id, None)
+
+        if span is None:
+            return False
+
+        self.size -= span.size
+        self.dirty = True
+
+        return True
+
+    def remove_outside(self, frame_from, frame_to):
+        """
+        Removes objects, which do not overlap interval <frame_from, frame_to>.
+
+        :rtype: list of (AnnotationObject, int, int)
+        """
+
+        removed = [span.row for span in self.spans.itervalues() if span.end < frame_from or span.start > frame_to]
+
+        for row in removed:
+            self.remove(self.row_id(row))
+
+        return removed
+
+    def copy(self):
+        """
+        Returns an independent index with the same objects. Records and the tree are immutable, so they are shared;
+        the copy can be changed and rebuilt (e.g. by another thread) while this index is queried.
+
+        :rtype: SpanIndex
+        """
+
+        index = SpanIndex(memory_usage=self.memory_usage, row_id=self.row_id)
+        index.spans = dict(self.spans)
+        index.tree = self.tree
+        index.dirty = self.dirty
+        index.size = self.size
+
+        return index
+
+    def clear(self):
+        self.spans = {}
+        self.tree = None
+        self.dirty = False
+        self.size = 0
+
+    def update(self):
+        """
+        Builds the tree after objects were added or removed (otherwise it is done by the next query).
+        """
+
+        if self.dirty:
+            self.tree = self.build(self.spans.values())
+            self.dirty = False
+
+    def in_frame(self, frame):
+        """
+        :rtype: list of (AnnotationObject, int, int)
+        """
+
+        return self.in_interval(frame, frame)
+
+    def in_interval(self, frame_from, frame_to):
+        """
+        Returns objects overlapping interval <frame_from, frame_to>, sorted by first frame, last frame and ID.
+
+        :rtype: list of (AnnotationObject, int, int)
+        """
+
+        self.update()
+
+        spans = []
+        nodes = [self.tree]
+
+        while nodes:
+            node = nodes.pop()
+
+            if node is None:
+                continue
+
+            center, left, right, by_start, by_end = node
+
+            if frame_to < center:
+                # spans of the node end after the interval, only their starts matter
+                for span in by_start:
+                    if span.start > frame_to:
+                        break
+                    spans.append(span)
+
+                nodes.append(left)
+            elif frame_from > center:
+                # spans of the node start before the interval, only their ends matter
+                for span in by_end:
+                    if span.end < frame_from:
+                        break
+                    spans.append(span)
+
+                nodes.append(right)
+            else:
+                spans.extend(by_start)
+                nodes.append(left)
+                nodes.append(right)
+
+        spans.sort(key=lambda span: (span.start, span.end, self.row_id(span.row)))
+
+        return [span.row for span in spans]
+
+    @classmethod
+    def build(cls, spans):
+        if not spans:
+            return None
+
+        endpoints = sorted([span.start for span in spans] + [span.end for span in spans])
+        center = endpoints[len(endpoints) / 2]
+
+        # center is an endpoint of some span, so at least one span is stored in the node
+        left = [span for span in spans if span.end < center]
+        right = [span for span in spans if span.start > center]
+        here = [span for span in spans if span.start <= center <= span.end]
+
+        return (center, cls.build(left), cls.build(right),
+                sorted(here, key=lambda span: span.start), sorted(here, key=lambda span: span.end, reverse=True))
+
+
+class ValueDictionary(object):
+    """
+    In-memory dictionary of distinct values of one annotation attribute, with numbers of occurrences.
+    Values are kept sorted case-insensitively (values with given prefix are found by binary search)
+    and by rank (the most frequent values first, matches are searched in this order until enough is found).
+    """
+
+    def __init__(self, counts):
+        """
+        :param counts: encoded values (AnnotationValue._value) with numbers of occurrences
+        :type counts: list of (unicode, int)
+        """
+
+        self.counts = dict((value, count) for value, count in counts if value is not None)
+        self.keys = sorted((value.lower(), value) for value in self.counts)
+        self.ranked = sorted((-count, value, value.lower()) for value, count in self.counts.iteritems())
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, value, count=1):
+        if value is None:
+            return
+
+        if value in self.counts:
+            self._remove_ranked(value)
+            self.counts[value] += count
+        else:
+            self.counts[value] = count
+            insort(self.keys, (value.lower(), value))
+
+        insort(self.ranked, (-self.counts[value], value, value.lower()))
+
+    def remove(self, value, count=1):
+        if value not in self.counts:
+            return
+
+        self._remove_ranked(value)
+        self.counts[value] -= count
+
+        if self.counts[value] > 0:
+            insort(self.ranked, (-self.counts[value], value, value.lower()))
+        else:
+            del self.counts[value]
+            del self.keys[bisect_left(self.keys, (value.lower(), value))]
+
+    def _remove_ranked(self, value):
+        del self.ranked[bisect_left(self.ranked, (-self.counts[value], value, value.lower()))]
+
+    def lookup(self, text=None, limit=None):
+        """
+        Returns values containing text (case-insensitive). Values starting with text are returned first, both groups
+        are ranked by number of occurrences and alphabetically. Other values are searched only when there is less than
+        limit values starting with text.
+
+        :rtype: list of unicode
+        """
+
+        if not text:
+            return [value for count, value, key in self.ranked[:limit]]
+
+        text = text.lower()
+
+        # range of keys starting with text
+        i = bisect_left(self.keys, (text,))
+        j = bisect_left(self.keys, (text + u'\uffff',))
+
+        if limit is None or j - i <= limit:
+            result = [value for count, value in sorted((-self.counts[value], value) for key, value in self.keys[i:j])]
+        else:
+            # many values with the prefix, the best ranked are found soon
+            result = list(islice((value for count, value, key in self.ranked if key.startswith(text)), limit))
+
+        if limit is None or len(result) < limit:
+            others = (value for count, value, key in self.ranked if text in key and not key.startswith(text))
+            result.extend(islice(others, limit - len(result) if limit is not None else None))
+
+        return result
+
+
+def reset_value_dictionaries():
+    """
+    Drops all value dictionaries, they are loaded again when needed. Called after changes of annotation values
+    done without the ORM (see importer).
+    """
+
+    value_dictionaries.clear()
+    _value_dictionaries_loaded.clear()
+    del _value_dictionaries_changes[:]
+
+
 class Annotator(Base):
     """
     Annotators.
@@ -69,6 +545,10 @@ class Annotator(Base):
 
     logger.debug('Initialized Annotator')
 
+    # see resolve_options()
+    _options_cache = None
+    _options_version = 0
+
     @property
     def password(self):
         raise Exception("Cannot get password")
@@ -116,23 +596,18 @@ class Annotator(Base):
             return None
 
     def get_option(self, key=[], use_defaults=True):
-        try:
-            entity_options = json.loads(self.options)
-        except:
-            entity_options = {}
-
-        if use_defaults:
-            options = util.dict_merge(default_options, entity_options)
-        else:
-            options = entity_options
-
-        if isinstance(key, basestring):
-            key = key.split('.')
-
-        for k in key:
-            options = options[k]
+        def merge():
+            try:
+                entity_options = json.loads(self.options)
+            except:
+                entity_options = {}
+
+            if use_defaults:
+                return util.dict_merge(default_options, entity_options)
+            else:
+                return entity_options
 
-        return options
+        return select_option(resolve_options(self, use_defaults, merge), key)
 
 
 table_bind_video_to_annotator = Table('bind_video_to_annotator', Base.metadata,
@@ -173,41 +648,43 @@ class Video(Base):
 
     logger.debug('Initialized Video')
 
+    # cache of timeline_index(), see timeline_version
+    _timeline_cache = None
+
+    # see resolve_options()
+    _options_cache = None
+    _options_version = 0
+
     def __repr__(self):
         return "<Video#%s(%s,%s,%s,%s)>" % (str(self.id), unicode(self.name).encode('utf8'), unicode(self.filename).encode('utf8'), 'enabled' if self.is_enabled else 'disabled', 'finished' if self.is_finished else 'not finished')
 
     def get_option(self, key=[], use_defaults=True):
-        try:
-            entity_options = json.loads(self.options)
-        except:
-            entity_options = {}
-
-        if use_defaults:
-            options = util.dict_merge(default_options, entity_options)
-        else:
-            options = entity_options
-
-        if isinstance(key, basestring):
-            key = key.split('.')
-
-        for k in key:
-            options = options[k]
+        def merge():
+            try:
+                entity_options = json.loads(self.options)
+            except:
+                entity_options = {}
+
+            if use_defaults:
+                return util.dict_merge(default_options, entity_options)
+            else:
+                return entity_options
 
-        return options
+        return select_option(resolve_options(self, use_defaults, merge), key)
 
     def annotation_objects_all(self):
         """
         Returns all annotation objects related to this video, with object's first and last frame.
         Annotation objects are sorted by the time of theirs first occurrence in the video.
+        Objects with global annotation values only are included too, their first and last frame is None.
 
         :rtype: list of (AnnotationObject, int, int)
         """
 
-        q = database.db.session.query(AnnotationObject, func.min(AnnotationValue.frame_from), func.max(AnnotationValue.frame_from))
+        q = database.db.session.query(AnnotationObject, AnnotationObject.first_frame, AnnotationObject.last_frame)
         q = q.filter_by(video_id=self.id)
-        q = q.join(AnnotationObject.annotation_values)
-        q = q.group_by(AnnotationObject.id)
-        q = q.order_by(func.min(AnnotationValue.frame_from), func.max(AnnotationValue.frame_from), AnnotationObject.id)
+        q = q.filter((AnnotationObject.first_frame != None) | AnnotationObject.annotation_values.any())
+        q = q.order_by(AnnotationObject.first_frame, AnnotationObject.last_frame, AnnotationObject.id)
 
         return q.all()
 
@@ -217,34 +694,31 @@ class Video(Base):
         AnnotationValues are lazily-loaded, in comparison to annotation_objects_in_frame_intervals()
 
         SQL:
-            SELECT annotation_objects....., min(annotation_values.frame_from) AS min_1, max(annotation_values.frame_from) AS max_1
+            SELECT annotation_objects....., annotation_objects.first_frame, annotation_objects.last_frame
             FROM annotation_objects
-            INNER JOIN annotation_values ON annotation_objects.id = annotation_values.annotation_object_id
-            WHERE annotation_objects.video_id = %s
-            GROUP BY annotation_objects.id
-            HAVING min(annotation_values.frame_from) <= %s AND max(annotation_values.frame_from) >= %s
-            ORDER BY min(annotation_values.frame_from), max(annotation_values.frame_from), annotation_objects.id
+            WHERE annotation_objects.video_id = %s AND annotation_objects.first_frame <= %s AND annotation_objects.last_frame >= %s
+            ORDER BY annotation_objects.first_frame, annotation_objects.last_frame, annotation_objects.id
 
         :rtype: list of (AnnotationObject, int, int)
         """
 
-        q = database.db.session.query(AnnotationObject, func.min(AnnotationValue.frame_from), func.max(AnnotationValue.frame_from))
+        q = database.db.session.query(AnnotationObject, AnnotationObject.first_frame, AnnotationObject.last_frame)
         q = q.filter_by(video_id=self.id)
-        q = q.join(AnnotationObject.annotation_values)
-        q = q.group_by(AnnotationObject.id)
-        q = q.having((func.min(AnnotationValue.frame_from) <= frame) & (func.max(AnnotationValue.frame_from) >= frame))
-        q = q.order_by(func.min(AnnotationValue.frame_from), func.max(AnnotationValue.frame_from), AnnotationObject.id)
+        q = q.filter((AnnotationObject.first_frame <= frame) & (AnnotationObject.last_frame >= frame))
+        q = q.order_by(AnnotationObject.first_frame, AnnotationObject.last_frame, AnnotationObject.id)
         q = q.all()
 
         return q
 
-    def annotation_objects_in_frame_intervals(self, intervals, filter_object_ids=None):
+    def annotation_objects_in_frame_intervals(self, intervals, filter_object_ids=None, session=None):
         """
         Returns annotation objects related to this video that are visible in given time intervals <from, to>
         Related AnnotationValues collections are eagerly loaded from database (not lazily which is the default).
 
         Optionally with filter_object_ids, only AnnotationObjects with given IDs are returned.
 
+        Objects are loaded by given session (e.g. session of executor.DatabaseExecutor), database.db.session by default.
+
         :param filter_object_ids: list of AnnotationObject ids
         :type filter_object_ids: list of int
         :param intervals: list of tuples each representing one time interval (frame_from, frame_to)
@@ -255,30 +729,47 @@ class Video(Base):
         if not len(intervals):
             return []
 
-        q = database.db.session.query(AnnotationObject, func.min(AnnotationValue.frame_from), func.max(AnnotationValue.frame_from))
+        if session is None:
+            session = database.db.session
+
+        q = session.query(AnnotationObject, AnnotationObject.first_frame, AnnotationObject.last_frame)
         q = q.filter_by(video_id=self.id)
-        q = q.join(AnnotationObject.annotation_values)
 
         if filter_object_ids is not None:
             q = q.filter(AnnotationObject.id.in_(filter_object_ids))
 
         q = q.options(subqueryload(AnnotationObject.annotation_values)) # eagerly load "annotation_values" relation
-        q = q.group_by(AnnotationObject.id)
-
-        having = None
+        q = q.options(subqueryload(AnnotationObject.annotation_tracks))
 
-        # construct having condition
-        for frame_from, frame_to in intervals:
-            h = (func.min(AnnotationValue.frame_from) <= frame_to) & (func.max(AnnotationValue.frame_from) >= frame_from)
-            having = h if having is None else having | h
+        # construct condition, object's span must overlap at least one interval
+        q = q.filter(or_(*[(AnnotationObject.first_frame <= frame_to) & (AnnotationObject.last_frame >= frame_from)
+                           for frame_from, frame_to in intervals]))
 
-        q = q.having(having)
-
-        q = q.order_by(func.min(AnnotationValue.frame_from), func.max(AnnotationValue.frame_from), AnnotationObject.id)
+        q = q.order_by(AnnotationObject.first_frame, AnnotationObject.last_frame, AnnotationObject.id)
         q = q.all()
 
         return q
 
+    def timeline_index(self):
+        """
+        Returns in-memory index of annotation objects of this video (IDs and spans). It is loaded once and kept until
+        it is invalidated (see timeline_version).
+
+        :rtype: TimelineIndex
+        """
+
+        # as with autoflush of a query, pending changes are flushed (spans are updated), nothing is done when there are none
+        database.db.session.flush()
+
+        if self._timeline_cache is None or self._timeline_cache[0] != timeline_version:
+            q = database.db.session.query(AnnotationObject.id, AnnotationObject.first_frame, AnnotationObject.last_frame)
+            q = q.filter_by(video_id=self.id)
+            q = q.filter(AnnotationObject.first_frame != None)
+
+            self._timeline_cache = (timeline_version, TimelineIndex(q.all()))
+
+        return self._timeline_cache[1]
+
     def annotation_object_next(self, current_frame, current_annotation_object=None, to_future=True):
         """
         When current_annotation_object is None, nearest AnnotationObject in the future (in respect to current_frame) is returned.
@@ -288,50 +779,27 @@ class Video(Base):
         If to_future is false, the search is done in the past instead of the future.
 
         Returned tuple contains the next object and its starting and ending frame.
+        Objects are found in timeline_index(), only the found object is loaded by its ID (without a query,
+        when it is in the session already).
 
         :rtype: (AnnotationObject, int, int)
         """
 
-        q = database.db.session.query(AnnotationObject, func.min(AnnotationValue.frame_from), func.max(AnnotationValue.frame_from))
-        q = q.filter_by(video_id=self.id)
-        q = q.join(AnnotationObject.annotation_values)
-        q = q.group_by(AnnotationObject.id)
+        timeline_index = self.timeline_index()
+
+        current_id = current_annotation_object.id if current_annotation_object is not None else None
 
         if to_future:
-            if current_annotation_object is None:
-                # nearest AnnotationObject in future
-                q = q.having(func.min(AnnotationValue.frame_from) > current_frame)
-                q = q.order_by(func.min(AnnotationValue.frame_from), AnnotationObject.id)
-            else:
-                # nearest AnnotationObject in future, or in the same frame with bigger ID
-                current_id = current_annotation_object.id
-                q = q.having( (func.min(AnnotationValue.frame_from) > current_frame) |
-                              ((AnnotationObject.id > current_id) & (func.min(AnnotationValue.frame_from) <= current_frame) & (func.max(AnnotationValue.frame_from) >= current_frame))
-                            )
-                q = q.order_by(func.min(AnnotationValue.frame_from), AnnotationObject.id)
+            row = timeline_index.next(current_frame, current_id)
         else:
-            if current_annotation_object is None:
-                # nearest AnnotationObject in past
-                q = q.having(func.max(AnnotationValue.frame_from) < current_frame)
-                q = q.order_by(desc(func.max(AnnotationValue.frame_from)), desc(AnnotationObject.id))
-            else:
-                # nearest AnnotationObject in past, or in the same frame with lower ID
-                current_id = current_annotation_object.id
-                q = q.having( (func.max(AnnotationValue.frame_from) < current_frame) |
-                              ((AnnotationObject.id < current_id) & (func.min(AnnotationValue.frame_from) <= current_frame) & (func.max(AnnotationValue.frame_from) >= current_frame))
-                            )
-                q = q.order_by(desc(func.max(AnnotationValue.frame_from)), desc(AnnotationObject.id))
-
-        q = q.limit(1)
-        q = q.all()
+            row = timeline_index.previous(current_frame, current_id)
 
-        if len(q) < 1:
+        if row is None:
             return None
 
-        if len(q) > 1:
-            raise Exception('Returned collection cannot contain more than 1 item.')
+        annotation_object_id, first_frame, last_frame = row
 
-        return q[0]
+        return database.db.session.query(AnnotationObject).get(annotation_object_id), first_frame, last_frame
 
     def annotation_object_previous(self, current_frame, current_annotation_object=None):
         """
@@ -425,6 +893,13 @@ class Video(Base):
                     entities.append(annotation_value)
 
             if fast_database_inserts:
+                # values are not inserted through the session, object's span has to be set here
+                frames = [av['frame_from'] for av in annotation_values if av['frame_from'] is not None]
+
+                if len(frames):
+                    annotation_object.first_frame = min(frames)
+                    annotation_object.last_frame = max(frames)
+
                 database.db.session.execute(
                     AnnotationValue.__table__.insert(),
                     annotation_values
@@ -467,6 +942,10 @@ class AnnotationAttribute(Base):
 
     logger.debug('Initialized AnnotationAttribute')
 
+    # see resolve_options()
+    _options_cache = None
+    _options_version = 0
+
     @property
     def allowed_values(self):
         if self._allowed_values is None:
@@ -488,42 +967,42 @@ class AnnotationAttribute(Base):
         return "<AnnotationAttribute#%s(%s,%s)>" % (str(self.id), unicode(self.name).encode('utf8'), 'global' if self.is_global else 'local')
 
     def get_option(self, key=[], use_defaults=True):
-        try:
-            entity_options = json.loads(self.options)
-        except:
-            entity_options = {}
-
-        if use_defaults:
-            options = util.dict_merge(default_options, entity_options)
-        else:
-            options = entity_options
-
-        if isinstance(key, basestring):
-            key = key.split('.')
-
-        for k in key:
-            options = options[k]
+        def merge():
+            try:
+                entity_options = json.loads(self.options)
+            except:
+                entity_options = {}
+
+            if use_defaults:
+                return util.dict_merge(default_options, entity_options)
+            else:
+                return entity_options
 
-        return options
+        return select_option(resolve_options(self, use_defaults, merge), key)
 
-    def autocomplete_values(self, text=None):
-        value_like = None
+    def value_dictionary(self):
+        """
+        Returns distinct values of this attribute with numbers of occurrences. The dictionary is loaded by one query
+        and then updated with annotation values inserted, changed and deleted by the session (see value_dictionaries).
 
-        if text is not None:
-            value_like = '%'+text+'%'
+        :rtype: ValueDictionary
+        """
 
-        avs = repository.annotation_values.search(annotation_attribute_id=self.id, value_like=value_like, limit=700, group_by_value=True)
+        if self.id not in value_dictionaries:
+            value_dictionaries[self.id] = ValueDictionary(repository.annotation_values.count_distinct(self.id))
+            _value_dictionaries_loaded.add(self.id)
 
-        result = []
+        return value_dictionaries[self.id]
 
-        if len(avs) >= 700:
-            # too many values, return nothing
-            return result
+    def autocomplete_values(self, text=None, limit=700):
+        """
+        Returns at most limit distinct values of this attribute containing text, ranked by ValueDictionary.lookup().
 
-        for av in avs:
-            result.append(unicode(av.value))
+        :rtype: list of unicode
+        """
 
-        return result
+        return [unicode(AnnotationValue.decode_value(value, self.data_type))
+                for value in self.value_dictionary().lookup(text, limit)]
 
 class AnnotationObject(Base):
     """
@@ -542,6 +1021,10 @@ class AnnotationObject(Base):
     created_at = Column(TIMESTAMP, server_default=func.current_timestamp())
     modified_at = Column(TIMESTAMP, onupdate=func.current_timestamp())
 
+    # denormalized span of local annotation values (min and max frame_from), maintained by update_span()
+    first_frame = Column(Integer)
+    last_frame = Column(Integer)
+
     created_by_id = Column(Integer, ForeignKey('annotators.id'))
     created_by = relationship('Annotator', backref='annotation_objects_created', foreign_keys=[created_by_id])
 
@@ -553,10 +1036,23 @@ class AnnotationObject(Base):
 
     type = synonym('_type') #, descriptor=type)
 
+    __table_args__ = (
+        Index('ix_annotation_objects_video_id_first_frame', 'video_id', 'first_frame'),
+        Index('ix_annotation_objects_video_id_last_frame', 'video_id', 'last_frame'),
+    )
+
     allowed_annotation_types = ['rectangle', 'circle', 'point', 'nonvisual']
 
+    # cache of annotation_values_local_sorted() and keyframes(), see reset_keyframes_cache()
+    _keyframes_cache = None
+    _keyframe_frames_cache = None
+
     logger.debug('Initialized AnnotationObject')
 
+    # see resolve_options()
+    _options_cache = None
+    _options_version = 0
+
     @property
     def type(self):
         return self._type
@@ -598,28 +1094,25 @@ class AnnotationObject(Base):
         return u", ".join(text['global']), u", ".join(text['local'])
 
     def get_option(self, key=[], use_defaults=True):
-        if use_defaults:
-            options = default_options
-        else:
-            options = {}
+        video = self.video
 
-        if self.video is not None:
-            options = util.dict_merge(options, self.video.get_option(use_defaults=False))
-
-        try:
-            entity_options = json.loads(self.options)
-        except:
-            entity_options = {}
+        def merge():
+            if use_defaults:
+                options = default_options
+            else:
+                options = {}
 
-        options = util.dict_merge(options, entity_options)
+            if video is not None:
+                options = util.dict_merge(options, video.get_option(use_defaults=False))
 
-        if isinstance(key, basestring):
-            key = key.split('.')
+            try:
+                entity_options = json.loads(self.options)
+            except:
+                entity_options = {}
 
-        for k in key:
-            options = options[k]
+            return util.dict_merge(options, entity_options)
 
-        return options
+        return select_option(resolve_options(self, (use_defaults, video), merge, [video]), key)
 
     def annotation_values_global(self):
         """
@@ -637,8 +1130,9 @@ class AnnotationObject(Base):
 
     def annotation_values_local(self, ignore_interpolated=True):
         """
-        Returns list of all LOCAL annotation values associated to this annotation object
-        :rtype: list of AnnotationValue
+        Returns list of all LOCAL annotation values associated to this annotation object, including packed keyframes
+        (see AnnotationTrack)
+        :rtype: list of AnnotationValue or PackedValue
         """
 
         result = []
@@ -648,6 +1142,9 @@ class AnnotationObject(Base):
                 if not ignore_interpolated or not annotation_value.is_interpolated:
                     result.append(annotation_value)
 
+        for annotation_track in self.annotation_tracks:
+            result.extend(annotation_track.annotation_values())
+
         return result
 
     def annotation_values_local_grouped(self):
@@ -668,53 +1165,142 @@ class AnnotationObject(Base):
 
         return avsg
 
-    def annotation_values_local_interpolate_in_frame(self, frame, interpolation=True):
+    def annotation_values_local_sorted(self):
         """
-        Returns list of LOCAL annotation values for given frame.
-        Annotation values are interpolated when the annotation values are not specified exactly for given frame
-        Interpolated values are newly created AnnotationValue instances with is_interpolated attribute set to True
-        Newly created AnnotationValue instances are automatically expunged from sqlalchemy session, not to be persisted in the database.
+        Returns LOCAL annotation values associated to this annotation object, grouped by annotation attributes and sorted by frame.
+        Result is cached until annotation values of this object are changed (see reset_keyframes_cache()).
 
-        :rtype: list of AnnotationValue
+        :rtype: dict of AnnotationAttribute.id => (list of int, list of AnnotationValue)
         """
 
-        result = []
+        if self._keyframes_cache is None:
+            keyframes = {}
 
-        for annotation_attribute_id, annotation_values in self.annotation_values_local_grouped().iteritems():
-            # interpolate each annotation attribute separately
+            for annotation_attribute_id, annotation_values in self.annotation_values_local_grouped().iteritems():
+                annotation_values = sorted(annotation_values, key=lambda av: av.frame_from)
+                keyframes[annotation_attribute_id] = ([av.frame_from for av in annotation_values], annotation_values)
 
-            # at first, try to find annotation value in the given frame (no interpolation needed)
-            exact_match_av = None
+            self._keyframes_cache = keyframes
 
-            for av in annotation_values:
-                if av.frame_from == frame:
-                    # found exact match
-                    if exact_match_av is not None:
-                        raise Exception('Two local annotation values found in the same frame! (IDs: %d, %d)' % (
-                            av.id, exact_match_av.id))
+        return self._keyframes_cache
 
-                    exact_match_av = av
+    def keyframes(self):
+        """
+        Returns sorted frames with some LOCAL annotation value (of any attribute).
+        Result is cached together with annotation_values_local_sorted().
 
-            if exact_match_av is not None:
-                result.append(exact_match_av)
-                continue
+        :rtype: list of int
+        """
 
-            # no annotation value was found in the given frame, interpolation is needed
+        if self._keyframe_frames_cache is None:
+            frames = set()
 
-            if not interpolation:
-                continue
+            for annotation_attribute_frames, annotation_values in self.annotation_values_local_sorted().itervalues():
+                frames.update(annotation_attribute_frames)
 
-            # find two nearest annotation values, one past and one future
-            nearest_av_before = None
-            nearest_av_after = None
+            self._keyframe_frames_cache = sorted(frames)
 
-            for av in annotation_values:
-                if av.frame_from < frame:
-                    if nearest_av_before is None or nearest_av_before.frame_from < av.frame_from:
-                        nearest_av_before = av
-                elif av.frame_from > frame:
-                    if nearest_av_after is None or nearest_av_after.frame_from > av.frame_from:
-                        nearest_av_after = av
+        return self._keyframe_frames_cache
+
+    def keyframe_next(self, current_frame, to_future=True):
+        """
+        Returns the nearest keyframe (see keyframes()) after current_frame, or before it when to_future is false.
+        Returns None when there is no such keyframe.
+
+        :rtype: int
+        """
+
+        frames = self.keyframes()
+
+        if to_future:
+            i = bisect_right(frames, current_frame)
+
+            return frames[i] if i < len(frames) else None
+        else:
+            i = bisect_left(frames, current_frame)
+
+            return frames[i - 1] if i > 0 else None
+
+    def keyframe_previous(self, current_frame):
+        """
+        Shortcut for keyframe_next() with to_future=False
+        """
+
+        return self.keyframe_next(current_frame, to_future=False)
+
+    def reset_keyframes_cache(self):
+        """
+        Invalidates cached result of annotation_values_local_sorted() and keyframes(). Called automatically when annotation
+        values are added, removed or moved in time, and when this object is expired or refreshed by the session.
+        """
+
+        self._keyframes_cache = None
+        self._keyframe_frames_cache = None
+
+    def memory_usage(self):
+        """
+        Approximate memory footprint of this object with its loaded annotation values and packed tracks in bytes
+        (see instance_memory_usage()). Shared instances (attributes, annotators, video) are not included
+        and nothing is loaded from the database.
+
+        :rtype: int
+        """
+
+        size = instance_memory_usage(self)
+
+        # collections which are not loaded are not in __dict__
+        annotation_values = self.__dict__.get('annotation_values', [])
+        annotation_tracks = self.__dict__.get('annotation_tracks', [])
+
+        size += sys.getsizeof(annotation_values) + sum(instance_memory_usage(av) for av in annotation_values)
+        size += sys.getsizeof(annotation_tracks) + sum(instance_memory_usage(at) for at in annotation_tracks)
+
+        for annotation_track in annotation_tracks:
+            if annotation_track._values_cache is not None:
+                size += sys.getsizeof(annotation_track._values_cache) + sum(sys.getsizeof(pv) for pv in annotation_track._values_cache)
+
+        if self._keyframes_cache is not None:
+            for frames, values in self._keyframes_cache.itervalues():
+                size += sys.getsizeof(frames) + sys.getsizeof(values)
+
+        return size
+
+    def annotation_values_local_interpolate_in_frame(self, frame, interpolation=True):
+        """
+        Returns list of LOCAL annotation values for given frame.
+        Annotation values are interpolated when the annotation values are not specified exactly for given frame
+        Interpolated values are read-only InterpolatedValue instances, not persisted in the database
+        (see InterpolatedValue.database_session_add()).
+
+        Nearest annotation values are found by binary search in annotation_values_local_sorted().
+
+        :rtype: list of AnnotationValue or InterpolatedValue
+        """
+
+        result = []
+
+        for annotation_attribute_id, (frames, annotation_values) in self.annotation_values_local_sorted().iteritems():
+            # interpolate each annotation attribute separately
+            i = bisect_left(frames, frame)
+
+            # at first, try to find annotation value in the given frame (no interpolation needed)
+            if i < len(frames) and frames[i] == frame:
+                # found exact match
+                if i + 1 < len(frames) and frames[i + 1] == frame:
+                    raise Exception('Two local annotation values found in the same frame! (IDs: %d, %d)' % (
+                        annotation_values[i + 1].id, annotation_values[i].id))
+
+                result.append(annotation_values[i])
+                continue
+
+            # no annotation value was found in the given frame, interpolation is needed
+
+            if not interpolation:
+                continue
+
+            # two nearest annotation values, one past and one future
+            nearest_av_before = annotation_values[i - 1] if i > 0 else None
+            nearest_av_after = annotation_values[i] if i < len(frames) else None
 
             if nearest_av_before is None and nearest_av_after is None:
                 raise Exception('No annotation values were found in the past and future!?!')
@@ -727,6 +1313,108 @@ class AnnotationObject(Base):
 
         return result
 
+    def pack_tracks(self):
+        """
+        Moves LOCAL annotation values of positional attributes into packed tracks (see AnnotationTrack), one track
+        per attribute. Existing tracks are extended. Returns number of packed annotation values.
+
+        :rtype: int
+        """
+
+        grouped = defaultdict(list)
+
+        for annotation_value in self.annotation_values:
+            annotation_attribute = annotation_value.annotation_attribute
+
+            if not annotation_attribute.is_global and annotation_attribute.data_type in AnnotationTrack.packed_components:
+                grouped[annotation_attribute].append(annotation_value)
+
+        annotation_tracks = {annotation_track.annotation_attribute: annotation_track for annotation_track in self.annotation_tracks}
+
+        count = 0
+
+        for annotation_attribute, annotation_values in grouped.iteritems():
+            keyframes = [(annotation_value.frame_from, annotation_value.value) for annotation_value in annotation_values]
+
+            if annotation_attribute in annotation_tracks:
+                annotation_track = annotation_tracks[annotation_attribute]
+                keyframes.extend(zip(*annotation_track.keyframes()))
+            else:
+                annotation_track = AnnotationTrack(annotation_attribute=annotation_attribute)
+                self.annotation_tracks.append(annotation_track)
+
+            keyframes.sort(key=lambda keyframe: keyframe[0])
+
+            for i in range(1, len(keyframes)):
+                if keyframes[i - 1][0] == keyframes[i][0]:
+                    # the unique index of annotation values does not cover keyframes of packed tracks
+                    raise Exception('Two local annotation values or a packed track keyframe found in the same frame! (object %d, attribute %d, frame %d)' % (self.id, annotation_attribute.id, keyframes[i][0]))
+
+            annotation_track.set_keyframes(keyframes)
+
+            for annotation_value in annotation_values:
+                # deleted as orphan
+                self.annotation_values.remove(annotation_value)
+
+            count += len(annotation_values)
+
+        return count
+
+    def unpack_tracks(self):
+        """
+        Converts all packed tracks of this object back into LOCAL annotation values. Returns number of created values.
+
+        :rtype: int
+        """
+
+        count = 0
+
+        for annotation_track in list(self.annotation_tracks):
+            count += len(annotation_track.unpack())
+
+        return count
+
+    def simplify_keyframes(self, tolerance):
+        """
+        Removes LOCAL keyframes of positional attributes, which are reproduced by interpolation of remaining keyframes
+        within tolerance in pixels (see AnnotationValue.simplify()). Annotation values are deleted as orphans,
+        packed tracks are rewritten.
+
+        :rtype: (int, float) - number of removed keyframes, maximum error of removed keyframes
+        """
+
+        count = 0
+        max_error = 0.0
+
+        # list of items, the cache is reset when keyframes are removed
+        for annotation_attribute_id, (frames, annotation_values) in self.annotation_values_local_sorted().items():
+            if annotation_values[0].annotation_attribute.data_type not in AnnotationValue.simplified_data_types:
+                continue
+
+            kept, removed, error = AnnotationValue.simplify(annotation_values, tolerance)
+
+            if not len(removed):
+                continue
+
+            for annotation_value in removed:
+                if not annotation_value.is_packed:
+                    # deleted as orphan
+                    self.annotation_values.remove(annotation_value)
+
+            for annotation_track in set(av.annotation_track for av in removed if av.is_packed):
+                keyframes = [(av.frame_from, av.value) for av in kept if av.is_packed and av.annotation_track is annotation_track]
+
+                if len(keyframes):
+                    annotation_track.set_keyframes(keyframes)
+                else:
+                    # deleted as orphan
+                    self.annotation_tracks.remove(annotation_track)
+
+            count += len(removed)
+            max_error = max(max_error, error)
+
+        return count, max_error
+
     def active_interval(self):
         """
         Return frame interval, where this object is active (i.e. has some annotation values or some annotation values can be interpolated)
@@ -748,6 +1436,19 @@ class AnnotationObject(Base):
 
         return frame_from, frame_to
 
+    def update_span(self, ignored_annotation_values=()):
+        """
+        Recomputes first_frame and last_frame columns from LOCAL annotation values of this object.
+        Annotation values and tracks in ignored_annotation_values (e.g. deleted in current flush) are not counted.
+        """
+
+        frames = [av.frame_from for av in self.annotation_values_local()
+                  if av.frame_from is not None and av not in ignored_annotation_values
+                  and (not av.is_packed or av.annotation_track not in ignored_annotation_values)]
+
+        self.first_frame = min(frames) if len(frames) else None
+        self.last_frame = max(frames) if len(frames) else None
+
     def is_active_in_frame(self, frame):
         """
         Returns True if this object is active in given frame, see active_interval()
@@ -772,6 +1473,10 @@ class AnnotationValue(Base):
     __tablename__ = 'annotation_values'
 
     is_interpolated = False
+    is_packed = False
+
+    # (data type, decoded value), see value property and reset_value_cache()
+    _value_cache = None
 
     id = Column(Integer, primary_key=True)
     options = Column(UnicodeText)
@@ -795,19 +1500,40 @@ class AnnotationValue(Base):
 
     value = synonym('_value') #, descriptor=value)
 
+    __table_args__ = (
+        # one local value per object, attribute and frame (global values have frame_from NULL, NULLs are not compared)
+        # serves also as a composite index for lookups by object, attribute and frame
+        Index('ux_annotation_values_object_id_attribute_id_frame_from',
+              'annotation_object_id', 'annotation_attribute_id', 'frame_from', unique=True),
+        # autocomplete and searching of values within one attribute, MySQL indexes only a prefix of TEXT columns
+        Index('ix_annotation_values_attribute_id_value', 'annotation_attribute_id', 'value',
+              mysql_length={'value': 64}),
+    )
+
     logger.debug('Initialized AnnotationValue')
 
+    # data types whose keyframes can be removed by simplify()
+    simplified_data_types = [u'position_rectangle', u'position_circle', u'position_point']
+
+    # see resolve_options()
+    _options_cache = None
+    _options_version = 0
+
     @property
     def value(self):
-        # decode value from string
-        if self.annotation_attribute is None:
-            raise Exception('annotation_attribute cannot be None')
+        # decoded value is cached, until _value, annotation attribute or annotation object is changed
+        if self._value_cache is None:
+            # decode value from string
+            if self.annotation_attribute is None:
+                raise Exception('annotation_attribute cannot be None')
 
-        self.check_consistency()
+            self.check_consistency()
 
-        data_type = self.annotation_attribute.data_type
+            data_type = self.annotation_attribute.data_type
 
-        return self.decode_value(self._value, data_type)
+            self._value_cache = (data_type, self.decode_value(self._value, data_type))
+
+        return self._value_cache[1]
 
     @value.setter
     def value(self, v):
@@ -832,30 +1558,20 @@ class AnnotationValue(Base):
     def __repr__(self):
         return "<AnnotationValue#%s(frame %s,%s,%s)>" % (str(self.id), str(self.frame_from), unicode(self._value).encode('utf8'), 'interpolated' if self.is_interpolated else 'not interpolated')
 
-    def get_text(self):
+    def reset_value_cache(self):
         """
-        Returns text representation of the annotation value, suitable for the user.
+        Invalidates cached decoded value. Called automatically when _value, annotation attribute or annotation object
+        is changed, and when this value is expired or refreshed by the session.
         """
 
-        if self.annotation_attribute is None:
-            return None
+        self._value_cache = None
 
-        # no text for positional attributes
-        if self.annotation_attribute.name.startswith('position_'):
-            return None
-
-        data_type = self.annotation_attribute.data_type
-
-        if data_type == u'bool':
-            text = self.annotation_attribute.name if self._value else None
-        elif data_type in [u'int', u'float']:
-            text = self.annotation_attribute.name + '=' + unicode(self._value)
-        elif data_type == u'unicode':
-            text = self._value
-        else:
-            text = None
+    def get_text(self):
+        """
+        Returns text representation of the annotation value, suitable for the user.
+        """
 
-        return text
+        return value_text(self.annotation_attribute, self._value)
 
     @classmethod
     def encode_value(cls, v, data_type):
@@ -924,10 +1640,10 @@ class AnnotationValue(Base):
     @classmethod
     def interpolate(cls, annotation_value_before, annotation_value_after, frame):
         """
-        Returns new AnnotationValue, with value interpolated in given frame, from one or two existing annotation values.
-        Newly created object is automatically expunged from sqlalchemy session, not to be persisted in the database.
+        Returns new InterpolatedValue, with value interpolated in given frame, from one or two existing annotation values.
+        Interpolated value is not a mapped object, it is not tracked by sqlalchemy session (see InterpolatedValue).
 
-        :rtype: AnnotationValue
+        :rtype: InterpolatedValue
         """
 
         if annotation_value_before is not None and annotation_value_after is not None:
@@ -948,18 +1664,6 @@ class AnnotationValue(Base):
         # from where to copy attributes
         av_first = annotation_value_before if annotation_value_before is not None else annotation_value_after
 
-        # create new AnnotationValue with interpolated values
-        av_interpolated = AnnotationValue()
-        av_interpolated.is_interpolated = True
-        av_interpolated.frame_from = frame
-        av_interpolated.annotation_attribute = av_first.annotation_attribute
-        av_interpolated.annotation_attribute_id = av_first.annotation_attribute_id
-        av_interpolated.annotation_object = av_first.annotation_object
-        av_interpolated.annotation_object_id = av_first.annotation_object_id
-
-        # expunge object - do not persist this object in database
-        av_interpolated.database_session_remove()
-
         data_type = av_first.annotation_attribute.data_type
 
         t1 = annotation_value_before.frame_from if annotation_value_before is not None else None
@@ -972,55 +1676,129 @@ class AnnotationValue(Base):
         if data_type == u'int' or data_type == u'float':
             if t1 is None or t2 is None:
                 # one value is None, use the second value as a result
-                av_interpolated.value = av_first.value
+                v = av_first.value
             else:
                 # both values are set, interpolate result value
                 v = cls.interpolate_float((t1, annotation_value_before.value),
-                                          (t2, float(annotation_value_after.value)))
+                                          (t2, float(annotation_value_after.value)), frame)
                 if data_type == u'int':
                     v = int(v)
-                av_interpolated.value = v
         elif data_type == u'bool' or data_type == u'unicode':
             # result value is same as the "before" value, "after" value is ignored
             if t1 is None:
                 return None
-            av_interpolated.value = annotation_value_before.value
+            v = annotation_value_before.value
         elif data_type == u'position_rectangle':
             if t1 is None or t2 is None:
                 # one value is None, use the second value as a result
-                av_interpolated.value = av_first.value
+                v = av_first.value
             else:
                 # both values are set, interpolate result value
                 x1 = int(cls.interpolate_float((t1, annotation_value_before.value[0]), (t2, annotation_value_after.value[0]), frame))
                 y1 = int(cls.interpolate_float((t1, annotation_value_before.value[1]), (t2, annotation_value_after.value[1]), frame))
                 x2 = int(cls.interpolate_float((t1, annotation_value_before.value[2]), (t2, annotation_value_after.value[2]), frame))
                 y2 = int(cls.interpolate_float((t1, annotation_value_before.value[3]), (t2, annotation_value_after.value[3]), frame))
-                av_interpolated.value = [x1, y1, x2, y2]
+                v = [x1, y1, x2, y2]
         elif data_type == u'position_circle':
             if t1 is None or t2 is None:
                 # one value is None, use the second value as a result
-                av_interpolated.value = av_first.value
+                v = av_first.value
             else:
                 # both values are set, interpolate result value
                 x = int(cls.interpolate_float((t1, annotation_value_before.value[0]), (t2, annotation_value_after.value[0]), frame))
                 y = int(cls.interpolate_float((t1, annotation_value_before.value[1]), (t2, annotation_value_after.value[1]), frame))
                 r = cls.interpolate_float((t1, annotation_value_before.value[2]), (t2, annotation_value_after.value[2]), frame)
-                av_interpolated.value = [x, y, r]
+                v = [x, y, r]
         elif data_type == u'position_point':
             if t1 is None or t2 is None:
                 # one value is None, use the second value as a result
-                av_interpolated.value = av_first.value
+                v = av_first.value
             else:
                 # both values are set, interpolate result value
                 x = int(cls.interpolate_float((t1, annotation_value_before.value[0]), (t2, annotation_value_after.value[0]), frame))
                 y = int(cls.interpolate_float((t1, annotation_value_before.value[1]), (t2, annotation_value_after.value[1]), frame))
-                av_interpolated.value = [x, y]
+                v = [x, y]
         elif data_type == u'position_nonvisual':
-            av_interpolated.value = None
+            v = None
         else:
             raise Exception('Unsupported data_type for interpolation: %s' % (data_type))
 
-        return av_interpolated
+        return InterpolatedValue(frame, v, av_first.annotation_attribute, av_first.annotation_object)
+
+    @classmethod
+    def interpolation_error(cls, value, value_interpolated):
+        """
+        Returns the largest difference of coordinates (in pixels) between positional value and its interpolation.
+
+        :rtype: float
+        """
+
+        return max(abs(float(a) - b) for a, b in zip(value, value_interpolated))
+
+    @classmethod
+    def simplify(cls, annotation_values, tolerance):
+        """
+        Douglas-Peucker simplification of keyframes of one positional attribute (see simplified_data_types).
+        Keyframe is removable, when its value is reproduced by interpolate() from the kept neighbouring keyframes
+        within tolerance (in pixels, see interpolation_error()). First and last keyframes are always kept.
+
+        Interpolation is linear between keyframes, so frames between removed keyframes are also within tolerance
+        (up to rounding of coordinates to integers).
+
+        :param annotation_values: keyframes sorted by frame
+        :type annotation_values: list of AnnotationValue or PackedValue
+        :rtype: (list, list, float) - kept keyframes, removed keyframes, maximum error of removed keyframes
+        """
+
+        if len(annotation_values) < 3:
+            return list(annotation_values), [], 0.0
+
+        data_type = annotation_values[0].annotation_attribute.data_type
+
+        if data_type not in cls.simplified_data_types:
+            raise Exception('Unsupported data_type for simplification: %s' % (data_type))
+
+        for i in range(1, len(annotation_values)):
+            if annotation_values[i - 1].frame_from == annotation_values[i].frame_from:
+                raise Exception('Two local annotation values found in the same frame! (frame %d)' % (annotation_values[i].frame_from))
+
+        keep = [False] * len(annotation_values)
+        keep[0] = keep[-1] = True
+
+        max_error = 0.0
+
+        # ranges of keyframes (first, last) to simplify, explicit stack instead of recursion (tracks can be long)
+        stack = [(0, len(annotation_values) - 1)]
+
+        while len(stack):
+            i, j = stack.pop()
+
+            worst = None
+            worst_error = -1.0
+
+            for k in range(i + 1, j):
+                av_interpolated = cls.interpolate(annotation_values[i], annotation_values[j], annotation_values[k].frame_from)
+                error = cls.interpolation_error(annotation_values[k].value, av_interpolated.value)
+
+                if error > worst_error:
+                    worst = k
+                    worst_error = error
+
+            if worst is None:
+                continue
+
+            if worst_error > tolerance:
+                # keyframe with the largest error is kept, both parts are simplified separately
+                keep[worst] = True
+                stack.append((i, worst))
+                stack.append((worst, j))
+            else:
+                max_error = max(max_error, worst_error)
+
+        kept = [av for av, k in zip(annotation_values, keep) if k]
+        removed = [av for av, k in zip(annotation_values, keep) if not k]
+
+        return kept, removed, max_error
 
     def get_option(self, key=[], current_annotator=None, use_defaults=True):
         """
@@ -1032,34 +1810,28 @@ class AnnotationValue(Base):
             3) annotation object (which inherits options from video)
             4) annotation attribute
             5) self.options
-        """
 
-        if use_defaults:
-            options = default_options
-        else:
-            options = {}
+        Resolved options are cached (see resolve_options()) and returned as read-only dicts.
+        """
 
-        if current_annotator is not None:
-            options = util.dict_merge(options, current_annotator.get_option(use_defaults=False))
-        if self.annotation_attribute is not None:
-            options = util.dict_merge(options, self.annotation_attribute.get_option(use_defaults=False))
-        if self.annotation_object is not None:
-            options = util.dict_merge(options, self.annotation_object.get_option(use_defaults=False))
+        annotation_attribute = self.annotation_attribute
+        annotation_object = self.annotation_object
 
-        try:
-            entity_options = json.loads(self.options)
-        except:
-            entity_options = {}
+        def merge():
+            options = value_options(current_annotator, annotation_attribute, annotation_object, use_defaults)
 
-        options = util.dict_merge(options, entity_options)
+            try:
+                entity_options = json.loads(self.options)
+            except:
+                entity_options = {}
 
-        if isinstance(key, basestring):
-            key = key.split('.')
+            return util.dict_merge(options, entity_options)
 
-        for k in key:
-            options = options[k]
+        cache_key = (use_defaults, current_annotator, annotation_attribute, annotation_object)
+        inherited = [current_annotator, annotation_attribute, annotation_object,
+                     annotation_object.video if annotation_object is not None else None]
 
-        return options
+        return select_option(resolve_options(self, cache_key, merge, inherited), key)
 
     def check_consistency(self):
         if self.annotation_object and self.annotation_attribute:
@@ -1079,6 +1851,595 @@ class AnnotationValue(Base):
             self.is_interpolated = False
         database.db.session.add(self)
 
+        if self.annotation_object is not None:
+            # interpolated value is a new keyframe now
+            self.annotation_object.reset_keyframes_cache()
+
+
+class ReadOnlyValue(object):
+    """
+    Common methods of read-only annotation values, which are not mapped to the database (InterpolatedValue, PackedValue).
+    """
+
+    __slots__ = ()
+
+    @property
+    def annotation_attribute_id(self):
+        return self.annotation_attribute.id
+
+    @property
+    def annotation_object_id(self):
+        return self.annotation_object.id
+
+    def get_option(self, key=[], current_annotator=None, use_defaults=True):
+        """
+        Options are merged the same way as in AnnotationValue.get_option(), read-only value has no own options.
+        Resolved options are cached on the annotation object (see resolve_options()).
+        """
+
+        annotation_attribute = self.annotation_attribute
+        annotation_object = self.annotation_object
+
+        merge = lambda: value_options(current_annotator, annotation_attribute, annotation_object, use_defaults)
+        cache_key = ('value', use_defaults, current_annotator, annotation_attribute)
+        inherited = [current_annotator, annotation_attribute, annotation_object.video]
+
+        return select_option(resolve_options(annotation_object, cache_key, merge, inherited), key)
+
+
+class InterpolatedValue(ReadOnlyValue):
+    """
+    Read-only annotation value interpolated in a frame between two LOCAL annotation values (see AnnotationValue.interpolate()).
+    It is not mapped to the database and does not touch sqlalchemy session, use database_session_add() to store it
+    as a new AnnotationValue.
+    """
+
+    __slots__ = ('frame_from', 'value', '_value', 'annotation_attribute', 'annotation_object')
+
+    is_interpolated = True
+    is_packed = False
+    id = None
+    options = None
+
+    def __init__(self, frame_from, value, annotation_attribute, annotation_object):
+        data_type = annotation_attribute.data_type
+
+        # value is normalized the same way as AnnotationValue.value (encoded and decoded back)
+        _value = AnnotationValue.encode_value(value, data_type)
+
+        object.__setattr__(self, 'frame_from', frame_from)
+        object.__setattr__(self, '_value', _value)
+        object.__setattr__(self, 'value', AnnotationValue.decode_value(_value, data_type))
+        object.__setattr__(self, 'annotation_attribute', annotation_attribute)
+        object.__setattr__(self, 'annotation_object', annotation_object)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("InterpolatedValue is read-only, use database_session_add() to create an AnnotationValue")
+
+    def __repr__(self):
+        return "<InterpolatedValue(frame %s,%s)>" % (str(self.frame_from), unicode(self._value).encode('utf8'))
+
+    def get_text(self):
+        """
+        Returns text representation of the annotation value, suitable for the user, see AnnotationValue.get_text()
+        """
+
+        return value_text(self.annotation_attribute, self._value)
+
+    def database_session_add(self):
+        """
+        Creates a new LOCAL AnnotationValue (keyframe) with this value and adds it to the session.
+
+        :rtype: AnnotationValue
+        """
+
+        annotation_value = AnnotationValue()
+        annotation_value.frame_from = self.frame_from
+        annotation_value.annotation_attribute = self.annotation_attribute
+        annotation_value.annotation_object = self.annotation_object
+        annotation_value.value = self.value
+
+        annotation_value.database_session_add()
+
+        return annotation_value
+
+
+class PackedValue(ReadOnlyValue):
+    """
+    Read-only LOCAL annotation value (keyframe) stored in a packed track (see AnnotationTrack).
+    It is not mapped to the database, use database_session_add() to unpack the track into editable AnnotationValues.
+    """
+
+    __slots__ = ('frame_from', 'value', 'annotation_attribute', 'annotation_object', 'annotation_track')
+
+    is_interpolated = False
+    is_packed = True
+    id = None
+    options = None
+    _value = None
+
+    def __init__(self, frame_from, value, annotation_track):
+        object.__setattr__(self, 'frame_from', frame_from)
+        object.__setattr__(self, 'value', value)
+        object.__setattr__(self, 'annotation_attribute', annotation_track.annotation_attribute)
+        object.__setattr__(self, 'annotation_object', annotation_track.annotation_object)
+        object.__setattr__(self, 'annotation_track', annotation_track)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PackedValue is read-only, use database_session_add() to unpack the track")
+
+    def __repr__(self):
+        return "<PackedValue(frame %s,%s)>" % (str(self.frame_from), str(self.value))
+
+    def get_text(self):
+        # no text for positional attributes
+        return None
+
+    def database_session_add(self):
+        """
+        Unpacks whole track into AnnotationValues (see AnnotationTrack.unpack()) and returns the one in this frame.
+
+        :rtype: AnnotationValue
+        """
+
+        for annotation_value in self.annotation_track.unpack():
+            if annotation_value.frame_from == self.frame_from:
+                return annotation_value
+
+
+class AnnotationTrack(Base):
+    """
+    Packed LOCAL annotation values (keyframes) of one annotation object and one positional annotation attribute.
+    Instead of one annotation_values row per keyframe, keyframes are stored as little-endian binary arrays:
+    frames as int32 and coordinates as int16 (circle radius as float32).
+
+    Packed keyframes are returned by AnnotationObject.annotation_values_local*() as PackedValue instances.
+    Per-keyframe data other than frame and value (e.g. created_by, options) are not stored.
+    """
+
+    __tablename__ = 'annotation_tracks'
+
+    # number of int16 components of packed value for each data type, circle has float32 radius too
+    packed_components = {
+        u'position_rectangle': 4,
+        u'position_circle': 2,
+        u'position_point': 2,
+    }
+
+    # PackedValue instances decoded from frames and coordinates, see reset_values_cache()
+    _values_cache = None
+
+    id = Column(Integer, primary_key=True)
+
+    frames = Column(LargeBinary().with_variant(LONGBLOB, 'mysql'), nullable=False)
+    coordinates = Column(LargeBinary().with_variant(LONGBLOB, 'mysql'), nullable=False)
+    first_frame = Column(Integer)
+    last_frame = Column(Integer)
+    created_at = Column(TIMESTAMP, server_default=func.current_timestamp())
+    modified_at = Column(TIMESTAMP, onupdate=func.current_timestamp())
+
+    annotation_attribute_id = Column(Integer, ForeignKey('annotation_attributes.id'), nullable=False)
+    annotation_attribute = relationship('AnnotationAttribute', backref='annotation_tracks')
+
+    annotation_object_id = Column(Integer, ForeignKey('annotation_objects.id', ondelete='CASCADE'), nullable=False)
+    # deleted by the ORM, SQLite does not enforce ON DELETE CASCADE
+    annotation_object = relationship('AnnotationObject', backref=backref('annotation_tracks', cascade="all, delete-orphan"))
+
+    __table_args__ = (
+        # one track per object and attribute
+        Index('ux_annotation_tracks_object_id_attribute_id', 'annotation_object_id', 'annotation_attribute_id', unique=True),
+    )
+
+    logger.debug('Initialized AnnotationTrack')
+
+    def __repr__(self):
+        return "<AnnotationTrack#%s(object %s,attribute %s,frames %s-%s)>" % (str(self.id), str(self.annotation_object_id), str(self.annotation_attribute_id), str(self.first_frame), str(self.last_frame))
+
+    @classmethod
+    def encode_keyframes(cls, keyframes, data_type):
+        """
+        Packs keyframes into binary strings.
+
+        :type keyframes: list of (int, value) sorted by frame
+        :rtype: (str, str) - frames and coordinates
+        """
+
+        if data_type not in cls.packed_components:
+            raise Exception('Unsupported data_type for packed track: %s' % (data_type))
+
+        components = cls.packed_components[data_type]
+
+        frames = array('i', [frame for frame, v in keyframes])
+        coordinates = array('h')
+        radiuses = array('f')
+
+        for frame, v in keyframes:
+            if not all(-32768 <= c <= 32767 for c in v[:components]):
+                raise Exception('Coordinates cannot be packed into int16: %s' % (v, ))
+
+            coordinates.extend(int(c) for c in v[:components])
+
+            if data_type == u'position_circle':
+                radiuses.append(v[2])
+
+        if sys.byteorder != 'little':
+            frames.byteswap()
+            coordinates.byteswap()
+            radiuses.byteswap()
+
+        return frames.tostring(), coordinates.tostring() + radiuses.tostring()
+
+    @classmethod
+    def decode_keyframes(cls, frames, coordinates, data_type):
+        """
+        Unpacks binary strings created by encode_keyframes(), values are the same as AnnotationValue.value.
+
+        :rtype: (list of int, list of value)
+        """
+
+        if data_type not in cls.packed_components:
+            raise Exception('Unsupported data_type for packed track: %s' % (data_type))
+
+        components = cls.packed_components[data_type]
+
+        a_frames = array('i')
+        a_frames.fromstring(frames)
+
+        n = len(a_frames) * components * array('h').itemsize
+
+        a_coordinates = array('h')
+        a_coordinates.fromstring(coordinates[:n])
+
+        a_radiuses = array('f')
+        a_radiuses.fromstring(coordinates[n:])
+
+        if sys.byteorder != 'little':
+            a_frames.byteswap()
+            a_coordinates.byteswap()
+            a_radiuses.byteswap()
+
+        c = a_coordinates.tolist()
+
+        if data_type == u'position_rectangle':
+            values = zip(c[0::4], c[1::4], c[2::4], c[3::4])
+        elif data_type == u'position_circle':
+            # radius is stored with 2 decimal places, see AnnotationValue.encode_value()
+            values = [(x, y, round(r, 2)) for x, y, r in zip(c[0::2], c[1::2], a_radiuses.tolist())]
+        else:
+            values = zip(c[0::2], c[1::2])
+
+        return a_frames.tolist(), values
+
+    def set_keyframes(self, keyframes):
+        """
+        Replaces packed keyframes.
+
+        :type keyframes: list of (int, value) sorted by frame
+        """
+
+        self.frames, self.coordinates = self.encode_keyframes(keyframes, self.annotation_attribute.data_type)
+
+        self.first_frame = keyframes[0][0] if len(keyframes) else None
+        self.last_frame = keyframes[-1][0] if len(keyframes) else None
+
+    def keyframes(self):
+        """
+        :rtype: (list of int, list of value)
+        """
+
+        return self.decode_keyframes(self.frames, self.coordinates, self.annotation_attribute.data_type)
+
+    def annotation_values(self):
+        """
+        Returns packed keyframes as read-only values, sorted by frame. Result is cached until the track is changed.
+
+        :rtype: list of PackedValue
+        """
+
+        if self._values_cache is None:
+            self._values_cache = [PackedValue(frame, value, self) for frame, value in zip(*self.keyframes())]
+
+        return self._values_cache
+
+    def reset_values_cache(self):
+        """
+        Invalidates cached result of annotation_values(). Called automatically when frames or coordinates are changed,
+        and when this track is expired or refreshed by the session.
+        """
+
+        self._values_cache = None
+
+    def unpack(self):
+        """
+        Converts this track into AnnotationValues (one per keyframe), the track is removed.
+
+        :rtype: list of AnnotationValue
+        """
+
+        annotation_object = self.annotation_object
+        annotation_attribute = self.annotation_attribute
+
+        frames, values = self.keyframes()
+
+        # loose annotation values in frames of the track would violate the unique index
+        duplicate_frames = sorted(set(frames).intersection(annotation_value.frame_from
+                                                           for annotation_value in annotation_object.annotation_values
+                                                           if annotation_value.annotation_attribute == annotation_attribute))
+
+        if duplicate_frames:
+            raise Exception('Local annotation values found in frames of the packed track! (object %d, attribute %d, frames %s)' % (annotation_object.id, annotation_attribute.id, duplicate_frames))
+
+        annotation_values = []
+
+        for frame, value in zip(frames, values):
+            annotation_value = AnnotationValue()
+            annotation_value.frame_from = frame
+            annotation_value.annotation_attribute = annotation_attribute
+            annotation_value.annotation_object = annotation_object
+            annotation_value.value = value
+
+            annotation_values.append(annotation_value)
+
+        # deleted as orphan
+        annotation_object.annotation_tracks.remove(self)
+
+        return annotation_values
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'before_flush')
+def _update_annotation_object_spans(session, flush_context, instances):
+    """
+    Keeps AnnotationObject.first_frame and last_frame up to date, when local annotation values are added, moved or deleted.
+    """
+
+    annotation_objects = set()
+
+    for instance in list(session.new) + list(session.deleted):
+        if isinstance(instance, (AnnotationValue, AnnotationTrack)) and instance.annotation_object is not None:
+            annotation_objects.add(instance.annotation_object)
+
+    for instance in session.dirty:
+        if isinstance(instance, AnnotationTrack):
+            if instance.annotation_object is not None and sqlalchemy.orm.attributes.get_history(instance, 'frames').has_changes():
+                annotation_objects.add(instance.annotation_object)
+
+            continue
+
+        if not isinstance(instance, AnnotationValue):
+            continue
+
+        history_frame = sqlalchemy.orm.attributes.get_history(instance, 'frame_from')
+        history_object = sqlalchemy.orm.attributes.get_history(instance, 'annotation_object')
+
+        if history_frame.has_changes() or history_object.has_changes():
+            # value was moved in time or to a different object, update both old and new object
+            annotation_objects.update(ao for ao in history_object.deleted if ao is not None)
+
+            if instance.annotation_object is not None:
+                annotation_objects.add(instance.annotation_object)
+
+    deleted = set(session.deleted)
+
+    for annotation_object in annotation_objects:
+        if annotation_object not in deleted:
+            annotation_object.update_span(ignored_annotation_values=deleted)
+
+
+@event.listens_for(AnnotationValue.annotation_object, 'set')
+def _reset_keyframes_cache_on_object_change(annotation_value, value, oldvalue, initiator):
+    # fired also for AnnotationObject.annotation_values append/remove (backref)
+    for annotation_object in (value, oldvalue):
+        if isinstance(annotation_object, AnnotationObject):
+            annotation_object.reset_keyframes_cache()
+
+
+@event.listens_for(AnnotationValue.frame_from, 'set')
+@event.listens_for(AnnotationValue.annotation_attribute, 'set')
+def _reset_keyframes_cache_on_value_change(annotation_value, value, oldvalue, initiator):
+    if annotation_value.annotation_object is not None:
+        annotation_value.annotation_object.reset_keyframes_cache()
+
+
+@event.listens_for(AnnotationTrack.annotation_object, 'set')
+def _reset_keyframes_cache_on_track_object_change(annotation_track, value, oldvalue, initiator):
+    # fired also for AnnotationObject.annotation_tracks append/remove (backref)
+    for annotation_object in (value, oldvalue):
+        if isinstance(annotation_object, AnnotationObject):
+            annotation_object.reset_keyframes_cache()
+
+    annotation_track.reset_values_cache()
+
+
+@event.listens_for(AnnotationTrack.frames, 'set')
+@event.listens_for(AnnotationTrack.coordinates, 'set')
+@event.listens_for(AnnotationTrack.annotation_attribute, 'set')
+def _reset_keyframes_cache_on_track_change(annotation_track, value, oldvalue, initiator):
+    annotation_track.reset_values_cache()
+
+    if annotation_track.annotation_object is not None:
+        annotation_track.annotation_object.reset_keyframes_cache()
+
+
+@event.listens_for(AnnotationTrack, 'expire')
+def _reset_values_cache_on_track_expire(annotation_track, attrs):
+    # instance can be already garbage collected when the whole session is expired
+    if annotation_track is not None:
+        annotation_track.reset_values_cache()
+
+
+@event.listens_for(AnnotationTrack, 'refresh')
+def _reset_values_cache_on_track_refresh(annotation_track, context, attrs):
+    annotation_track.reset_values_cache()
+
+
+@event.listens_for(AnnotationObject, 'expire')
+def _reset_keyframes_cache_on_expire(annotation_object, attrs):
+    # instance can be already garbage collected when the whole session is expired
+    if annotation_object is not None:
+        annotation_object.reset_keyframes_cache()
+
+
+@event.listens_for(AnnotationObject, 'refresh')
+def _reset_keyframes_cache_on_refresh(annotation_object, context, attrs):
+    annotation_object.reset_keyframes_cache()
+
+
+@event.listens_for(AnnotationValue._value, 'set')
+@event.listens_for(AnnotationValue.annotation_attribute, 'set')
+@event.listens_for(AnnotationValue.annotation_object, 'set')
+def _reset_value_cache_on_change(annotation_value, value, oldvalue, initiator):
+    annotation_value.reset_value_cache()
+
+
+@event.listens_for(AnnotationValue, 'expire')
+def _reset_value_cache_on_expire(annotation_value, attrs):
+    # instance can be already garbage collected when the whole session is expired
+    if annotation_value is not None:
+        annotation_value.reset_value_cache()
+
+
+@event.listens_for(AnnotationValue, 'refresh')
+def _reset_value_cache_on_refresh(annotation_value, context, attrs):
+    annotation_value.reset_value_cache()
+
+
+def _change_value_dictionary(annotation_attribute_id, value, count):
+    if annotation_attribute_id in value_dictionaries and value is not None:
+        if count > 0:
+            value_dictionaries[annotation_attribute_id].add(value, count)
+        else:
+            value_dictionaries[annotation_attribute_id].remove(value, -count)
+
+        _value_dictionaries_changes.append((annotation_attribute_id, value, count))
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _update_value_dictionaries(session, flush_context):
+    if not len(value_dictionaries) or session is not database.db.session:
+        return
+
+    for instance in session.new:
+        if isinstance(instance, AnnotationValue):
+            _change_value_dictionary(instance.annotation_attribute_id, instance._value, 1)
+
+    for instance in session.deleted:
+        if isinstance(instance, AnnotationValue):
+            _change_value_dictionary(instance.annotation_attribute_id, instance._value, -1)
+
+    for instance in session.dirty:
+        if isinstance(instance, AnnotationValue):
+            attrs = sqlalchemy.inspect(instance).attrs
+            history_value = attrs._value.history
+            history_attribute = attrs.annotation_attribute_id.history
+
+            if not history_value.has_changes() and not history_attribute.has_changes():
+                continue
+
+            # values before and after the flush
+            old_value, old_attribute_id = [(h.deleted or h.unchanged or [None])[0] for h in (history_value, history_attribute)]
+            new_value, new_attribute_id = [(h.added or h.unchanged or [None])[0] for h in (history_value, history_attribute)]
+
+            _change_value_dictionary(old_attribute_id, old_value, -1)
+            _change_value_dictionary(new_attribute_id, new_value, 1)
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _commit_value_dictionaries(session):
+    if session is not database.db.session:
+        return
+
+    del _value_dictionaries_changes[:]
+    _value_dictionaries_loaded.clear()
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _rollback_value_dictionaries(session):
+    if session is not database.db.session:
+        return
+
+    for annotation_attribute_id, value, count in reversed(_value_dictionaries_changes):
+        if annotation_attribute_id in value_dictionaries:
+            if count > 0:
+                value_dictionaries[annotation_attribute_id].remove(value, count)
+            else:
+                value_dictionaries[annotation_attribute_id].add(value, -count)
+
+    # dictionaries loaded in the transaction may contain rolled back values
+    for annotation_attribute_id in _value_dictionaries_loaded:
+        value_dictionaries.pop(annotation_attribute_id, None)
+
+    del _value_dictionaries_changes[:]
+    _value_dictionaries_loaded.clear()
+
+
+def _increment_timeline_version():
+    global timeline_version, _timeline_changed
+    timeline_version += 1
+    _timeline_changed = True
+
+
+def invalidate_timeline_indexes():
+    """
+    Timeline indexes of videos are loaded again on the next use, e.g. to see objects committed by other annotators.
+    """
+
+    global timeline_version
+    timeline_version += 1
+
+
+@event.listens_for(AnnotationObject.first_frame, 'set')
+@event.listens_for(AnnotationObject.last_frame, 'set')
+@event.listens_for(AnnotationObject.video, 'set')
+def _increment_timeline_version_on_change(annotation_object, value, oldvalue, initiator):
+    # spans are assigned in every flush, see _update_annotation_object_spans()
+    if value != oldvalue:
+        _increment_timeline_version()
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'before_flush')
+def _increment_timeline_version_on_delete(session, flush_context, instances):
+    if any(isinstance(instance, AnnotationObject) for instance in session.deleted):
+        _increment_timeline_version()
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _commit_timeline_changes(session):
+    global _timeline_changed
+
+    # new transaction sees objects committed by other annotators meanwhile
+    if session is database.db.session:
+        invalidate_timeline_indexes()
+        _timeline_changed = False
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _rollback_timeline_changes(session):
+    global _timeline_changed
+
+    # only rolled back changes of spans invalidate indexes, other sessions (e.g. executor.DatabaseExecutor) do not change them
+    if session is database.db.session and _timeline_changed:
+        _increment_timeline_version()
+        _timeline_changed = False
+
+
+def _increment_options_version(instance, attrs=None):
+    # instance can be already garbage collected when the whole session is expired
+    if instance is not None and (attrs is None or 'options' in attrs):
+        instance._options_version += 1
+
+
+def _increment_options_version_on_change(instance, value, oldvalue, initiator):
+    _increment_options_version(instance)
+
+
+def _increment_options_version_on_refresh(instance, context, attrs):
+    _increment_options_version(instance, attrs)
+
+for cls in (Annotator, Video, AnnotationAttribute, AnnotationObject, AnnotationValue):
+    event.listen(cls.options, 'set', _increment_options_version_on_change)
+    event.listen(cls, 'expire', _increment_options_version)
+    event.listen(cls, 'refresh', _increment_options_version_on_refresh)
+
 
 class Log(Base):
     """
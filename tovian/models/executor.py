@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Database executor - a thread, which owns its own database connection and session and runs submitted queries.
+
+    Queries are submitted as functions, which are called with the session of the executor as the first argument.
+    Results are returned as Future objects; callbacks of futures (e.g. emitting Qt signals) are called by the executor thread.
+    The session of the executor is read-only: after each function, loaded objects are detached (so they can be passed
+    to other threads) and the transaction is ended, so the next function sees newly committed data.
+
+    Objects loaded by the executor are copied into the main session (database.db.session) by merge_into_session().
+"""
+
+import sys
+import time
+import logging
+import threading
+import itertools
+import Queue
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+
+import database
+import entity
+
+
+logger = logging.getLogger(__name__)
+logger.debug('Import ' + __name__)
+
+
+class Future():
+    """
+    Result of a function submitted to DatabaseExecutor.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        """
+        :rtype: bool
+        """
+
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the result. Exception raised by the function is raised again.
+        """
+
+        if not self.event.wait(timeout):
+            raise Exception('Result of database executor was not available in %s seconds.' % (timeout))
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        :rtype: Exception or None
+        """
+
+        if not self.event.wait(timeout):
+            raise Exception('Result of database executor was not available in %s seconds.' % (timeout))
+
+        return None if self._exc_info is None else self._exc_info[1]
+
+    def add_done_callback(self, callback):
+        """
+        Callback is called with the future as the only argument, by the executor thread
+        (or immediately, when the future is already done).
+        """
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+
+        self._call(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._done()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done()
+
+    def _done(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logger.exception("Error in callback of database executor future")
+
+
+class DatabaseExecutor():
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+
+        self.engine = None
+        self.session = None
+        self.opened_url = None
+
+    def start(self):
+        """
+        Starts the executor thread (if not started yet).
+        """
+
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.thread = threading.Thread(target=self.run, name='DatabaseExecutor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the executor thread after all submitted functions are done. Returns False on timeout.
+
+        :rtype: bool
+        """
+
+        if self.thread is None or not self.thread.is_alive():
+            return True
+
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+        return not self.thread.is_alive()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Submits function(session, *args, **kwargs) to be called by the executor thread.
+
+        :rtype: Future
+        """
+
+        future = Future()
+
+        self.start()
+        self.queue.put((future, function, args, kwargs))
+
+        return future
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+
+            if task is None:
+                break
+
+            future, function, args, kwargs = task
+
+            try:
+                session = self.open_session()
+                result = function(session, *args, **kwargs)
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+            finally:
+                self.end_session()
+
+        self.close()
+
+    def open_session(self):
+        """
+        Session of the executor, bound to its own engine with the same url as the main database.
+
+        :rtype: sqlalchemy.orm.Session
+        """
+
+        url = str(database.db.engine.url)
+
+        if self.opened_url != url:
+            self.close()
+
+            self.engine = database.db.create_engine(url)
+
+            # executed statements are included in statistics of the database
+            event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(self.engine, "after_cursor_execute", self._after_cursor_execute)
+
+            self.session = sessionmaker(bind=self.engine, autoflush=False)()
+            self.opened_url = url
+
+        return self.session
+
+    def end_session(self):
+        if self.session is None:
+            return
+
+        try:
+            # loaded objects keep their state, transaction is ended (without expiring them)
+            self.session.expunge_all()
+            self.session.rollback()
+        except Exception:
+            logger.exception("Error when ending session of database executor")
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+
+        self.opened_url = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['executor_query_start'] = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration_ms = 1000 * (time.time() - conn.info.pop('executor_query_start', time.time()))
+
+        database.db.statistics.add(statement, duration_ms, cursor.rowcount)
+
+
+def changed_annotation_object_ids(session=None):
+    """
+    IDs of annotation objects, which are new, changed or deleted in session (database.db.session by default),
+    or whose annotation values or tracks are. Instance state is read without SQL statements.
+
+    :rtype: set of int
+    """
+
+    if session is None:
+        session = database.db.session
+
+    ids = set()
+
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        state = sqlalchemy.inspect(instance)
+
+        if isinstance(instance, entity.AnnotationObject):
+            owners = [instance]
+        elif isinstance(instance, (entity.AnnotationValue, entity.AnnotationTrack)):
+            owners = [state.dict.get('annotation_object')]
+            ids.add(state.dict.get('annotation_object_id'))
+            ids.add(state.committed_state.get('annotation_object_id'))
+        else:
+            continue
+
+        for owner in owners:
+            identity = sqlalchemy.inspect(owner).identity if owner is not None else None
+
+            if identity is not None:
+                ids.add(identity[0])
+
+    ids.discard(None)
+
+    return ids
+
+
+def annotation_objects_with_changed_values(session=None):
+    """
+    Annotation objects in session (database.db.session by default), whose annotation values or tracks are new,
+    changed or deleted. Deleted objects are left out. Instance state is read without SQL statements.
+
+    :rtype: set of entity.AnnotationObject
+    """
+
+    if session is None:
+        session = database.db.session
+
+    objects = set()
+
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        if not isinstance(instance, (entity.AnnotationValue, entity.AnnotationTrack)):
+            continue
+
+        state = sqlalchemy.inspect(instance)
+        owner = state.dict.get('annotation_object')
+
+        if owner is None:
+            # removed from the collection, owner is looked up by the former foreign key
+            owner_id = state.committed_state.get('annotation_object_id', state.dict.get('annotation_object_id'))
+
+            if owner_id is not None:
+                owner = session.identity_map.get(sqlalchemy.orm.util.identity_key(entity.AnnotationObject, owner_id))
+
+        if owner is not None and owner not in session.deleted:
+            objects.add(owner)
+
+    return objects
+
+
+def merge_into_session(rows, session=None):
+    """
+    Copies annotation objects loaded by the executor (with their loaded annotation values and tracks) into session
+    (database.db.session by default), without SQL statements. Objects with changes in the session (including changes
+    of their annotation values and tracks) are kept as they are, objects deleted in the session are left out.
+
+    :type rows: list of (entity.AnnotationObject, int, int)
+    :rtype: list of (entity.AnnotationObject, int, int)
+    """
+
+    if session is None:
+        session = database.db.session
+
+    changed_ids = changed_annotation_object_ids(session)
+    result = []
+
+    for annotation_object, first_frame, last_frame in rows:
+        existing = session.identity_map.get(sqlalchemy.inspect(annotation_object).key)
+
+        if existing is not None and existing in session.deleted:
+            continue
+
+        if existing is not None and annotation_object.id in changed_ids:
+            result.append((existing, existing.first_frame, existing.last_frame))
+        else:
+            result.append((session.merge(annotation_object, load=False), first_frame, last_frame))
+
+    return result
+
+
+def expire_unchanged(annotation_objects, keep_ids=(), session=None):
+    """
+    Expires annotation objects in session (database.db.session by default), so they and their loaded annotation values
+    can be garbage collected. Objects with changes (see changed_annotation_object_ids), objects with given IDs
+    (e.g. displayed objects, whose attributes would be loaded again) and objects not in session are kept.
+    Returns expired objects.
+
+    :type annotation_objects: list of entity.AnnotationObject
+    :type keep_ids: collection of int
+    :rtype: list of entity.AnnotationObject
+    """
+
+    if session is None:
+        session = database.db.session
+
+    keep_ids = changed_annotation_object_ids(session).union(keep_ids)
+    expired = []
+
+    for annotation_object in annotation_objects:
+        identity = sqlalchemy.inspect(annotation_object).identity
+
+        if annotation_object not in session or identity is None or identity[0] in keep_ids:
+            continue
+
+        session.expire(annotation_object)
+        expired.append(annotation_object)
+
+    return expired
+
+
+executor = DatabaseExecutor()
+
+logger.debug('Database executor instance created.')
@@ -0,0 +1,585 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Streaming export of database tables.
+
+    Rows are read with SQLAlchemy Core selects (no entities are created) using server-side cursors where the database
+    driver supports them, and written to the output one by one. Memory usage does not depend on the size of the database.
+"""
+
+import os
+import json
+import logging
+import datetime
+
+import sqlalchemy
+
+import entity
+import database
+import repository
+
+
+logger = logging.getLogger(__name__)
+logger.debug('Import ' + __name__)
+
+# columns stored encoded (column attribute starting with "_"), exported as decoded synonyms
+# (entity name, synonym) => function(encoded value, row, data_types)
+synonym_decoders = {
+    ('AnnotationAttribute', 'allowed_values'): lambda s, row, data_types: None if s is None else unicode(s).split('|'),
+    ('AnnotationObject', 'type'): lambda s, row, data_types: s,
+    ('AnnotationValue', 'value'): lambda s, row, data_types: entity.AnnotationValue.decode_value(s, data_types[row['annotation_attribute_id']]),
+}
+
+# columns of positional data types in .npy export (see export_video_arrays()), data type => (prefix, columns)
+positional_columns = {
+    u'position_rectangle': ('rectangle', ['x1', 'y1', 'x2', 'y2']),
+    u'position_circle': ('circle', ['x', 'y', 'r']),
+    u'position_point': ('point', ['x', 'y']),
+}
+
+
+def stream(q, batch_size=1000):
+    """
+    Executes select on its own connection and yields result rows in batches, with server-side cursor if possible.
+    Own connection is needed, several results are read in parallel (see export_rows()).
+
+    :rtype: iterator of sqlalchemy.engine.RowProxy
+    """
+
+    connection = database.db.engine.connect()
+
+    try:
+        result = connection.execution_options(stream_results=True).execute(q)
+
+        while True:
+            rows = result.fetchmany(batch_size)
+
+            if not rows:
+                break
+
+            for row in rows:
+                yield row
+    finally:
+        connection.close()
+
+def group_by_parent(rows):
+    """
+    Groups (parent_id, child_id) rows sorted by parent_id.
+
+    :rtype: iterator of (int, list of int)
+    """
+
+    parent_id = None
+    child_ids = []
+
+    for row in rows:
+        if row[0] != parent_id:
+            if parent_id is not None:
+                yield parent_id, child_ids
+
+            parent_id = row[0]
+            child_ids = []
+
+        child_ids.append(int(row[1]))
+
+    if parent_id is not None:
+        yield parent_id, child_ids
+
+def group_tracks(rows):
+    """
+    Groups (annotation_object_id, annotation_attribute_id, frame_from, encoded value) rows sorted by object and attribute
+    into tracks.
+
+    :rtype: iterator of ((int, int), list of (int, unicode))
+    """
+
+    track_key = None
+    keyframes = []
+
+    for annotation_object_id, annotation_attribute_id, frame_from, s in rows:
+        if (annotation_object_id, annotation_attribute_id) != track_key:
+            if track_key is not None:
+                yield track_key, keyframes
+
+            track_key = (annotation_object_id, annotation_attribute_id)
+            keyframes = []
+
+        keyframes.append((frame_from, s))
+
+    if track_key is not None:
+        yield track_key, keyframes
+
+def filters(entity_name, video_ids=None, custom_filter=None):
+    """
+    Returns where clauses for the table of given entity, see export_rows().
+
+    :rtype: list of sqlalchemy.sql.ClauseElement
+    """
+
+    table = getattr(entity, entity_name).__table__
+    clauses = []
+
+    if video_ids:
+        # add special filters to export only data related to given video(s)
+        if entity_name == 'Video':
+            clauses.append(table.c.id.in_(video_ids))
+        elif entity_name == 'Annotator':
+            t_bind = entity.table_bind_video_to_annotator
+            clauses.append(table.c.id.in_(sqlalchemy.select([t_bind.c.annotator_id]).where(t_bind.c.video_id.in_(video_ids))))
+        elif entity_name == 'AnnotationAttribute':
+            t_bind = entity.table_bind_video_to_annotation_attributes
+            clauses.append(table.c.id.in_(sqlalchemy.select([t_bind.c.annotation_attribute_id]).where(t_bind.c.video_id.in_(video_ids))))
+        elif entity_name == 'AnnotationObject':
+            clauses.append(table.c.video_id.in_(video_ids))
+        elif entity_name == 'AnnotationValue':
+            t_objects = entity.AnnotationObject.__table__
+            clauses.append(table.c.annotation_object_id.in_(sqlalchemy.select([t_objects.c.id]).where(t_objects.c.video_id.in_(video_ids))))
+        else:
+            raise Exception("Video filter is not supported for table '%s'" % (entity_name))
+
+    if custom_filter:
+        clauses.append(sqlalchemy.text(custom_filter))
+
+    return clauses
+
+def stream_tracks(video_ids=None, custom_filter=None, batch_size=1000):
+    """
+    Yields keyframes of packed tracks (see entity.AnnotationTrack), which are exported as LOCAL annotation values.
+    Custom filter is written for the annotation_values table, it cannot be applied to packed tracks.
+
+    :rtype: iterator of ((int, int), list of int, list of value) - (annotation object ID, annotation attribute ID), frames, values
+    """
+
+    t_tracks = entity.AnnotationTrack.__table__
+    t_objects = entity.AnnotationObject.__table__
+
+    q = sqlalchemy.select([t_tracks.c.annotation_object_id, t_tracks.c.annotation_attribute_id, t_tracks.c.frames, t_tracks.c.coordinates])
+
+    if video_ids:
+        q = q.where(t_tracks.c.annotation_object_id.in_(sqlalchemy.select([t_objects.c.id]).where(t_objects.c.video_id.in_(video_ids))))
+
+    q = q.order_by(t_tracks.c.annotation_object_id, t_tracks.c.annotation_attribute_id)
+
+    data_types = None
+
+    for annotation_object_id, annotation_attribute_id, frames, coordinates in stream(q, batch_size):
+        if custom_filter:
+            raise Exception("Custom filter cannot be applied to packed tracks, unpack them first (action 'tracks unpack')")
+
+        if data_types is None:
+            data_types = {aa.id: aa.data_type for aa in repository.annotation_attributes.get_all()}
+
+        frames, values = entity.AnnotationTrack.decode_keyframes(frames, coordinates, data_types[annotation_attribute_id])
+
+        yield (int(annotation_object_id), int(annotation_attribute_id)), frames, values
+
+def export_rows(entity_name, video_ids=None, custom_filter=None, batch_size=1000):
+    """
+    Yields rows of given entity's table as dicts, sorted by ID:
+        - columns, encoded columns are decoded (e.g. AnnotationValue.value)
+        - one-to-many and many-to-many relationships, as lists of IDs
+
+    IDs of each relationship are read by one query sorted by parent ID, which is read in parallel with the table.
+    Keyframes of packed tracks are appended after AnnotationValue rows, without ID (see stream_tracks()).
+
+    :param video_ids: export only data related to given videos
+    :param custom_filter: SQL condition, e.g. 'id>10'
+    :rtype: iterator of dict
+    """
+
+    mapper = sqlalchemy.inspect(getattr(entity, entity_name))
+    table = mapper.local_table
+    clauses = filters(entity_name, video_ids, custom_filter)
+
+    if entity_name == 'AnnotationValue':
+        data_types = {aa.id: aa.data_type for aa in repository.annotation_attributes.get_all()}
+    else:
+        data_types = None
+
+    # exported columns, encoded columns are replaced by synonyms
+    columns = []
+    decoders = {}
+
+    for column_property in mapper.column_attrs:
+        key = column_property.key
+
+        if key.startswith('_'):
+            if (entity_name, key[1:]) not in synonym_decoders:
+                continue
+
+            decoders[key[1:]] = synonym_decoders[(entity_name, key[1:])]
+            key = key[1:]
+
+        columns.append(column_property.columns[0].label(key))
+
+    q = sqlalchemy.select(columns).order_by(table.c.id)
+
+    for clause in clauses:
+        q = q.where(clause)
+
+    # IDs of exported rows, to limit relationship queries
+    q_ids = sqlalchemy.select([table.c.id])
+
+    for clause in clauses:
+        q_ids = q_ids.where(clause)
+
+    relationships = []
+
+    for relationship in mapper.relationships:
+        if relationship.direction.name == 'ONETOMANY':
+            parent_column = relationship.local_remote_pairs[0][1]
+            child_column = list(relationship.mapper.local_table.primary_key)[0]
+        elif relationship.direction.name == 'MANYTOMANY':
+            parent_column = relationship.synchronize_pairs[0][1]
+            child_column = relationship.secondary_synchronize_pairs[0][1]
+        else:
+            continue
+
+        q_relationship = sqlalchemy.select([parent_column, child_column])
+        q_relationship = q_relationship.where(parent_column.in_(q_ids))
+        q_relationship = q_relationship.order_by(parent_column, child_column)
+
+        groups = group_by_parent(stream(q_relationship, batch_size))
+        relationships.append([relationship.key, groups, next(groups, None)])
+
+    for row in stream(q, batch_size):
+        d = {}
+
+        for k, v in row.items():
+            # convert long to int
+            if type(v) is long:
+                v = int(v)
+
+            d[k] = v
+
+        for k, decoder in decoders.iteritems():
+            d[k] = decoder(d[k], d, data_types)
+
+        # merge relationships, both sorted by parent ID
+        for r in relationships:
+            key, groups, group = r
+
+            while group is not None and group[0] < d['id']:
+                group = next(groups, None)
+
+            r[2] = group
+
+            d[key] = group[1] if group is not None and group[0] == d['id'] else []
+
+        yield d
+
+    if entity_name == 'AnnotationValue':
+        # packed keyframes have only columns stored in the track
+        keys = [column.name for column in columns] + [r[0] for r in relationships]
+
+        for (annotation_object_id, annotation_attribute_id), frames, values in stream_tracks(video_ids, custom_filter, batch_size):
+            for frame, value in zip(frames, values):
+                d = dict.fromkeys(keys)
+                d.update({r[0]: [] for r in relationships})
+                d.update({'annotation_object_id': annotation_object_id, 'annotation_attribute_id': annotation_attribute_id,
+                          'frame_from': frame, 'value': value})
+
+                yield d
+
+def export_interpolated_rows(video_ids=None, custom_filter=None, batch_size=1000):
+    """
+    Yields values interpolated between LOCAL annotation values (keyframes) of each annotation object and attribute,
+    as dicts with annotation_object_id, annotation_attribute_id, frame_from, value and is_interpolated.
+    Keyframes are read sorted, only one track is held in memory. Packed tracks are interpolated after other values.
+
+    :rtype: iterator of dict
+    """
+
+    import numpy as np
+    from tovian.models import interpolation
+
+    table = entity.AnnotationValue.__table__
+    data_types = {aa.id: aa.data_type for aa in repository.annotation_attributes.get_all()}
+
+    q = sqlalchemy.select([table.c.annotation_object_id, table.c.annotation_attribute_id, table.c.frame_from, table.c.value])
+    q = q.where(table.c.frame_from != None)
+
+    for clause in filters('AnnotationValue', video_ids, custom_filter):
+        q = q.where(clause)
+
+    q = q.order_by(table.c.annotation_object_id, table.c.annotation_attribute_id, table.c.frame_from)
+
+    def interpolate(track_key, frames, values):
+        annotation_object_id, annotation_attribute_id = track_key
+        data_type = data_types[annotation_attribute_id]
+
+        for frame, value in interpolation.iterate_track(frames, values, data_type):
+            yield {
+                'annotation_object_id': int(annotation_object_id),
+                'annotation_attribute_id': int(annotation_attribute_id),
+                'frame_from': frame,
+                'value': value,
+                'is_interpolated': True
+            }
+
+    for track_key, keyframes in group_tracks(stream(q, batch_size)):
+        frames = [frame for frame, s in keyframes]
+        values = interpolation.decode_track([s for frame, s in keyframes], data_types[track_key[1]])
+
+        for d in interpolate(track_key, frames, values):
+            yield d
+
+    for track_key, frames, values in stream_tracks(video_ids, custom_filter, batch_size):
+        # packed tracks are positional, linearly interpolated
+        for d in interpolate(track_key, frames, np.array(values, dtype=np.float64).reshape(len(frames), -1)):
+            yield d
+
+def export_video_arrays(video_id, interpolated=False, batch_size=1000):
+    """
+    Returns annotation values of one video as columnar arrays (for export to NumPy .npy files), sorted by object,
+    attribute and frame:
+        - attribute_id, attribute_name, attribute_data_type: all annotation attributes
+        - object_id, object_type: annotation objects of the video
+        - rectangle_*, circle_*, point_*: positional values, with columns object_id, attribute_id, frame, is_interpolated
+          and coordinates x1, y1, x2, y2 (rectangle), x, y, r (circle), x, y (point)
+        - values_*: other values, with columns object_id, attribute_id, frame (-1 for global values), is_interpolated
+          and code, which is an index into values_dictionary (encoded values, see AnnotationValue.encode_value())
+
+    :param interpolated: include values interpolated between keyframes
+    :rtype: dict of str => numpy.ndarray
+    """
+
+    import numpy as np
+    from tovian.models import interpolation
+
+    t_attributes = entity.AnnotationAttribute.__table__
+    t_objects = entity.AnnotationObject.__table__
+    t_values = entity.AnnotationValue.__table__
+
+    attributes = list(stream(sqlalchemy.select([t_attributes.c.id, t_attributes.c.name, t_attributes.c.data_type]).order_by(t_attributes.c.id)))
+    objects = list(stream(sqlalchemy.select([t_objects.c.id, t_objects.c.type]).where(t_objects.c.video_id == video_id).order_by(t_objects.c.id)))
+
+    data_types = {row[0]: row[2] for row in attributes}
+
+    arrays = {
+        'attribute_id': np.array([row[0] for row in attributes], dtype=np.int64),
+        'attribute_name': np.array([row[1] for row in attributes], dtype=np.unicode_),
+        'attribute_data_type': np.array([row[2] for row in attributes], dtype=np.unicode_),
+        'object_id': np.array([row[0] for row in objects], dtype=np.int64),
+        'object_type': np.array([row[1] for row in objects], dtype=np.unicode_),
+    }
+
+    # tracks of positional values, data type => list of (object_id, attribute_id, frame, is_interpolated, coordinates)
+    positions = {data_type: [] for data_type in positional_columns}
+
+    # non-positional values, encoded values are replaced by codes from the dictionary
+    values = []
+    dictionary = {}
+
+    q = sqlalchemy.select([t_values.c.annotation_object_id, t_values.c.annotation_attribute_id, t_values.c.frame_from, t_values.c.value])
+    q = q.where(t_values.c.annotation_object_id.in_(sqlalchemy.select([t_objects.c.id]).where(t_objects.c.video_id == video_id)))
+    q = q.order_by(t_values.c.annotation_object_id, t_values.c.annotation_attribute_id, t_values.c.frame_from)
+
+    def add_positions(annotation_object_id, annotation_attribute_id, data_type, frames, coordinates):
+        is_interpolated = np.zeros(len(frames), dtype=np.bool_)
+
+        if interpolated:
+            frames_interpolated, coordinates_interpolated = interpolation.interpolate_track(frames, coordinates, data_type)
+
+            frames = np.concatenate((frames, frames_interpolated))
+            coordinates = np.concatenate((coordinates, coordinates_interpolated))
+            is_interpolated = np.concatenate((is_interpolated, np.ones(len(frames_interpolated), dtype=np.bool_)))
+
+            order = np.argsort(frames, kind='mergesort')
+            frames, coordinates, is_interpolated = frames[order], coordinates[order], is_interpolated[order]
+
+        positions[data_type].append((np.full(len(frames), annotation_object_id, dtype=np.int64),
+                                     np.full(len(frames), annotation_attribute_id, dtype=np.int64),
+                                     frames, is_interpolated, coordinates))
+
+    for (annotation_object_id, annotation_attribute_id), keyframes in group_tracks(stream(q, batch_size)):
+        data_type = data_types[annotation_attribute_id]
+
+        local_keyframes = [(frame, s) for frame, s in keyframes if frame is not None]
+        frames = np.array([frame for frame, s in local_keyframes], dtype=np.int64)
+
+        if data_type in positional_columns:
+            coordinates = interpolation.decode_track([s for frame, s in local_keyframes], data_type)
+            add_positions(annotation_object_id, annotation_attribute_id, data_type, frames, coordinates)
+            continue
+
+        # global values first (frame -1), then local values sorted by frame
+        track = [(-1, s, False) for frame, s in keyframes if frame is None]
+        track.extend((frame, s, False) for frame, s in local_keyframes)
+
+        if interpolated and len(local_keyframes) > 1:
+            track_values = interpolation.decode_track([s for frame, s in local_keyframes], data_type)
+
+            for frame, value in interpolation.iterate_track(frames, track_values, data_type):
+                track.append((frame, entity.AnnotationValue.encode_value(value, data_type), True))
+
+            track.sort(key=lambda v: v[0])
+
+        for frame, s, is_interpolated in track:
+            if s not in dictionary:
+                dictionary[s] = len(dictionary)
+
+            values.append((annotation_object_id, annotation_attribute_id, frame, is_interpolated, dictionary[s]))
+
+    # packed tracks (see entity.AnnotationTrack)
+    for (annotation_object_id, annotation_attribute_id), frames, coordinates in stream_tracks([video_id], batch_size=batch_size):
+        data_type = data_types[annotation_attribute_id]
+
+        add_positions(annotation_object_id, annotation_attribute_id, data_type,
+                      np.array(frames, dtype=np.int64), np.array(coordinates, dtype=np.float64).reshape(len(frames), -1))
+
+    for data_type, (prefix, columns) in positional_columns.iteritems():
+        tracks = positions[data_type]
+
+        if len(tracks):
+            object_ids, attribute_ids, frames, is_interpolated, coordinates = [np.concatenate(column) for column in zip(*tracks)]
+
+            # packed tracks are appended after other values
+            order = np.lexsort((frames, attribute_ids, object_ids))
+            object_ids, attribute_ids, frames, is_interpolated, coordinates = [column[order] for column in (object_ids, attribute_ids, frames, is_interpolated, coordinates)]
+        else:
+            object_ids, attribute_ids, frames = [np.zeros(0, dtype=np.int64) for i in range(3)]
+            is_interpolated = np.zeros(0, dtype=np.bool_)
+            coordinates = np.zeros((0, len(columns)), dtype=np.float64)
+
+        arrays[prefix + '_object_id'] = object_ids
+        arrays[prefix + '_attribute_id'] = attribute_ids
+        arrays[prefix + '_frame'] = frames
+        arrays[prefix + '_is_interpolated'] = is_interpolated
+
+        for i, column in enumerate(columns):
+            # radius is the only real number
+            arrays[prefix + '_' + column] = coordinates[:, i] if column == 'r' else coordinates[:, i].astype(np.int32)
+
+    arrays['values_object_id'] = np.array([v[0] for v in values], dtype=np.int64)
+    arrays['values_attribute_id'] = np.array([v[1] for v in values], dtype=np.int64)
+    arrays['values_frame'] = np.array([v[2] for v in values], dtype=np.int64)
+    arrays['values_is_interpolated'] = np.array([v[3] for v in values], dtype=np.bool_)
+    arrays['values_code'] = np.array([v[4] for v in values], dtype=np.int32)
+    arrays['values_dictionary'] = np.array(sorted(dictionary, key=dictionary.get), dtype=np.unicode_)
+
+    return arrays
+
+def write_npy(video_ids, output_dir, interpolated=False):
+    """
+    Writes arrays of each video (see export_video_arrays()) into a separate directory "video_<id>" in output_dir,
+    one file "<array name>.npy" per array, so they can be memory-mapped by numpy.load(path, mmap_mode='r').
+    Returns paths of written directories.
+
+    :rtype: list of str
+    """
+
+    import numpy as np
+
+    paths = []
+
+    for video_id in video_ids:
+        path = os.path.join(output_dir, 'video_%d' % (video_id))
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name, array in export_video_arrays(video_id, interpolated=interpolated).iteritems():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+        logger.info("Video %d was exported to %s" % (video_id, path))
+
+        paths.append(path)
+
+    return paths
+
+def write_json(tables, fw):
+    """
+    Writes tables to the file as one JSON object, row by row.
+
+    :param tables: list of (table name, iterator of dict)
+    """
+
+    # datetime objects cannot be serialized by default
+    dthandler = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
+
+    fw.write('{')
+
+    for i, (table_name, rows) in enumerate(tables):
+        if i > 0:
+            fw.write(', ')
+
+        fw.write(json.dumps(table_name) + ': [')
+
+        for j, row in enumerate(rows):
+            if j > 0:
+                fw.write(', ')
+
+            fw.write(json.dumps(row, default=dthandler))
+
+        fw.write(']')
+
+    fw.write('}\n')
+
+def write_yaml(tables, fw):
+    """
+    Writes tables to the file as one YAML mapping, row by row.
+
+    :param tables: list of (table name, iterator of dict)
+    """
+
+    import yaml
+
+    for table_name, rows in tables:
+        fw.write(table_name.encode('utf8') + ':')
+
+        is_empty = True
+
+        for row in rows:
+            if is_empty:
+                fw.write('\n')
+                is_empty = False
+
+            # one item sequence, it is written in the same (block) style as the sequence of all rows
+            yaml.safe_dump([row], fw, allow_unicode=True, indent=4, width=1000)
+
+        if is_empty:
+            fw.write(' []\n')
+
+def write_csv(tables, fw):
+    """
+    Writes each table to the file as CSV, with table name and header (taken from the first row) before rows.
+
+    :param tables: list of (table name, iterator of dict)
+    """
+
+    import csv
+
+    for table_name, rows in tables:
+        fw.write(table_name.encode('utf8') + '\r\n')
+
+        dict_writer = None
+
+        for row in rows:
+            if dict_writer is None:
+                keys = sorted(row.keys())
+
+                # encode all strings to utf8
+                dict_writer = csv.DictWriter(fw, [v.encode('utf8') for v in keys])
+                dict_writer.writer.writerow([v.encode('utf8') for v in keys])
+
+            dict_writer.writerow({k: unicode(v).encode('utf8') if isinstance(v, basestring) else v for k, v in row.iteritems()})
+
+        fw.write('\r\n')
+
+def write_print(tables, fw):
+    """
+    Writes tables in human readable form, row by row.
+
+    :param tables: list of (table name, iterator of dict)
+    """
+
+    import pprint
+
+    for table_name, rows in tables:
+        fw.write(table_name.encode('utf8') + ':\n')
+
+        for row in rows:
+            pprint.pprint(row, fw)
+
+        fw.write('\n')
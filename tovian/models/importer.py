@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Streaming import of annotations from large files.
+
+    Annotation objects are read from the input one at a time (see iterate_json_annotations()), and inserted directly
+    into database in chunks, without creating AnnotationObject and AnnotationValue entities (see import_annotations()).
+"""
+
+import os
+import json
+import logging
+import time
+from collections import defaultdict, namedtuple
+
+import sqlalchemy
+
+import entity
+import database
+import repository
+
+
+logger = logging.getLogger(__name__)
+logger.debug('Import ' + __name__)
+
+checkpoint_log_type = u'import.checkpoint'
+
+# keyframe of positional attribute for entity.AnnotationValue.simplify(), row is the inserted values row
+Keyframe = namedtuple('Keyframe', ['frame_from', 'value', 'annotation_attribute', 'annotation_object', 'row'])
+
+
+class JsonStreamReader():
+    """
+    Incremental reader of JSON file, values are decoded one by one, only a small part of the file is held in memory.
+    """
+
+    whitespace = ' \t\n\r'
+
+    def __init__(self, fr, read_size=1024 * 1024):
+        self.fr = fr
+        self.read_size = read_size
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def read(self, size):
+        """
+        Appends next data from file to the buffer, already processed data are discarded.
+        """
+
+        data = self.fr.read(size)
+
+        if not data:
+            self.eof = True
+
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+
+    def skip_whitespace(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.whitespace:
+                self.position += 1
+
+            if self.position < len(self.buffer) or self.eof:
+                return
+
+            self.read(self.read_size)
+
+    def peek(self):
+        """
+        Returns next non-whitespace character, without consuming it. Returns None at the end of file.
+        """
+
+        self.skip_whitespace()
+
+        if self.position >= len(self.buffer):
+            return None
+
+        return self.buffer[self.position]
+
+    def expect(self, characters):
+        """
+        Consumes next non-whitespace character, which has to be one of given characters.
+        """
+
+        c = self.peek()
+
+        if c is None or c not in characters:
+            raise Exception('Invalid JSON: expected one of "%s", found "%s"' % (characters, c))
+
+        self.position += 1
+
+        return c
+
+    def decode(self):
+        """
+        Decodes and consumes next JSON value.
+        """
+
+        self.skip_whitespace()
+
+        read_size = self.read_size
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                # value is incomplete, read more data (read size grows, not to decode large values repeatedly)
+                if self.eof:
+                    raise
+
+                self.read(read_size)
+                read_size *= 2
+                continue
+
+            # numbers and literals can be cut at the end of buffer, they must be followed by some other character
+            if end == len(self.buffer) and not self.eof and self.buffer[self.position] not in '{["':
+                self.read(read_size)
+                continue
+
+            self.position = end
+
+            return value
+
+def iterate_json_annotations(fr):
+    """
+    Iterates over annotation objects in JSON file, which has the same structure as for Video.import_annotations(),
+    grouped by videos:
+        {"video name or filename": [{annotation object}, ...], ...}
+
+    :rtype: iterator of (unicode, int, dict) - video name or filename, index of the object within the video, annotation object
+    """
+
+    reader = JsonStreamReader(fr)
+
+    reader.expect('{')
+
+    if reader.peek() == '}':
+        return
+
+    while True:
+        video_name = reader.decode()
+
+        reader.expect(':')
+        reader.expect('[')
+
+        i = 0
+
+        if reader.peek() != ']':
+            while True:
+                yield video_name, i, reader.decode()
+
+                i += 1
+
+                if reader.expect(',]') == ']':
+                    break
+        else:
+            reader.expect(']')
+
+        if reader.expect(',}') == '}':
+            break
+
+def iterate_annotations(data):
+    """
+    Iterates over annotation objects already loaded in memory (e.g. from YAML), see iterate_json_annotations().
+
+    :type data: dict of video name or filename => list of annotation objects
+    :rtype: iterator of (unicode, int, dict)
+    """
+
+    for video_name, aos_data in data.iteritems():
+        for i, data_object in enumerate(aos_data):
+            yield video_name, i, data_object
+
+def file_fingerprint(path):
+    """
+    Size and modification time of the imported file. Checkpoint stored for the file is not resumed, when the file
+    is changed (see load_checkpoint()).
+
+    :rtype: dict
+    """
+
+    stat = os.stat(path)
+
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+def find_checkpoint(checkpoint):
+    """
+    Returns ID and decoded value of the log record with given checkpoint name (see save_checkpoint()).
+    Records are kept only for unfinished imports, so there are few of them.
+
+    :type checkpoint: unicode
+    :rtype: (int, dict) or (None, None)
+    """
+
+    q = database.db.session.query(entity.Log.id, entity.Log.value)
+    q = q.filter(entity.Log.type == checkpoint_log_type)
+
+    for log_id, value in q:
+        data = json.loads(value)
+
+        if data['checkpoint'] == checkpoint:
+            return log_id, data
+
+    return None, None
+
+def load_checkpoint(checkpoint, fingerprint=None):
+    """
+    Returns numbers of already imported annotation objects for each video, stored by previous interrupted import
+    with the same checkpoint name (see save_checkpoint()). Checkpoint stored with a different fingerprint of the input
+    (e.g. a changed file, see file_fingerprint()) is not resumed.
+
+    :type checkpoint: unicode
+    :type fingerprint: dict
+    :rtype: dict of video name => int
+    """
+
+    if checkpoint is None:
+        return {}
+
+    log_id, data = find_checkpoint(checkpoint)
+
+    if data is None:
+        return {}
+
+    if data.get('fingerprint') != fingerprint:
+        logger.warning("Input of import %s was changed since it was interrupted, it is imported from the beginning." % (checkpoint))
+        return {}
+
+    return data['imported']
+
+def save_checkpoint(checkpoint, imported, fingerprint=None):
+    """
+    Stores numbers of imported annotation objects for each video into the logs table, one record per checkpoint name
+    is updated. The record is written in the current transaction, so it is committed together with the imported chunk.
+
+    :type checkpoint: unicode
+    :type imported: dict of video name => int
+    :type fingerprint: dict
+    """
+
+    log_id, data = find_checkpoint(checkpoint)
+    value = unicode(json.dumps({'checkpoint': checkpoint, 'fingerprint': fingerprint, 'imported': imported}))
+
+    table = entity.Log.__table__
+
+    if log_id is None:
+        database.db.session.execute(table.insert(), {'type': checkpoint_log_type, 'value': value})
+    else:
+        database.db.session.execute(table.update().where(table.c.id == log_id), {'value': value})
+
+def clear_checkpoint(checkpoint):
+    """
+    Deletes the checkpoint of finished import in the current transaction.
+
+    :type checkpoint: unicode
+    """
+
+    log_id, data = find_checkpoint(checkpoint)
+
+    if log_id is not None:
+        table = entity.Log.__table__
+        database.db.session.execute(table.delete().where(table.c.id == log_id))
+
+def import_annotations(items, annotator=None, chunk_size=1000, checkpoint=None, fingerprint=None, simplify_tolerance=None,
+                       simplify_stats=None):
+    """
+    Imports annotation objects and their annotation values, see Video.import_annotations() for structure of annotation objects.
+    Returns number of newly imported annotation objects.
+
+    Objects are inserted in chunks and each chunk is committed. IDs of annotation objects of the chunk are allocated
+    as one block after the highest existing ID, objects and values of the whole chunk are inserted with two "executemany"
+    statements.
+
+    When checkpoint name is given, numbers of imported objects are stored in the same transaction as each chunk
+    (see save_checkpoint()). Interrupted import with the same input (the same fingerprint, see file_fingerprint())
+    and checkpoint name continues where it stopped.
+
+    When simplify_tolerance is given, keyframes of positional attributes reproduced by interpolation within the tolerance
+    (in pixels) are not imported, see entity.AnnotationValue.simplify(). Number of removed keyframes and maximum error
+    are stored into simplify_stats dict (keys 'removed' and 'max_error'), when given.
+
+    :param items: annotation objects, see iterate_json_annotations()
+    :type items: iterator of (unicode, int, dict)
+    :type annotator: entity.Annotator
+    :rtype: int
+    """
+
+    imported = load_checkpoint(checkpoint, fingerprint)
+
+    if len(imported):
+        logger.info("Resuming import from checkpoint: %s" % (', '.join('%s: %d objects' % (k, v) for k, v in imported.iteritems())))
+
+    videos_cache = {}
+    annotation_attributes_cache = {}
+
+    chunk = []
+    count = 0
+
+    if simplify_stats is None:
+        simplify_stats = {}
+
+    simplify_stats.update({'removed': 0, 'max_error': 0.0})
+
+    t0 = time.time()
+
+    def insert_chunk():
+        # progress is committed together with the chunk, interrupted import never inserts the chunk twice
+        # (written first, on SQLite it takes the write lock, so no other writer can insert objects before the chunk)
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, imported, fingerprint)
+
+        # block of IDs after the highest existing one, the row is locked on MySQL (concurrent imports wait)
+        table = entity.AnnotationObject.__table__
+        max_id = database.db.session.execute(sqlalchemy.select([sqlalchemy.func.max(table.c.id)], for_update=True)).scalar()
+        next_id = (max_id or 0) + 1
+
+        objects = []
+        values = []
+
+        for video, data_object in chunk:
+            if data_object['type'] not in entity.AnnotationObject.allowed_annotation_types:
+                raise Exception('Unsupported annotation type: %s' % (data_object['type']))
+
+            frames = []
+
+            # keyframes of positional attributes to simplify
+            keyframes = defaultdict(list)
+
+            object_values = []
+
+            for data_av in data_object['annotation_values']:
+                aa_name = data_av[0]
+
+                if aa_name not in annotation_attributes_cache:
+                    annotation_attributes_cache[aa_name] = repository.annotation_attributes.get_one_by_name(aa_name)
+
+                annotation_attribute = annotation_attributes_cache[aa_name]
+
+                if annotation_attribute is None:
+                    raise Exception('Annotation attribute not found: %s' % (aa_name))
+
+                if annotation_attribute.annotation_object_type != data_object['type']:
+                    raise Exception("Annotation object type and annotation attribute's annotation object type mismatch (%s, %s)" % (
+                        data_object['type'], annotation_attribute.annotation_object_type))
+
+                if annotation_attribute.is_global:
+                    frame_from = None
+                    value = data_av[1]
+                else:
+                    frame_from = data_av[1]
+                    value = data_av[2]
+                    frames.append(frame_from)
+
+                row = {
+                    'annotation_attribute_id': annotation_attribute.id,
+                    'created_by_id': annotator.id if annotator is not None else None,
+                    'frame_from': frame_from,
+                    'value': entity.AnnotationValue.encode_value(value, annotation_attribute.data_type)
+                }
+
+                object_values.append(row)
+
+                if simplify_tolerance is not None and frame_from is not None \
+                        and annotation_attribute.data_type in entity.AnnotationValue.simplified_data_types:
+                    keyframes[annotation_attribute].append(Keyframe(frame_from, value, annotation_attribute, None, row))
+
+            removed_rows = set()
+
+            for annotation_attribute, attribute_keyframes in keyframes.iteritems():
+                attribute_keyframes.sort(key=lambda keyframe: keyframe.frame_from)
+
+                kept, removed, error = entity.AnnotationValue.simplify(attribute_keyframes, simplify_tolerance)
+
+                removed_rows.update(id(keyframe.row) for keyframe in removed)
+                simplify_stats['removed'] += len(removed)
+                simplify_stats['max_error'] = max(simplify_stats['max_error'], error)
+
+            annotation_object_id = next_id + len(objects)
+
+            objects.append({
+                'id': annotation_object_id,
+                'type': data_object['type'],
+                'public_comment': data_object.get('public_comment'),
+                'video_id': video.id,
+                'created_by_id': annotator.id if annotator is not None else None,
+                'modified_by_id': annotator.id if annotator is not None else None,
+                'first_frame': min(frames) if len(frames) else None,
+                'last_frame': max(frames) if len(frames) else None,
+            })
+
+            for row in object_values:
+                if id(row) not in removed_rows:
+                    row['annotation_object_id'] = annotation_object_id
+                    values.append(row)
+
+        database.db.session.execute(table.insert(), objects)
+
+        if len(values):
+            database.db.session.execute(entity.AnnotationValue.__table__.insert(), values)
+
+        database.db.session.commit()
+
+        # values were inserted without the ORM
+        entity.reset_value_dictionaries()
+
+        logger.info("Imported %d annotation objects with %d values, %d objects in total. (%1.2f objects/s)" % (
+            len(objects), len(values), count, count / (time.time() - t0)))
+
+        del chunk[:]
+
+    for video_name, i, data_object in items:
+        if i < imported.get(video_name, 0):
+            # already imported before the interruption
+            continue
+
+        if video_name not in videos_cache:
+            # name can be video's name or filename, try to select by both
+            videos_cache[video_name] = repository.videos.get_one(video_name)
+
+            if videos_cache[video_name] is None:
+                raise Exception('Video with name or filename not found: %s' % (video_name))
+
+        chunk.append((videos_cache[video_name], data_object))
+        imported[video_name] = i + 1
+        count += 1
+
+        if len(chunk) >= chunk_size:
+            insert_chunk()
+
+    if len(chunk):
+        insert_chunk()
+
+    if checkpoint is not None:
+        clear_checkpoint(checkpoint)
+        database.db.session.commit()
+
+    if simplify_tolerance is not None:
+        logger.info("Simplification removed %d keyframes, maximum error %1.2f px." % (simplify_stats['removed'], simplify_stats['max_error']))
+
+    return count
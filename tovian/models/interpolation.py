@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Vectorized interpolation of annotation value tracks, using NumPy.
+
+    A track is a list of keyframes (local annotation values) of one annotation object and one annotation attribute.
+    Values in all frames between the keyframes are computed at once, with the same results as AnnotationValue.interpolate(),
+    but without creating AnnotationValue instances.
+"""
+
+import logging
+import numpy as np
+
+import entity
+
+
+logger = logging.getLogger(__name__)
+logger.debug('Import ' + __name__)
+
+# data types interpolated linearly, with number of value components
+linear_data_types = {
+    u'int': 1,
+    u'float': 1,
+    u'position_rectangle': 4,
+    u'position_circle': 3,
+    u'position_point': 2,
+}
+
+# data types where the value of the previous keyframe is held until the next keyframe
+hold_data_types = [u'bool', u'unicode', u'position_nonvisual']
+
+
+def decode_track(encoded_values, data_type):
+    """
+    Decodes values of keyframes (as stored in database) into an array suitable for interpolate_track().
+
+    :param encoded_values: list of encoded values (AnnotationValue._value)
+    :rtype: numpy.ndarray, shape (n, components) of float for linearly interpolated data types, shape (n,) of object otherwise
+    """
+
+    if data_type in linear_data_types:
+        components = linear_data_types[data_type]
+
+        if components == 1:
+            values = np.array([float(s) for s in encoded_values], dtype=np.float64)
+        else:
+            values = np.array([s.split(',') for s in encoded_values], dtype=np.float64)
+
+        return values.reshape(len(encoded_values), components)
+
+    if data_type in hold_data_types:
+        values = np.empty(len(encoded_values), dtype=object)
+        values[:] = [entity.AnnotationValue.decode_value(s, data_type) for s in encoded_values]
+
+        return values
+
+    raise Exception('Unsupported data_type for interpolation: %s' % (data_type))
+
+def interpolate_track(frames, values, data_type):
+    """
+    Interpolates values in all frames between the first and the last keyframe, which are not keyframes.
+
+    :param frames: frames of keyframes, sorted, without duplicates
+    :type frames: numpy.ndarray, shape (n,)
+    :param values: values of keyframes, see decode_track()
+    :type values: numpy.ndarray
+    :returns: interpolated frames and values (same layout as the input values)
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+
+    frames = np.asarray(frames, dtype=np.int64)
+
+    if len(frames) < 2:
+        return np.empty(0, dtype=np.int64), values[:0]
+
+    # all frames in between, without keyframes
+    frames_all = np.arange(frames[0], frames[-1] + 1, dtype=np.int64)
+    frames_interpolated = frames_all[~np.in1d(frames_all, frames)]
+
+    # index of the nearest keyframe before each interpolated frame
+    before = np.searchsorted(frames, frames_interpolated, side='right') - 1
+
+    if data_type in hold_data_types:
+        # result value is same as the "before" value, "after" value is ignored
+        return frames_interpolated, values[before]
+
+    if data_type not in linear_data_types:
+        raise Exception('Unsupported data_type for interpolation: %s' % (data_type))
+
+    after = before + 1
+
+    t1 = frames[before].astype(np.float64)[:, np.newaxis]
+    t2 = frames[after].astype(np.float64)[:, np.newaxis]
+    x = frames_interpolated.astype(np.float64)[:, np.newaxis]
+    v1 = values[before]
+    v2 = values[after]
+
+    # same formula (and order of operations) as AnnotationValue.interpolate_float()
+    v = (v2 - v1) / (t2 - t1) * (x - t1) + v1
+
+    if data_type == u'int':
+        v = np.trunc(v)
+    elif data_type == u'position_rectangle':
+        v = np.trunc(v)
+
+        # sort x and y coordinates, as AnnotationValue.encode_value() does
+        v = np.column_stack((np.minimum(v[:, 0], v[:, 2]), np.minimum(v[:, 1], v[:, 3]),
+                             np.maximum(v[:, 0], v[:, 2]), np.maximum(v[:, 1], v[:, 3])))
+    elif data_type == u'position_circle':
+        v = np.column_stack((np.trunc(v[:, 0]), np.trunc(v[:, 1]), np.round(v[:, 2], 2)))
+    elif data_type == u'position_point':
+        v = np.trunc(v)
+
+    return frames_interpolated, v
+
+def iterate_track(frames, values, data_type):
+    """
+    Interpolates the track (see interpolate_track()) and returns interpolated values converted to python types,
+    the same as returned by AnnotationValue.value.
+
+    :rtype: iterator of (int, value)
+    """
+
+    frames_interpolated, values_interpolated = interpolate_track(frames, values, data_type)
+
+    frames_interpolated = frames_interpolated.tolist()
+
+    if data_type in hold_data_types:
+        return iter(zip(frames_interpolated, values_interpolated.tolist()))
+
+    if data_type == u'int':
+        values_interpolated = [int(v) for v in values_interpolated[:, 0].tolist()]
+    elif data_type == u'float':
+        values_interpolated = values_interpolated[:, 0].tolist()
+    elif data_type == u'position_circle':
+        values_interpolated = [(int(x), int(y), r) for x, y, r in values_interpolated.tolist()]
+    else:
+        values_interpolated = [tuple(int(c) for c in v) for v in values_interpolated.tolist()]
+
+    return iter(zip(frames_interpolated, values_interpolated))
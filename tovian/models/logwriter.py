@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Background writer of log records (see repository.Logs).
+
+    Records are put into a bounded queue, without waiting for the database. A daemon thread encodes their values to JSON
+    and inserts them in batches, using its own database engine (the shared engine does not allow parallel calls
+    from more threads, see database.Database).
+"""
+
+import time
+import json
+import locale
+import datetime
+import atexit
+import logging
+import threading
+import Queue
+
+import sqlalchemy
+
+import entity
+import database
+
+
+logger = logging.getLogger(__name__)
+logger.debug('Import ' + __name__)
+
+
+class FlushMarker():
+    """
+    Queue item put by LogWriter.flush(), set when all records put before it are written.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class LogWriter():
+    """
+    Log records are inserted in batches of at most batch_size records, at most interval seconds after the first record
+    of the batch was put. When the queue is full, new records are dropped and counted (see dropped).
+    """
+
+    def __init__(self, max_queue_size=10000, batch_size=100, interval=0.5):
+        self.queue = Queue.Queue(max_queue_size)
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.execution_number = None
+        self.engine = None
+        self.opened_url = None
+        self.thread = None
+
+        # counters of records
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        """
+        Starts the writing thread (if not started yet).
+        """
+
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.run, name='LogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+        # records still in the queue are written before the interpreter exits
+        atexit.register(self.flush, 10)
+
+    def put(self, row):
+        """
+        Enqueues one record (dict of columns of entity.Log, without execution_number), value is any data encoded to JSON
+        by the writing thread. Never blocks.
+        """
+
+        try:
+            self.queue.put_nowait(row)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=None):
+        """
+        Waits until all records put before are written. Returns False on timeout.
+
+        :rtype: bool
+        """
+
+        if self.thread is None or not self.thread.is_alive():
+            return self.queue.empty()
+
+        marker = FlushMarker()
+
+        # marker is not dropped when the queue is full
+        self.queue.put(marker)
+
+        return marker.done.wait(timeout)
+
+    def run(self):
+        while True:
+            batch = []
+            markers = []
+            deadline = None
+
+            while len(batch) < self.batch_size:
+                try:
+                    if deadline is None:
+                        # wait for the first record
+                        item = self.queue.get()
+                        deadline = time.time() + self.interval
+                    else:
+                        item = self.queue.get(timeout=max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+
+                if isinstance(item, FlushMarker):
+                    # flush() was called, write immediately
+                    markers.append(item)
+                    break
+
+                batch.append(item)
+
+            if len(batch):
+                self.write(batch)
+
+            for marker in markers:
+                marker.done.set()
+
+    def write(self, batch):
+        try:
+            url = str(database.db.engine.url)
+
+            if self.opened_url != url:
+                # database was opened (again) with another url, execution number is counted in the new database
+                if self.engine is not None:
+                    self.engine.dispose()
+
+                self.engine = database.db.create_engine(url)
+                self.opened_url = url
+                self.execution_number = None
+
+            if self.execution_number is None:
+                last = self.engine.execute(sqlalchemy.select([sqlalchemy.func.max(entity.Log.__table__.c.execution_number)])).scalar()
+                self.execution_number = (last or 0) + 1
+
+            for row in batch:
+                row['value'] = self.encode(row['value'])
+                row['execution_number'] = self.execution_number
+
+            self.engine.execute(entity.Log.__table__.insert(), batch)
+
+            self.written += len(batch)
+        except Exception:
+            logger.exception("Error when writing %d log records" % (len(batch)))
+            self.failed += len(batch)
+
+    @staticmethod
+    def encode(value):
+        """
+        :rtype: unicode
+        """
+
+        dthandler = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
+
+        return unicode(json.dumps(value, default=dthandler, encoding=locale.getdefaultlocale()[1] or 'utf-8'))
@@ -6,17 +6,96 @@
 
 import entity
 import database
+import logwriter
 import sqlalchemy
 import logging
-import datetime
-import json
-import locale
+import time
+
+from sqlalchemy import event
 
 
 logger = logging.getLogger(__name__)
 logger.debug('Import ' + __name__)
 
 
+class LookupCache():
+    """
+    Cache of reference entities (annotators, videos, annotation attributes) found by get_one() of repositories,
+    by entity class and lookup key (ID, name, email or filename). Entries expire after ttl seconds. All entries are
+    invalidated when some cached entity is changed or deleted in the session, and can be invalidated explicitly by invalidate().
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, cls, key):
+        """
+        :rtype: entity or None
+        """
+
+        try:
+            expires, o = self.entries[(cls, key)]
+        except KeyError:
+            return None
+
+        # expired entry, or entity from another (closed) session, or already deleted
+        if expires < time.time() or sqlalchemy.orm.object_session(o) is not database.db.session or o in database.db.session.deleted:
+            del self.entries[(cls, key)]
+            return None
+
+        return o
+
+    def set(self, cls, key, o):
+        self.entries[(cls, key)] = (time.time() + self.ttl, o)
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def get_one(self, cls, value, columns):
+        """
+        Returns one entity, whose column (the first one in given order) equals to value, or None.
+        Entities matching any column are selected by one query, results are cached.
+
+        :param columns: names of columns, "id" column is compared only with integer values
+        :type columns: list of str
+        """
+
+        key = unicode(value)
+
+        o = self.get(cls, key)
+
+        if o is not None:
+            return o
+
+        criteria = []
+
+        for column in columns:
+            if column == 'id':
+                try:
+                    criteria.append((column, int(key)))
+                except ValueError:
+                    pass
+            else:
+                criteria.append((column, key))
+
+        q = database.db.session.query(cls)
+        q = q.filter(sqlalchemy.or_(*[getattr(cls, column) == v for column, v in criteria]))
+
+        rows = q.all()
+
+        for column, v in criteria:
+            matches = [row for row in rows if getattr(row, column) == v]
+
+            # ambiguous values are skipped
+            if len(matches) == 1:
+                self.set(cls, key, matches[0])
+
+                return matches[0]
+
+        return None
+
+
 class Annotators():
     def get_all(self):
         """
@@ -39,36 +118,12 @@ class Annotators():
 
     def get_one(self, email_name_id):
         """
-        Try to find one user by email, name or ID
+        Try to find one user by email, name or ID (in this order), results are cached (see LookupCache)
 
         :rtype: entity.Annotator or None
         """
 
-        try:
-            o = self.get_one_by_email(unicode(email_name_id))
-
-            if o:
-                return o
-        except:
-            pass
-
-        try:
-            o = self.get_one_by_name(unicode(email_name_id))
-
-            if o:
-                return o
-        except:
-            pass
-
-        try:
-            o = self.get_one_by_id(int(email_name_id))
-
-            if o:
-                return o
-        except:
-            pass
-
-        return None
+        return lookup_cache.get_one(entity.Annotator, email_name_id, ['email', 'name', 'id'])
 
     def get_one_by_id(self, id):
         """
@@ -187,36 +242,12 @@ class Videos():
 
     def get_one(self, filename_name_id):
         """
-        Try to find one video by filename, name or ID
+        Try to find one video by filename, name or ID (in this order), results are cached (see LookupCache)
 
         :rtype: entity.Video or None
         """
 
-        try:
-            o = self.get_one_by_filename(unicode(filename_name_id))
-
-            if o:
-                return o #or self.get_one_by_name(unicode(filename_name_id)) or self.get_one_by_id(int(filename_name_id))
-        except:
-            pass
-
-        try:
-            o = self.get_one_by_name(unicode(filename_name_id))
-
-            if o:
-                return o
-        except:
-            pass
-
-        try:
-            o = self.get_one_by_id(unicode(filename_name_id))
-
-            if o:
-                return o
-        except:
-            pass
-
-        return None
+        return lookup_cache.get_one(entity.Video, filename_name_id, ['filename', 'name', 'id'])
 
     def get_one_by_id(self, id):
         """
@@ -285,6 +316,41 @@ class AnnotationObjects():
         except sqlalchemy.orm.exc.NoResultFound, sqlalchemy.orm.exc.MultipleResultsFound:
             return None
 
+    def update_spans(self, video_ids=None):
+        """
+        Recomputes first_frame and last_frame of annotation objects directly in database, from their local annotation values
+        and packed tracks. Used to backfill spans in existing databases. Optionally only objects of given videos are updated.
+
+        :type video_ids: list of int
+        """
+
+        t_objects = entity.AnnotationObject.__table__
+        t_values = entity.AnnotationValue.__table__
+        t_tracks = entity.AnnotationTrack.__table__
+
+        def span(aggregate, track_column, is_first):
+            q = sqlalchemy.select([aggregate(t_values.c.frame_from)])
+            q = q.where(t_values.c.annotation_object_id == t_objects.c.id)
+            q = q.where(t_values.c.frame_from != None)
+            v = q.as_scalar()
+
+            q = sqlalchemy.select([aggregate(track_column)])
+            q = q.where(t_tracks.c.annotation_object_id == t_objects.c.id)
+            t = q.as_scalar()
+
+            # aggregate of both, NULL when there are no values (database independent LEAST/GREATEST ignoring NULLs)
+            return sqlalchemy.case([(v == None, t), (t == None, v), (v <= t if is_first else v >= t, v)], else_=t)
+
+        q = t_objects.update().values(first_frame=span(sqlalchemy.func.min, t_tracks.c.first_frame, True),
+                                      last_frame=span(sqlalchemy.func.max, t_tracks.c.last_frame, False))
+
+        if video_ids is not None:
+            q = q.where(t_objects.c.video_id.in_(video_ids))
+
+        result = database.db.session.execute(q)
+
+        logger.info("Spans of %d annotation objects were updated." % (result.rowcount))
+
 
 class AnnotationAttributes():
     def get_all(self):
@@ -298,28 +364,12 @@ class AnnotationAttributes():
 
     def get_one(self, name_id):
         """
-        Try to find one attribute by name or ID
+        Try to find one attribute by name or ID (in this order), results are cached (see LookupCache)
 
         :rtype: entity.AnnotationAttribute or None
         """
 
-        try:
-            o = self.get_one_by_name(unicode(name_id))
-
-            if o:
-                return o
-        except:
-            pass
-
-        try:
-            o = self.get_one_by_id(int(name_id))
-
-            if o:
-                return o
-        except:
-            pass
-
-        return None
+        return lookup_cache.get_one(entity.AnnotationAttribute, name_id, ['name', 'id'])
 
     def get_one_by_id(self, id):
         """
@@ -397,9 +447,85 @@ class AnnotationValues():
 
         return q.all()
 
+    def count_distinct(self, annotation_attribute_id):
+        """
+        Returns distinct encoded values of given annotation attribute with numbers of occurrences.
+
+        :rtype: list of (unicode, int)
+        """
+
+        av = entity.AnnotationValue
+
+        q = database.db.session.query(av._value, sqlalchemy.func.count(av.id))
+        q = q.filter_by(annotation_attribute_id=annotation_attribute_id)
+        q = q.group_by(av._value)
+
+        return q.all()
+
+    def delete(self, annotation_value):
+        """
+        Deletes annotation value (a new one, not flushed yet, is only removed from the session).
+        DELETE is flushed immediately: in one flush, new rows are inserted before rows are deleted, so a new LOCAL value
+        in the frame of the deleted one would violate the unique index of annotation_values.
+
+        :type annotation_value: entity.AnnotationValue
+        """
+
+        if annotation_value in database.db.session.new:
+            database.db.session.expunge(annotation_value)
+        else:
+            database.db.session.delete(annotation_value)
+            database.db.session.flush()
+
+    def get_local_duplicates(self):
+        """
+        Returns groups of LOCAL annotation values that share the same object, attribute and frame
+        (they violate the unique index of annotation_values).
+
+        :rtype: list of (annotation_object_id, annotation_attribute_id, frame_from, count)
+        """
+
+        av = entity.AnnotationValue
+
+        q = database.db.session.query(av.annotation_object_id, av.annotation_attribute_id, av.frame_from, sqlalchemy.func.count(av.id))
+        q = q.filter(av.frame_from != None)
+        q = q.group_by(av.annotation_object_id, av.annotation_attribute_id, av.frame_from)
+        q = q.having(sqlalchemy.func.count(av.id) > 1)
+
+        return q.all()
+
+    def delete_local_duplicates(self):
+        """
+        Deletes duplicate LOCAL annotation values (see get_local_duplicates()), the most recent value (highest ID) is kept.
+        Returns number of deleted values.
+
+        :rtype: int
+        """
+
+        av = entity.AnnotationValue
+        deleted = 0
+
+        for annotation_object_id, annotation_attribute_id, frame_from, count in self.get_local_duplicates():
+            q = database.db.session.query(av.id)
+            q = q.filter_by(annotation_object_id=annotation_object_id, annotation_attribute_id=annotation_attribute_id, frame_from=frame_from)
+            q = q.order_by(av.id.desc())
+
+            ids = [row[0] for row in q.all()[1:]]
+
+            deleted += database.db.session.execute(av.__table__.delete().where(av.id.in_(ids))).rowcount
+
+        logger.info("%d duplicate annotation values were deleted." % (deleted))
+
+        # values were deleted without the ORM
+        entity.reset_value_dictionaries()
+
+        return deleted
+
 
 class Logs():
-    execution_number = None
+    def __init__(self):
+        # log records are written in background, see logwriter.LogWriter
+        self.writer = logwriter.LogWriter()
 
     def get_by_annotator(self, annotator):
         """
@@ -411,35 +537,53 @@ class Logs():
         else:
             annotator_id = annotator.id
 
+        # records inserted before are in the database
+        self.flush()
+
         q = database.db.session.query(entity.Log)
         q = q.filter_by(created_by_id=annotator_id)
 
         return q.all()
 
+    def get_last_by_types(self, types, execution_number=None):
+        """
+        Returns the most recent log message of given types (optionally only from given execution).
+
+        :rtype: entity.Log
+        """
+
+        self.flush()
+
+        q = database.db.session.query(entity.Log)
+        q = q.filter(entity.Log.type.in_(types))
+
+        if execution_number is not None:
+            q = q.filter_by(execution_number=execution_number)
+
+        q = q.order_by(entity.Log.id.desc())
+
+        return q.first()
+
     def insert(self, type, value=None, annotator_id=None):
         """
-        Insert log message directly into the database, without session.
+        Insert log message into the database, without session. Message is only enqueued, it is encoded to JSON
+        and written by background writer later (see flush).
         """
-        if self.execution_number is None:
-            q = database.db.session.query(entity.Log)
-            q = q.filter(entity.Log.execution_number != None)
-            q = q.order_by(entity.Log.execution_number.desc())
-            q = q.limit(1)
 
-            last_log = q.all()
+        self.writer.start()
+        self.writer.put({'type': unicode(type), 'value': value, 'created_by_id': annotator_id})
 
-            if len(last_log) == 0:
-                self.execution_number = 1
-            else:
-                self.execution_number = last_log[0].execution_number + 1
+    def flush(self, timeout=None):
+        """
+        Waits until all inserted log messages are written into the database. Returns False on timeout.
 
-        dthandler = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
-        value_encoded = json.dumps(value, default=dthandler, indent=1, encoding=locale.getdefaultlocale()[1] or 'utf-8')
+        :rtype: bool
+        """
+
+        return self.writer.flush(timeout)
 
-        database.db.engine.execute(
-            entity.Log.__table__.insert(),
-            [{'type': unicode(type), 'value': unicode(value_encoded), 'created_by_id': annotator_id, 'execution_number': self.execution_number}]
-        )
+
+lookup_cache = LookupCache()
 
 annotators = Annotators()
 videos = Videos()
@@ -449,3 +593,19 @@ annotation_values = AnnotationValues()
 logs = Logs()
 
 logger.debug('Repository object instances created.')
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'before_flush')
+def _invalidate_lookup_cache(session, flush_context, instances):
+    cached_classes = (entity.Annotator, entity.Video, entity.AnnotationAttribute)
+
+    # cached entity can be renamed or deleted (changes of relationships only do not matter)
+    for o in session.dirty:
+        if isinstance(o, cached_classes) and session.is_modified(o, include_collections=False):
+            lookup_cache.invalidate()
+            return
+
+    for o in session.deleted:
+        if isinstance(o, cached_classes):
+            lookup_cache.invalidate()
+            return
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import os
+import tovian.log as log
+
+
+root_dir = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+log.setup_logging(os.path.join(root_dir, 'data', 'log_testing.json'), log_dir=os.path.join(root_dir, 'log'))
+
+import tovian.config as config
+import tovian.models as models
+
+import tovian.models.tests.fixtures as fixtures
+
+
+class DatabaseTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config.load(os.path.join(root_dir, 'config.ini'))
+
+        models.database.db.open_from_config(config.config, 'testing')
+        models.database.db.recreate_tables()
+
+        models.database.db.session.add_all(fixtures.create_fixtures())
+        models.database.db.session.commit()
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+
+    def test_001a_statement_fingerprint(self):
+        fingerprint = models.database.StatementStatistics.fingerprint
+
+        self.assertEqual(fingerprint("SELECT a.id\n  FROM a\n WHERE a.id IN (?, ?, ?) AND a.name = 'x''y' LIMIT 10"),
+                         "SELECT a.id FROM a WHERE a.id IN (?, ...) AND a.name = ? LIMIT ?")
+
+        # numbers in identifiers are kept
+        self.assertEqual(fingerprint("SELECT anon_1.id FROM t1 AS anon_1 WHERE anon_1.x > -1.5"),
+                         "SELECT anon_1.id FROM t1 AS anon_1 WHERE anon_1.x > ?")
+
+        self.assertEqual(fingerprint("SELECT * FROM a WHERE id IN (?, ?)"), fingerprint("SELECT * FROM a WHERE id IN (?, ?, ?, ?)"))
+
+    def test_001b_statement_statistics(self):
+        statistics = models.database.StatementStatistics()
+
+        for i in range(1, 101):
+            statistics.add("SELECT * FROM a WHERE id = %d" % (i), float(i), -1)
+
+        statistics.add("DELETE FROM a WHERE id IN (?, ?)", 5000.0, 2)
+        statistics.add("DELETE FROM a WHERE id IN (?, ?, ?)", 7000.0, 3)
+
+        stats_delete, stats_select = statistics.snapshot()
+
+        # the most expensive statement first
+        self.assertEqual(stats_delete['fingerprint'], "DELETE FROM a WHERE id IN (?, ...)")
+        self.assertEqual((stats_delete['count'], stats_delete['rows'], stats_delete['total_ms']), (2, 5, 12000.0))
+
+        self.assertEqual(stats_select['fingerprint'], "SELECT * FROM a WHERE id = ?")
+        self.assertEqual((stats_select['count'], stats_select['rows'], stats_select['mean_ms']), (100, None, 50.5))
+        self.assertEqual((stats_select['p50_ms'], stats_select['p95_ms'], stats_select['p99_ms']), (51.0, 96.0, 100.0))
+
+        self.assertEqual(len(statistics.snapshot(limit=1)), 1)
+
+    def test_001c_database_statistics(self):
+        models.database.db.statistics.reset()
+
+        models.repository.annotation_values.get_one_by_id(1)
+        models.repository.annotation_values.get_one_by_id(2)
+
+        stats = [s for s in models.database.db.statistics.snapshot() if 'FROM annotation_values' in s['fingerprint']]
+
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['count'], 2)
+
+    def test_002a_instrumentation_n_plus_one(self):
+        instrumentation = models.database.db.instrumentation
+        instrumentation.enabled = True
+        instrumentation.reset()
+
+        try:
+            models.database.db.session.expire_all()
+
+            # lazy load of the same relationship in a loop
+            with models.database.db.operation('test.lazy_loads'):
+                for av in models.repository.annotation_values.get_all():
+                    models.database.db.session.expire(av, ['annotation_object'])
+                    av.annotation_object
+
+            # the same statements without an operation are not reported
+            for av in models.repository.annotation_values.get_all():
+                models.database.db.session.expire(av, ['annotation_object'])
+                av.annotation_object
+        finally:
+            instrumentation.enabled = False
+
+        violations = [v for v in instrumentation.report() if v['type'] == 'n+1']
+
+        self.assertEqual(len(violations), 1)
+        self.assertEqual(violations[0]['operation'], 'test.lazy_loads')
+        self.assertIn('FROM annotation_objects', violations[0]['fingerprint'])
+
+        # call site is the line in this file, which accessed the relationship
+        self.assertTrue(violations[0]['site'].startswith('test_database.py:'))
+
+    def test_002b_instrumentation_budget(self):
+        instrumentation = models.database.db.instrumentation
+        instrumentation.enabled = True
+        instrumentation.reset()
+
+        try:
+            av = models.repository.annotation_values.get_one_by_id(1)
+
+            # object is in the identity map
+            with models.database.db.operation('test.warm', max_queries=0):
+                self.assertIs(models.database.db.session.query(models.entity.AnnotationValue).get(1), av)
+
+            with models.database.db.operation('test.cold', max_queries=1):
+                with models.database.db.operation('test.cold.inner'):
+                    models.database.db.session.expire_all()
+                    models.repository.annotation_values.get_one_by_id(1)
+                    models.repository.annotation_values.get_one_by_id(2)
+        finally:
+            instrumentation.enabled = False
+
+        violations = instrumentation.report()
+
+        self.assertEqual(len(violations), 1)
+        self.assertEqual((violations[0]['type'], violations[0]['operation'], violations[0]['count']), ('budget', 'test.cold', 2))
+        self.assertTrue(all(site.startswith('repository.py:') for site in violations[0]['sites']))
+
+        # disabled instrumentation does not track operations
+        with models.database.db.operation('test.disabled', max_queries=0):
+            models.database.db.session.expire_all()
+            models.repository.annotation_values.get_one_by_id(1)
+
+        self.assertEqual(len(instrumentation.report()), 1)
+
+    def test_003a_sqlite_pragmas(self):
+        pragma = lambda key: models.database.db.session.execute('PRAGMA %s' % (key)).scalar()
+
+        self.assertEqual(pragma('foreign_keys'), 1) # enabled in configuration of testing environment
+        self.assertIsNone(models.database.db.sqlite_pragmas['journal_mode']) # WAL only when enabled in configuration
+        self.assertEqual(pragma('synchronous'), 1) # NORMAL
+
+        with models.database.db.bulk_load():
+            self.assertEqual(pragma('synchronous'), 0) # OFF
+            self.assertEqual(pragma('cache_size'), models.database.db.sqlite_pragmas_bulk_load['cache_size'])
+
+            # the same for new connections
+            engine = models.database.db.create_engine(models.database.db.engine.url)
+            self.assertEqual(engine.execute('PRAGMA synchronous').scalar(), 0)
+            engine.dispose()
+
+        self.assertEqual(pragma('synchronous'), 1)
+        self.assertEqual(pragma('cache_size'), models.database.db.sqlite_pragmas['cache_size'])
+
+        with models.database.db.bulk_load(enabled=False):
+            self.assertEqual(pragma('synchronous'), 1)
+
+        # exception raised in the block is not hidden, when pragmas cannot be restored
+        try:
+            with models.database.db.bulk_load():
+                models.database.db.session.connection = None
+                raise ValueError()
+        except ValueError:
+            pass
+        else:
+            self.fail()
+        finally:
+            del models.database.db.session.connection
+            models.database.db.session.rollback()
+
+        self.assertFalse(models.database.db.bulk_load_active)
+        self.assertEqual(pragma('synchronous'), 1)
+
+    def test_003b_foreign_key_violations(self):
+        self.assertEqual(models.database.db.foreign_key_violations(), [])
+
+        # row inserted while foreign keys were not enforced
+        models.database.db.session.commit()
+        models.database.db.session.execute('PRAGMA foreign_keys=OFF')
+
+        try:
+            models.database.db.session.execute(models.entity.AnnotationValue.__table__.insert(), {
+                'id': 1000, 'annotation_object_id': 1000, 'annotation_attribute_id': 1, 'frame_from': 0, 'value': u'1'})
+
+            self.assertEqual(models.database.db.foreign_key_violations(), [(u'annotation_values', 1000, u'annotation_objects')])
+        finally:
+            models.database.db.session.rollback()
+            models.database.db.session.execute('PRAGMA foreign_keys=ON')
+            models.database.db.session.commit()
+
+
+if __name__ == '__main__':
+    unittest.main()
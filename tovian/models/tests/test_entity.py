@@ -4,6 +4,8 @@ import os
 import json
 import unittest
 
+import sqlalchemy.orm
+
 import tovian.log as log
 
 
@@ -141,6 +143,26 @@ class EntityTestCase(unittest.TestCase):
         self.assertEqual(aos[13][1:], (1542, 1547))
         self.assertEqual(aos[14][1:], (1696, 1702))
 
+    def test_002b_video_annotation_objects_all_global(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+        aa_identity = models.repository.annotation_attributes.get_one_by_id(1004)
+
+        try:
+            # object with a global value only has no span
+            ao = models.entity.AnnotationObject(type=u'rectangle', video=video_football)
+            models.entity.AnnotationValue(value=u"blue player", annotation_attribute=aa_identity, annotation_object=ao)
+            models.database.db.session.flush()
+
+            aos = video_football.annotation_objects_all()
+
+            self.assertEqual(len(aos), 16)
+            self.assertIn((ao, None, None), aos)
+
+            # and it is not in the timeline
+            self.assertEqual(len(models.entity.TimelineIndex(aos).rows), 15)
+        finally:
+            models.database.db.session.rollback()
+
     def test_002c_video_annotation_objects_in_frame(self):
         video_football = models.repository.videos.get_one_by_id(1)
         self.assertIsNotNone(video_football)
@@ -317,6 +339,157 @@ class EntityTestCase(unittest.TestCase):
             self.fail()
 
 
+    def test_002j_video_timeline_index(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+        self.assertIsNotNone(video_football)
+
+        ao, frame_from, frame_to = video_football.annotation_object_next(140)
+        self.assertEqual((ao.id, frame_from), (17, 142))
+
+        # index is loaded only once, it keeps IDs and spans only, objects in the session are not loaded again
+        timeline_index = video_football.timeline_index()
+        self.assertEqual(timeline_index.rows[17], (17, 142, 333))
+        sql_count_1 = models.database.db.profiler['sql_count']
+
+        ao, frame_from, frame_to = video_football.annotation_object_next(140)
+        self.assertEqual((ao.id, frame_from), (17, 142))
+
+        sql_count_2 = models.database.db.profiler['sql_count']
+        self.assertEqual(sql_count_1, sql_count_2)
+
+        ao, frame_from, frame_to = video_football.annotation_object_previous(140)
+        self.assertEqual(ao.id, 2)
+        self.assertIs(video_football.timeline_index(), timeline_index)
+
+        # span of the object is changed by a new keyframe
+        ao_17 = models.repository.annotation_objects.get_one_by_id(17)
+        av = [av for av in ao_17.annotation_values_local() if av.frame_from == 142][0]
+        av_new = models.entity.InterpolatedValue(141, av.value, av.annotation_attribute, ao_17).database_session_add()
+
+        ao, frame_from, frame_to = video_football.annotation_object_next(140)
+        self.assertEqual((ao.id, frame_from), (17, 141))
+
+        models.database.db.session.delete(av_new)
+
+        ao, frame_from, frame_to = video_football.annotation_object_next(140)
+        self.assertEqual((ao.id, frame_from), (17, 142))
+
+        # commit invalidates the index (objects committed by other annotators are visible), as the buffer reset does
+        timeline_index = video_football.timeline_index()
+        models.database.db.session.commit()
+        self.assertIsNot(video_football.timeline_index(), timeline_index)
+
+        timeline_index = video_football.timeline_index()
+        models.entity.invalidate_timeline_indexes()
+        self.assertIsNot(video_football.timeline_index(), timeline_index)
+
+        # rolled back change of the span does
+        av_new = models.entity.InterpolatedValue(141, av.value, av.annotation_attribute, ao_17).database_session_add()
+        self.assertEqual(video_football.timeline_index().next(140)[1], 141)
+
+        models.database.db.session.rollback()
+
+        ao, frame_from, frame_to = video_football.annotation_object_next(140)
+        self.assertEqual((ao.id, frame_from), (17, 142))
+
+    def test_002k_span_index(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+
+        index = models.entity.SpanIndex()
+        index.add(video_football.annotation_objects_in_frame_intervals([(0, video_football.frame_count)]))
+
+        self.assertEqual(len(index), len(video_football.annotation_objects_all()))
+
+        # the same objects (and order) as from database
+        for frame_from, frame_to in [(0, 0), (14, 14), (30, 30), (200, 200), (14, 320), (330, 20000), (20000, 20000)]:
+            self.assertEqual(index.in_interval(frame_from, frame_to),
+                             video_football.annotation_objects_in_frame_intervals([(frame_from, frame_to)]))
+
+        self.assertEqual(index.in_frame(30), index.in_interval(30, 30))
+
+        # objects are replaced and removed
+        row = index.in_frame(30)[0]
+        index.add([(row[0], 1000, 1010)])
+
+        self.assertNotIn(row, index.in_frame(30))
+        self.assertEqual(index.in_frame(1005), [(row[0], 1000, 1010)])
+
+        self.assertTrue(index.remove(row[0].id))
+        self.assertFalse(index.remove(row[0].id))
+        self.assertNotIn(row[0].id, index)
+        self.assertEqual(index.in_frame(1005), [])
+
+        index.clear()
+        self.assertEqual(index.in_interval(0, 20000), [])
+
+    def test_002l_span_index_random(self):
+        import random
+
+        class FakeObject(object):
+            def __init__(self, id):
+                self.id = id
+
+        rows = []
+
+        for i in range(0, 300):
+            start = random.randint(0, 1000)
+            rows.append((FakeObject(i), start, start + random.choice([0, 1, 5, 50, 500])))
+
+        index = models.entity.SpanIndex()
+        index.add(rows)
+
+        for i in range(0, 100):
+            frame_from = random.randint(-10, 1600)
+            frame_to = frame_from + random.choice([0, 0, 1, 10, 100])
+
+            expected = sorted([row for row in rows if row[1] <= frame_to and row[2] >= frame_from], key=lambda row: (row[1], row[2], row[0].id))
+            self.assertEqual(index.in_interval(frame_from, frame_to), expected)
+
+    def test_002m_span_index_memory_usage(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+        rows = video_football.annotation_objects_in_frame_intervals([(0, video_football.frame_count)])
+
+        # loaded values are included, nothing is loaded
+        ao = rows[0][0]
+        sql_count = models.database.db.profiler['sql_count']
+
+        self.assertTrue(ao.memory_usage() > models.entity.instance_memory_usage(ao) + sum(models.entity.instance_memory_usage(av) for av in ao.annotation_values))
+        self.assertEqual(models.database.db.profiler['sql_count'], sql_count)
+
+        index = models.entity.SpanIndex(memory_usage=lambda row: row[0].memory_usage())
+        index.add(rows)
+        self.assertEqual(index.size, sum(row[0].memory_usage() for row in rows))
+
+        # replaced object is counted once
+        index.add(rows[:1])
+        self.assertEqual(index.size, sum(row[0].memory_usage() for row in rows))
+
+        removed = index.remove_outside(0, 30)
+        self.assertEqual(sorted(removed), sorted(row for row in rows if row[1] > 30))
+        self.assertEqual(index.size, sum(row[0].memory_usage() for row in rows if row[1] <= 30))
+        self.assertEqual(index.in_interval(0, 20000), [row for row in rows if row[1] <= 30])
+
+        index.clear()
+        self.assertEqual(index.size, 0)
+
+    def test_002n_span_index_copy(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+        rows = video_football.annotation_objects_in_frame_intervals([(0, video_football.frame_count)])
+
+        index = models.entity.SpanIndex(memory_usage=lambda row: row[0].memory_usage())
+        index.add(rows[:-1])
+        index.update()
+
+        # changes of the copy are not visible in the original index
+        index_copy = index.copy()
+        index_copy.add(rows[-1:])
+        index_copy.remove(rows[0][0].id)
+
+        self.assertEqual(index.in_interval(0, video_football.frame_count), sorted(rows[:-1], key=lambda row: (row[1], row[2], row[0].id)))
+        self.assertEqual(index_copy.in_interval(0, video_football.frame_count), sorted(rows[1:], key=lambda row: (row[1], row[2], row[0].id)))
+        self.assertEqual(index.size, sum(row[0].memory_usage() for row in rows[:-1]))
+        self.assertEqual(index_copy.size, sum(row[0].memory_usage() for row in rows[1:]))
+
     def test_003a_annotation_attribute_repr(self):
         annotation_attribute_new = models.entity.AnnotationAttribute(name=u'ěšč')
         self.assertTrue(str(annotation_attribute_new).startswith('<AnnotationAttribute#None('))
@@ -384,6 +557,212 @@ class EntityTestCase(unittest.TestCase):
         v = aa_comment.autocomplete_values('xxx')
         self.assertEquals(v, [])
 
+    def test_004e_annotation_value_value_cache(self):
+        av = models.repository.annotation_values.get_one_by_id(1)
+        self.assertEqual(av.annotation_attribute.data_type, u'position_rectangle')
+
+        # decoded value is cached
+        value = av.value
+        self.assertIs(av.value, value)
+
+        av.value = [0, 0, 10, 10]
+        self.assertEqual(av.value, (0, 0, 10, 10))
+
+        # rollback expires the value, cache is reset
+        models.database.db.session.rollback()
+        self.assertEqual(av.value, value)
+
+    def test_004f_annotation_value_options_cache(self):
+        av = models.repository.annotation_values.get_one_by_id(1)
+
+        try:
+            # resolved options are cached and read-only
+            colors = av.get_option('gui.color')
+            self.assertIs(av.get_option('gui.color'), colors)
+
+            with self.assertRaises(TypeError):
+                colors['annotation_object_visual'] = 'black'
+
+            # change of options anywhere in the chain is reflected
+            av.annotation_object.video.options = json.dumps({'gui': {'color': {'annotation_object_visual': 'white'}}})
+            self.assertEquals(av.get_option('gui.color.annotation_object_visual'), 'white')
+
+            models.database.db.session.rollback()
+            self.assertEquals(av.get_option('gui.color.annotation_object_visual'), '#00ffff')
+
+            # options cached by other entities are kept, when unrelated entities are expired
+            colors = av.get_option('gui.color')
+            models.database.db.session.expire(models.repository.annotation_values.get_one_by_id(2))
+            self.assertIs(av.get_option('gui.color'), colors)
+
+            av.annotation_attribute.options = json.dumps({'gui': {'color': {'annotation_object_visual_focus': 'black'}}})
+            self.assertEquals(av.get_option('gui.color.annotation_object_visual_focus'), 'black')
+        finally:
+            # options changed by this test are not left in the session
+            models.database.db.session.rollback()
+
+    def test_004f_interpolated_value_options(self):
+        ao = models.repository.annotation_objects.get_one_by_id(1)
+        av = ao.annotation_values_local_interpolate_in_frame(8)[0]
+        self.assertIsInstance(av, models.entity.InterpolatedValue)
+
+        # the same options as of a keyframe without own options, cached on the annotation object
+        keyframe = [kf for kf in ao.annotation_values_local() if kf.annotation_attribute is av.annotation_attribute and kf.options is None][0]
+        colors = av.get_option('gui.color')
+
+        self.assertEqual(colors, keyframe.get_option('gui.color'))
+        self.assertIs(ao.annotation_values_local_interpolate_in_frame(8)[0].get_option('gui.color'), colors)
+        self.assertEqual(av.get_text(), None) # positional attribute
+
+        av.annotation_attribute.options = json.dumps({'gui': {'color': {'annotation_object_visual_focus': 'black'}}})
+        self.assertEquals(av.get_option('gui.color.annotation_object_visual_focus'), 'black')
+
+        models.database.db.session.rollback()
+
+    def test_004g_annotation_track_encode_keyframes(self):
+        keyframes = [(0, (1, -2, 3.25)), (10, (32767, -32768, 0.1)), (2 ** 30, (0, 0, 120.55))]
+
+        frames, coordinates = models.entity.AnnotationTrack.encode_keyframes(keyframes, u'position_circle')
+        self.assertEqual(len(frames) + len(coordinates), 3 * (4 + 2 * 2 + 4))
+        self.assertEqual(zip(*models.entity.AnnotationTrack.decode_keyframes(frames, coordinates, u'position_circle')), keyframes)
+
+        try:
+            models.entity.AnnotationTrack.encode_keyframes([(0, (0, 0, 40000, 10))], u'position_rectangle')
+        except:
+            pass
+        else:
+            self.fail()
+
+    def test_004h_annotation_object_pack_tracks(self):
+        ao_football_circle_3 = models.repository.annotation_objects.get_one_by_id(3)
+        self.assertIsNotNone(ao_football_circle_3)
+
+        span = (ao_football_circle_3.first_frame, ao_football_circle_3.last_frame)
+        frames = range(span[0], span[1] + 1)
+
+        def positions():
+            return [[av.value for av in ao_football_circle_3.annotation_values_local_interpolate_in_frame(frame)
+                     if av.annotation_attribute.data_type == u'position_circle'] for frame in frames]
+
+        positions_1 = positions()
+        values_len_1 = len(ao_football_circle_3.annotation_values)
+
+        # pack
+        count = ao_football_circle_3.pack_tracks()
+        models.database.db.session.flush()
+
+        self.assertGreater(count, 0)
+        self.assertEqual(len(ao_football_circle_3.annotation_tracks), 1)
+        self.assertEqual(len(ao_football_circle_3.annotation_values), values_len_1 - count)
+        self.assertEqual((ao_football_circle_3.first_frame, ao_football_circle_3.last_frame), span)
+        self.assertEqual(positions(), positions_1)
+
+        av = ao_football_circle_3.annotation_values_local_interpolate_in_frame(span[0])[0]
+        self.assertTrue(av.is_packed)
+        self.assertRaises(AttributeError, setattr, av, 'value', (1, 2, 3.0))
+
+        # unpack
+        self.assertEqual(ao_football_circle_3.unpack_tracks(), count)
+        models.database.db.session.flush()
+
+        self.assertEqual(len(ao_football_circle_3.annotation_tracks), 0)
+        self.assertEqual(len(ao_football_circle_3.annotation_values), values_len_1)
+        self.assertEqual(positions(), positions_1)
+
+    def test_004h_annotation_object_pack_tracks_duplicates(self):
+        ao_football_circle_3 = models.repository.annotation_objects.get_one_by_id(3)
+        ao_football_circle_3.pack_tracks()
+        models.database.db.session.flush()
+
+        annotation_track = ao_football_circle_3.annotation_tracks[0]
+        frames, values = annotation_track.keyframes()
+
+        # loose annotation value in a frame of the packed track
+        models.entity.AnnotationValue(frame_from=frames[0], value=list(values[0]),
+                                      annotation_attribute=annotation_track.annotation_attribute,
+                                      annotation_object=ao_football_circle_3)
+
+        try:
+            annotation_track.unpack()
+        except Exception, e:
+            self.assertIn('packed track', str(e))
+        else:
+            self.fail()
+
+        self.assertEqual(ao_football_circle_3.annotation_tracks, [annotation_track])
+
+        try:
+            ao_football_circle_3.pack_tracks()
+        except Exception, e:
+            self.assertIn('packed track', str(e))
+        else:
+            self.fail()
+
+        self.assertEqual(annotation_track.keyframes()[0], frames)
+
+        models.database.db.session.rollback()
+
+    def test_004i_annotation_value_simplify(self):
+        ao_football_point_5 = models.repository.annotation_objects.get_one_by_id(5)
+        aa_position = ao_football_point_5.annotation_values_local()[0].annotation_attribute
+
+        # straight movement to the corner in frame 50, frame 20 is one pixel off
+        track = [[2 * i if i <= 50 else 100, i] for i in range(0, 101)]
+        track[20][0] += 1
+
+        avs = [models.entity.InterpolatedValue(frame, value, aa_position, None) for frame, value in enumerate(track)]
+
+        kept, removed, max_error = models.entity.AnnotationValue.simplify(avs, 1)
+
+        self.assertEqual([av.frame_from for av in kept], [0, 50, 100])
+        self.assertEqual(len(removed), 98)
+        self.assertEqual(max_error, 1.0)
+
+        kept, removed, max_error = models.entity.AnnotationValue.simplify(avs, 0.5)
+
+        self.assertEqual([av.frame_from for av in kept], [0, 20, 50, 100])
+        self.assertEqual(max_error, 0.0)
+
+    def test_004j_annotation_attribute_value_dictionary(self):
+        aa_comment = models.repository.annotation_attributes.get_one_by_id(100)
+
+        # prefix matches first, then by number of occurrences
+        value_dictionary = models.entity.ValueDictionary([(u'goal', 1), (u'Shot', 2), (u'shot on goal', 5), (u'own goal', 9)])
+
+        self.assertEqual(value_dictionary.lookup(), [u'own goal', u'shot on goal', u'Shot', u'goal'])
+        self.assertEqual(value_dictionary.lookup(u'GOAL'), [u'goal', u'own goal', u'shot on goal'])
+        self.assertEqual(value_dictionary.lookup(u'sh', limit=1), [u'shot on goal'])
+        self.assertEqual(value_dictionary.lookup(u'goal', limit=2), [u'goal', u'own goal'])
+
+        value_dictionary.remove(u'Shot', 2)
+        value_dictionary.add(u'penalty')
+        self.assertEqual(value_dictionary.lookup(u'sh'), [u'shot on goal'])
+        self.assertEqual(len(value_dictionary), 4)
+
+        # dictionary of attribute is updated by flush and rollback
+        self.assertEqual(aa_comment.autocomplete_values(u'shot'), [u'shot on goal'])
+
+        av = [av for av in aa_comment.annotation_values if av.value == u'shot on goal'][0]
+        av.value = u'penalty'
+        models.database.db.session.flush()
+
+        self.assertEqual(aa_comment.autocomplete_values(u'shot'), [])
+        self.assertEqual(aa_comment.autocomplete_values(u'pen'), [u'penalty'])
+        self.assertEqual(aa_comment.value_dictionary().counts[u'penalty'], 1)
+
+        # other sessions (e.g. of executor thread) do not change dictionaries
+        session = sqlalchemy.orm.sessionmaker(bind=models.database.db.engine)()
+        session.query(models.entity.AnnotationValue).get(av.id)
+        session.rollback()
+        session.close()
+
+        self.assertEqual(aa_comment.autocomplete_values(u'pen'), [u'penalty'])
+
+        models.database.db.session.rollback()
+
+        self.assertEqual(aa_comment.autocomplete_values(u'shot'), [u'shot on goal'])
+        self.assertEqual(aa_comment.autocomplete_values(u'pen'), [])
+
     def test_005a_annotation_object_repr(self):
         annotation_object_new = models.entity.AnnotationObject()
         self.assertTrue(str(annotation_object_new).startswith('<AnnotationObject#None('))
@@ -487,6 +866,10 @@ class EntityTestCase(unittest.TestCase):
         self.assertTrue(avsi[1].is_interpolated)
         self.assertEqual(len(ao_football_rectangle_1.annotation_values_local()), 4)
 
+        # interpolated values are read-only and not tracked by the session
+        self.assertIsInstance(avsi[0], models.entity.InterpolatedValue)
+        self.assertRaises(AttributeError, setattr, avsi[0], 'frame_from', 9)
+
         # add interpolated values to database with commit
         avsi[0].database_session_add()
         avsi[1].database_session_add()
@@ -567,6 +950,100 @@ class EntityTestCase(unittest.TestCase):
         else:
             self.fail()
 
+    def test_005l_annotation_object_span(self):
+        ao_football_rectangle_1 = models.repository.annotation_objects.get_one_by_id(1)
+        self.assertIsNotNone(ao_football_rectangle_1)
+        self.assertEqual((ao_football_rectangle_1.first_frame, ao_football_rectangle_1.last_frame), (0, 30))
+
+        avsi = ao_football_rectangle_1.annotation_values_local_interpolate_in_frame(40)
+        av = [av for av in avsi if av.annotation_attribute.data_type == u'position_rectangle'][0]
+
+        # added value
+        av = av.database_session_add()
+        models.database.db.session.flush()
+        self.assertEqual((ao_football_rectangle_1.first_frame, ao_football_rectangle_1.last_frame), (0, 40))
+
+        # moved value
+        av.frame_from = 45
+        models.database.db.session.flush()
+        self.assertEqual((ao_football_rectangle_1.first_frame, ao_football_rectangle_1.last_frame), (0, 45))
+
+        # deleted value (as orphan)
+        ao_football_rectangle_1.annotation_values.remove(av)
+        models.database.db.session.flush()
+        self.assertEqual((ao_football_rectangle_1.first_frame, ao_football_rectangle_1.last_frame), (0, 30))
+
+    def test_005m_annotation_object_annotation_values_local_sorted(self):
+        ao_football_rectangle_1 = models.repository.annotation_objects.get_one_by_id(1)
+        self.assertIsNotNone(ao_football_rectangle_1)
+
+        keyframes = ao_football_rectangle_1.annotation_values_local_sorted()
+        self.assertEqual(keyframes[1][0], [0, 8, 15, 30]) # frame 8 was added in test_005h
+        self.assertEqual([av.frame_from for av in keyframes[1][1]], [0, 8, 15, 30])
+
+        # cached
+        self.assertIs(ao_football_rectangle_1.annotation_values_local_sorted(), keyframes)
+
+        # interpolated values do not invalidate the cache, until they are added to session
+        avsi = ao_football_rectangle_1.annotation_values_local_interpolate_in_frame(20)
+        av = [av for av in avsi if av.annotation_attribute_id == 1][0]
+        self.assertIs(ao_football_rectangle_1.annotation_values_local_sorted(), keyframes)
+
+        av = av.database_session_add()
+        self.assertEqual(ao_football_rectangle_1.annotation_values_local_sorted()[1][0], [0, 8, 15, 20, 30])
+
+        av.frame_from = 25
+        self.assertEqual(ao_football_rectangle_1.annotation_values_local_sorted()[1][0], [0, 8, 15, 25, 30])
+
+        ao_football_rectangle_1.annotation_values.remove(av)
+        models.database.db.session.flush()
+        self.assertEqual(ao_football_rectangle_1.annotation_values_local_sorted()[1][0], [0, 8, 15, 30])
+
+    def test_005n_annotation_object_simplify_keyframes(self):
+        ao_football_rectangle_1 = models.repository.annotation_objects.get_one_by_id(1)
+
+        def positions():
+            return [[av.value for av in ao_football_rectangle_1.annotation_values_local_interpolate_in_frame(frame)
+                     if av.annotation_attribute.data_type == u'position_rectangle'][0] for frame in range(0, 31)]
+
+        positions_1 = positions()
+
+        # keyframes created from interpolated values (see test_005l) are reproduced exactly
+        removed, max_error = ao_football_rectangle_1.simplify_keyframes(2)
+        self.assertEqual(max_error, 0.0)
+
+        # keyframe in frame 15 is 3 pixels off the interpolation
+        self.assertEqual(ao_football_rectangle_1.simplify_keyframes(3), (1, 3.0))
+        models.database.db.session.flush()
+
+        self.assertEqual((ao_football_rectangle_1.first_frame, ao_football_rectangle_1.last_frame), (0, 30))
+
+        # frames between keyframes are within tolerance, up to rounding of interpolated coordinates
+        for position_1, position_2 in zip(positions_1, positions()):
+            self.assertLessEqual(models.entity.AnnotationValue.interpolation_error(position_1, position_2), 3 + 1)
+
+        # restore removed keyframe
+        aa_position = [av.annotation_attribute for av in ao_football_rectangle_1.annotation_values_local()
+                       if av.annotation_attribute.data_type == u'position_rectangle'][0]
+        models.entity.InterpolatedValue(15, positions_1[15], aa_position, ao_football_rectangle_1).database_session_add()
+        models.database.db.session.flush()
+
+        self.assertEqual(positions()[15], positions_1[15])
+
+    def test_005o_annotation_object_keyframe_next(self):
+        ao_football_point_5 = models.repository.annotation_objects.get_one_by_id(5)
+
+        self.assertEqual(ao_football_point_5.keyframes(), [139, 156, 215, 265, 294, 307, 337])
+
+        self.assertEqual(ao_football_point_5.keyframe_next(0), 139)
+        self.assertEqual(ao_football_point_5.keyframe_next(139), 156)
+        self.assertEqual(ao_football_point_5.keyframe_next(200), 215)
+        self.assertIsNone(ao_football_point_5.keyframe_next(337))
+
+        self.assertIsNone(ao_football_point_5.keyframe_previous(139))
+        self.assertEqual(ao_football_point_5.keyframe_previous(156), 139)
+        self.assertEqual(ao_football_point_5.keyframe_previous(1000), 337)
+
     def test_100a_annotation_object_delete_cascade(self):
         values_len_1 = len(models.repository.annotation_values.get_all())
 
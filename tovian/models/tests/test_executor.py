@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import os
+import threading
+import tovian.log as log
+
+
+root_dir = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+log.setup_logging(os.path.join(root_dir, 'data', 'log_testing.json'), log_dir=os.path.join(root_dir, 'log'))
+
+import tovian.config as config
+import tovian.models as models
+import tovian.models.executor as executor
+
+import tovian.models.tests.fixtures as fixtures
+
+
+class ExecutorTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config.load(os.path.join(root_dir, 'config.ini'))
+
+        models.database.db.open_from_config(config.config, 'testing')
+        models.database.db.recreate_tables()
+
+        models.database.db.session.add_all(fixtures.create_fixtures())
+        models.database.db.session.commit()
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        executor.executor.stop(timeout=10)
+
+
+    def test_001a_submit(self):
+        future = executor.executor.submit(lambda session, a, b=0: (threading.current_thread().name, session, a + b), 1, b=2)
+        thread_name, session, result = future.result(timeout=10)
+
+        self.assertTrue(future.done())
+        self.assertIsNone(future.exception())
+        self.assertEqual(result, 3)
+
+        # own thread and session
+        self.assertEqual(thread_name, 'DatabaseExecutor')
+        self.assertIsNot(session, models.database.db.session)
+
+        # callback of done future is called immediately
+        results = []
+        future.add_done_callback(lambda f: results.append(f.result()[2]))
+        self.assertEqual(results, [3])
+
+    def test_001b_submit_exception(self):
+        def fail(session):
+            raise ValueError('failed')
+
+        future = executor.executor.submit(fail)
+
+        self.assertIsInstance(future.exception(timeout=10), ValueError)
+
+        try:
+            future.result()
+        except ValueError, e:
+            self.assertEqual(str(e), 'failed')
+        else:
+            self.fail()
+
+        # executor continues with next functions
+        self.assertEqual(executor.executor.submit(lambda session: session.query(models.entity.Video).count()).result(timeout=10),
+                         len(models.repository.videos.get_all()))
+
+    def test_002a_merge_into_session(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+        rows_expected = video_football.annotation_objects_in_frame_intervals([(14, 320)])
+
+        def load(session, video_id):
+            video = session.query(models.entity.Video).get(video_id)
+            return video.annotation_objects_in_frame_intervals([(14, 320)], session=session)
+
+        rows = executor.executor.submit(load, video_football.id).result(timeout=10)
+
+        sql_count = models.database.db.profiler['sql_count']
+        rows_merged = executor.merge_into_session(rows)
+
+        # objects of the main session with loaded values, without SQL
+        self.assertEqual(rows_merged, rows_expected)
+        self.assertEqual(sum(len(ao.annotation_values) for ao, first_frame, last_frame in rows_merged),
+                         sum(len(ao.annotation_values) for ao, first_frame, last_frame in rows))
+        self.assertEqual(models.database.db.profiler['sql_count'], sql_count)
+
+    def test_002b_merge_into_session_changes(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+
+        def load(session, video_id):
+            video = session.query(models.entity.Video).get(video_id)
+            return video.annotation_objects_in_frame_intervals([(14, 320)], session=session)
+
+        rows = executor.executor.submit(load, video_football.id).result(timeout=10)
+
+        ao_modified, ao_deleted = [ao for ao, first_frame, last_frame in video_football.annotation_objects_in_frame_intervals([(14, 320)])][:2]
+        ao_modified.public_comment = u'not committed'
+        models.database.db.session.delete(ao_deleted)
+
+        rows_merged = executor.merge_into_session(rows)
+
+        self.assertEqual(len(rows_merged), len(rows) - 1)
+        self.assertNotIn(ao_deleted, [ao for ao, first_frame, last_frame in rows_merged])
+        self.assertEqual([ao for ao, first_frame, last_frame in rows_merged if ao.id == ao_modified.id][0].public_comment, u'not committed')
+
+        models.database.db.session.rollback()
+
+    def test_002c_merge_into_session_changed_values(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+
+        def load(session, video_id):
+            video = session.query(models.entity.Video).get(video_id)
+            return video.annotation_objects_in_frame_intervals([(14, 320)], session=session)
+
+        rows = executor.executor.submit(load, video_football.id).result(timeout=10)
+
+        # only annotation values are changed, annotation objects are not modified
+        objects = [ao for ao, first_frame, last_frame in video_football.annotation_objects_in_frame_intervals([(14, 320)])
+                   if ao.annotation_values]
+        ao_value_changed, ao_value_deleted = objects[:2]
+
+        value_changed = ao_value_changed.annotation_values[0]
+        value_changed.frame_from += 1
+        frame_from = value_changed.frame_from
+        value_deleted = ao_value_deleted.annotation_values[0]
+        models.database.db.session.delete(value_deleted)
+
+        self.assertFalse(models.database.db.session.is_modified(ao_value_changed))
+        self.assertEqual(executor.changed_annotation_object_ids(), set([ao_value_changed.id, ao_value_deleted.id]))
+
+        rows_merged = executor.merge_into_session(rows)
+        objects_merged = dict((ao.id, ao) for ao, first_frame, last_frame in rows_merged)
+
+        self.assertIs(objects_merged[ao_value_changed.id], ao_value_changed)
+        self.assertIn(value_changed, ao_value_changed.annotation_values)
+        self.assertEqual(value_changed.frame_from, frame_from)
+        self.assertIn(value_deleted, models.database.db.session.deleted)
+
+        models.database.db.session.rollback()
+        self.assertEqual(executor.changed_annotation_object_ids(), set())
+
+    def test_002d_session_listeners(self):
+        annotation_attribute = models.repository.annotation_attributes.get_one_by_id(1005)
+        self.assertEqual(annotation_attribute.value_dictionary().lookup(u'shooting'), [])
+
+        ao = models.repository.annotation_objects.get_one_by_id(1)
+        ao.last_frame += 1
+        models.database.db.session.add(models.entity.AnnotationValue(frame_from=ao.last_frame, value=u'shooting',
+                                                                     annotation_attribute=annotation_attribute,
+                                                                     annotation_object=ao))
+        models.database.db.session.flush()
+
+        timeline_version = models.entity.timeline_version
+        self.assertIn(u'shooting', annotation_attribute.value_dictionary().lookup(u'shooting'))
+
+        # transaction of the executor is ended by rollback, changes of the main session are not reverted
+        executor.executor.submit(lambda session: session.query(models.entity.AnnotationObject).get(1)).result(timeout=10)
+
+        self.assertEqual(models.entity.timeline_version, timeline_version)
+        self.assertIn(u'shooting', annotation_attribute.value_dictionary().lookup(u'shooting'))
+
+        models.database.db.session.rollback()
+
+        self.assertGreater(models.entity.timeline_version, timeline_version)
+        self.assertNotIn(u'shooting', annotation_attribute.value_dictionary().lookup(u'shooting'))
+
+    def test_002e_expire_unchanged(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+        objects = [ao for ao, first_frame, last_frame in video_football.annotation_objects_in_frame_intervals([(14, 320)])
+                   if ao.annotation_values]
+        ao_value_changed, ao_displayed = objects[:2]
+        self.assertGreater(len(objects), 2)
+
+        ao_value_changed.annotation_values[0].frame_from += 1
+
+        sql_count = models.database.db.profiler['sql_count']
+        expired = executor.expire_unchanged(objects, keep_ids=[ao_displayed.id])
+
+        # objects are expired without SQL, changed and displayed objects are kept loaded
+        self.assertEqual(models.database.db.profiler['sql_count'], sql_count)
+        self.assertEqual(expired, objects[2:])
+        self.assertTrue(all('annotation_values' not in ao.__dict__ for ao in expired))
+        self.assertIn('annotation_values', ao_value_changed.__dict__)
+        self.assertIn('annotation_values', ao_displayed.__dict__)
+
+        models.database.db.session.rollback()
+
+    def test_002f_annotation_objects_with_changed_values(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+        objects = [ao for ao, first_frame, last_frame in video_football.annotation_objects_in_frame_intervals([(14, 320)])
+                   if len(ao.annotation_values) > 1]
+        ao_value_changed, ao_value_deleted, ao_comment_changed, ao_deleted = objects[:4]
+
+        ao_value_changed.annotation_values[0].frame_from += 1
+        ao_value_deleted.annotation_values.remove(ao_value_deleted.annotation_values[0])
+        ao_comment_changed.public_comment = u'changed'
+        ao_deleted.annotation_values[0].frame_from += 1
+        models.database.db.session.delete(ao_deleted)
+
+        # only objects with edited values, the comment is not a reason to rewrite values
+        self.assertEqual(executor.annotation_objects_with_changed_values(), set([ao_value_changed, ao_value_deleted]))
+
+        models.database.db.session.rollback()
+        self.assertEqual(executor.annotation_objects_with_changed_values(), set())
+
+    def test_003a_uncommitted_flush(self):
+        self.assertFalse(models.database.db.uncommitted_flush)
+
+        ao = models.repository.annotation_objects.get_one_by_id(1)
+        ao.public_comment = u'flushed'
+        models.database.db.session.flush()
+
+        self.assertTrue(models.database.db.uncommitted_flush)
+
+        # executor does not see changes, which are not committed
+        comment = executor.executor.submit(lambda session: session.query(models.entity.AnnotationObject).get(1).public_comment).result(timeout=10)
+        self.assertNotEqual(comment, u'flushed')
+
+        models.database.db.session.rollback()
+        self.assertFalse(models.database.db.uncommitted_flush)
+
+
+if __name__ == '__main__':
+    unittest.main()
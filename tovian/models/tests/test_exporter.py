@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import tovian.log as log
+
+
+root_dir = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+log.setup_logging(os.path.join(root_dir, 'data', 'log_testing.json'), log_dir=os.path.join(root_dir, 'log'))
+
+import tovian.config as config
+import tovian.models as models
+import tovian.models.exporter as exporter
+import tovian.models.tests.fixtures as fixtures
+
+
+class ExporterTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config.load(os.path.join(root_dir, 'config.ini'))
+
+        models.database.db.open_from_config(config.config, 'testing')
+        models.database.db.recreate_tables()
+
+        models.database.db.session.add_all(fixtures.create_fixtures())
+        models.database.db.session.commit()
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+
+    def test_001a_export_rows(self):
+        rows = list(exporter.export_rows('AnnotationValue'))
+        avs = models.repository.annotation_values.get_all()
+
+        self.assertEqual([d['id'] for d in rows], sorted(av.id for av in avs))
+
+        for d in rows:
+            av = models.repository.annotation_values.get_one_by_id(d['id'])
+
+            # decoded value, no encoded columns
+            self.assertEqual(d['value'], av.value)
+            self.assertEqual(d['frame_from'], av.frame_from)
+            self.assertNotIn('_value', d)
+
+    def test_001b_export_rows_relationships(self):
+        for d in exporter.export_rows('AnnotationObject'):
+            ao = models.repository.annotation_objects.get_one_by_id(d['id'])
+
+            self.assertEqual(d['type'], ao.type)
+            self.assertEqual(d['annotation_values'], sorted(av.id for av in ao.annotation_values))
+
+        for d in exporter.export_rows('Video'):
+            video = models.repository.videos.get_one_by_id(d['id'])
+
+            self.assertEqual(d['annotators'], sorted(a.id for a in video.annotators))
+            self.assertEqual(d['annotation_attributes'], sorted(aa.id for aa in video.annotation_attributes))
+
+    def test_001c_export_rows_filters(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+
+        rows = list(exporter.export_rows('AnnotationObject', video_ids=[video_football.id]))
+        self.assertEqual(len(rows), len(video_football.annotation_objects))
+
+        rows = list(exporter.export_rows('Annotator', video_ids=[video_football.id]))
+        self.assertEqual([d['id'] for d in rows], sorted(a.id for a in video_football.annotators))
+
+        rows = list(exporter.export_rows('AnnotationObject', custom_filter='id>2'))
+        self.assertTrue(len(rows) > 0)
+        self.assertTrue(all(d['id'] > 2 for d in rows))
+
+    def test_001d_export_interpolated_rows(self):
+        ao_football_rectangle_1 = models.repository.annotation_objects.get_one_by_id(1)
+
+        rows = [d for d in exporter.export_interpolated_rows() if d['annotation_object_id'] == 1 and d['annotation_attribute_id'] == 1]
+
+        self.assertEqual([d['frame_from'] for d in rows], range(1, 15) + range(16, 30))
+
+        for d in rows:
+            av = [av for av in ao_football_rectangle_1.annotation_values_local_interpolate_in_frame(d['frame_from'])
+                  if av.annotation_attribute_id == 1][0]
+
+            self.assertTrue(av.is_interpolated)
+            self.assertEqual(d['value'], av.value)
+
+    def test_001e_export_packed_tracks(self):
+        ao_football_circle_3 = models.repository.annotation_objects.get_one_by_id(3)
+
+        rows_1 = sorted((d['annotation_object_id'], d['annotation_attribute_id'], d['frame_from'], d['value'])
+                        for d in exporter.export_rows('AnnotationValue'))
+        rows_interpolated_1 = sorted((d['annotation_object_id'], d['annotation_attribute_id'], d['frame_from'], d['value'])
+                                     for d in exporter.export_interpolated_rows())
+
+        # rows are read by own connections, packed tracks must be committed
+        self.assertGreater(ao_football_circle_3.pack_tracks(), 0)
+        models.database.db.session.commit()
+
+        try:
+            rows = list(exporter.export_rows('AnnotationValue'))
+
+            # packed keyframes are exported as values without ID
+            self.assertTrue(any(d['id'] is None for d in rows))
+            self.assertEqual(set(rows[0].keys()), set(rows[-1].keys()))
+            self.assertEqual(sorted((d['annotation_object_id'], d['annotation_attribute_id'], d['frame_from'], d['value']) for d in rows), rows_1)
+
+            self.assertEqual(sorted((d['annotation_object_id'], d['annotation_attribute_id'], d['frame_from'], d['value'])
+                                    for d in exporter.export_interpolated_rows()), rows_interpolated_1)
+
+            # custom filter of annotation values cannot be applied to packed tracks
+            try:
+                list(exporter.export_rows('AnnotationValue', custom_filter='id>0'))
+            except Exception, e:
+                self.assertIn('packed', str(e))
+            else:
+                self.fail()
+        finally:
+            ao_football_circle_3.unpack_tracks()
+            models.database.db.session.commit()
+
+    def test_002a_write_json(self):
+        fw = StringIO()
+        exporter.write_json([('Video', exporter.export_rows('Video')), ('Annotator', iter([]))], fw)
+
+        data = json.loads(fw.getvalue())
+
+        self.assertEqual(len(data['Video']), len(models.repository.videos.get_all()))
+        self.assertEqual(data['Annotator'], [])
+
+    def test_003a_export_video_arrays(self):
+        video_football = models.repository.videos.get_one_by_id(1)
+
+        arrays = exporter.export_video_arrays(video_football.id)
+        arrays_interpolated = exporter.export_video_arrays(video_football.id, interpolated=True)
+
+        # all values are exported, positional or dictionary encoded
+        rows = list(exporter.export_rows('AnnotationValue', video_ids=[video_football.id]))
+        rows_interpolated = list(exporter.export_interpolated_rows(video_ids=[video_football.id]))
+
+        for a, n in ((arrays, len(rows)), (arrays_interpolated, len(rows) + len(rows_interpolated))):
+            self.assertEqual(sum(len(a[prefix + '_frame']) for prefix in ['rectangle', 'circle', 'point', 'values']), n)
+
+        self.assertFalse(arrays['rectangle_is_interpolated'].any())
+
+        # interpolated track of object 1 is the same as interpolated by AnnotationValue.interpolate()
+        ao_football_rectangle_1 = models.repository.annotation_objects.get_one_by_id(1)
+        track = arrays_interpolated['rectangle_object_id'] == 1
+
+        self.assertEqual(arrays_interpolated['rectangle_frame'][track].tolist(), range(0, 31))
+
+        for frame, x1, y1, x2, y2 in zip(*[arrays_interpolated['rectangle_' + k][track] for k in ['frame', 'x1', 'y1', 'x2', 'y2']]):
+            av = [av for av in ao_football_rectangle_1.annotation_values_local_interpolate_in_frame(frame)
+                  if av.annotation_attribute.data_type == u'position_rectangle'][0]
+
+            self.assertEqual((x1, y1, x2, y2), av.value)
+
+        # dictionary encoding
+        dictionary = arrays['values_dictionary']
+        av_identity = [av for av in ao_football_rectangle_1.annotation_values_global() if av.annotation_attribute.data_type == u'unicode'][0]
+        values = (arrays['values_object_id'] == 1) & (arrays['values_attribute_id'] == av_identity.annotation_attribute_id)
+
+        self.assertEqual([dictionary[code] for code in arrays['values_code'][values]], [av_identity.value])
+        self.assertEqual(arrays['values_frame'][values].tolist(), [-1])
+
+    def test_003b_write_npy(self):
+        import numpy as np
+
+        output_dir = tempfile.mkdtemp()
+
+        try:
+            paths = exporter.write_npy([1], output_dir)
+            arrays = exporter.export_video_arrays(1)
+
+            self.assertEqual(paths, [os.path.join(output_dir, 'video_1')])
+            self.assertEqual(sorted(os.listdir(paths[0])), sorted(name + '.npy' for name in arrays))
+
+            # arrays can be memory-mapped
+            for name, array in arrays.iteritems():
+                loaded = np.load(os.path.join(paths[0], name + '.npy'), mmap_mode='r')
+
+                self.assertIsInstance(loaded, np.memmap)
+                self.assertEqual(loaded.tolist(), array.tolist())
+        finally:
+            shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
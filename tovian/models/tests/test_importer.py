@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import unittest
+from StringIO import StringIO
+
+import tovian.log as log
+
+
+root_dir = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+log.setup_logging(os.path.join(root_dir, 'data', 'log_testing.json'), log_dir=os.path.join(root_dir, 'log'))
+
+import tovian.config as config
+import tovian.models as models
+import tovian.models.importer as importer
+import tovian.models.tests.fixtures as fixtures
+
+
+class ImporterTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config.load(os.path.join(root_dir, 'config.ini'))
+
+        models.database.db.open_from_config(config.config, 'testing')
+        models.database.db.recreate_tables()
+
+        models.database.db.session.add_all(fixtures.create_fixtures())
+        models.database.db.session.commit()
+
+        cls.fixtures_file = os.path.join(os.path.dirname(__file__), 'fixtures_2.json')
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+
+    def test_001a_iterate_json_annotations(self):
+        with open(self.fixtures_file) as fr:
+            data = json.load(fr)
+
+        with open(self.fixtures_file, 'rb') as fr:
+            items = list(importer.iterate_json_annotations(fr))
+
+        self.assertEqual(items, list(importer.iterate_annotations(data)))
+
+        # tiny buffer, values are split between reads
+        with open(self.fixtures_file, 'rb') as fr:
+            reader = importer.JsonStreamReader(fr, read_size=7)
+
+            self.assertEqual(reader.expect('{'), '{')
+            self.assertEqual(reader.decode(), u'test_football.mp4')
+            self.assertEqual(reader.expect(':'), ':')
+            self.assertEqual(reader.expect('['), '[')
+            self.assertEqual(reader.decode(), items[0][2])
+
+    def test_001b_iterate_json_annotations_empty(self):
+        self.assertEqual(list(importer.iterate_json_annotations(StringIO('{}'))), [])
+        self.assertEqual(list(importer.iterate_json_annotations(StringIO(' {"a": [ ], "b": [{"x": 1}]} '))), [(u'b', 0, {u'x': 1})])
+
+        # incomplete file
+        try:
+            list(importer.iterate_json_annotations(StringIO('{"a": [{"x": 1}')))
+        except:
+            pass
+        else:
+            self.fail()
+
+    def test_002a_import_annotations(self):
+        annotator_admin = models.repository.annotators.get_one_enabled_by_name(u"admin")
+        video = models.repository.videos.get_one(u'test_football.mp4')
+
+        annotation_objects_count_before = len(video.annotation_objects_all())
+
+        with open(self.fixtures_file, 'rb') as fr:
+            count = importer.import_annotations(importer.iterate_json_annotations(fr), annotator=annotator_admin, chunk_size=1)
+
+        self.assertEqual(count, 2)
+        self.assertEqual(len(video.annotation_objects_all()) - annotation_objects_count_before, 2)
+
+        # imported objects have span and values, IDs were assigned after existing objects
+        ao = models.repository.annotation_objects.get_all()[-1]
+        self.assertEqual(ao.type, u'point')
+        self.assertEqual((ao.first_frame, ao.last_frame), (142, 333))
+        self.assertEqual(ao.active_interval(), (142, 333))
+        self.assertEqual(ao.created_by, annotator_admin)
+        self.assertEqual(len(ao.annotation_values), 11)
+
+    def test_002b_import_annotations_resume(self):
+        video = models.repository.videos.get_one(u'test_football.mp4')
+        checkpoint = u'test_import'
+        fingerprint = importer.file_fingerprint(self.fixtures_file)
+
+        annotation_objects_count_before = len(video.annotation_objects_all())
+
+        # progress is stored only when the transaction is committed
+        importer.save_checkpoint(checkpoint, {u'test_football.mp4': 2}, fingerprint)
+        models.database.db.session.rollback()
+        self.assertEqual(importer.load_checkpoint(checkpoint, fingerprint), {})
+
+        # first object was imported before the interruption, one record per checkpoint is updated
+        importer.save_checkpoint(checkpoint, {u'test_football.mp4': 0}, fingerprint)
+        importer.save_checkpoint(checkpoint, {u'test_football.mp4': 1}, fingerprint)
+        models.database.db.session.commit()
+        self.assertEqual(self.checkpoints_count(), 1)
+        self.assertEqual(importer.load_checkpoint(checkpoint, fingerprint), {u'test_football.mp4': 1})
+        self.assertEqual(importer.load_checkpoint(u'other_import', fingerprint), {})
+
+        # changed file is not resumed
+        self.assertEqual(importer.load_checkpoint(checkpoint, {'size': fingerprint['size'] + 1, 'mtime': fingerprint['mtime']}), {})
+
+        with open(self.fixtures_file, 'rb') as fr:
+            count = importer.import_annotations(importer.iterate_json_annotations(fr), checkpoint=checkpoint, fingerprint=fingerprint)
+
+        self.assertEqual(count, 1)
+        self.assertEqual(len(video.annotation_objects_all()) - annotation_objects_count_before, 1)
+
+        # finished import deletes the checkpoint
+        self.assertEqual(importer.load_checkpoint(checkpoint, fingerprint), {})
+        self.assertEqual(self.checkpoints_count(), 0)
+
+    def checkpoints_count(self):
+        return models.database.db.session.query(models.entity.Log).filter(models.entity.Log.type == importer.checkpoint_log_type).count()
+
+    def test_002c_import_annotations_unknown_attribute(self):
+        items = importer.iterate_annotations({u'test_football.mp4': [{'type': 'point', 'annotation_values': [['unknown', 1]]}]})
+
+        try:
+            importer.import_annotations(items)
+        except Exception, e:
+            self.assertIn('unknown', str(e))
+        else:
+            self.fail()
+
+        models.database.db.session.rollback()
+
+    def test_002d_import_annotations_simplify(self):
+        # linear movement, keyframe in every frame
+        data_object = {'type': 'point', 'annotation_values': [['position_point', frame, [100 + 2 * frame, 50 + frame]] for frame in range(0, 50)]}
+        items = importer.iterate_annotations({u'test_football.mp4': [data_object]})
+
+        simplify_stats = {}
+        self.assertEqual(importer.import_annotations(items, simplify_tolerance=1, simplify_stats=simplify_stats), 1)
+        self.assertEqual(simplify_stats, {'removed': 48, 'max_error': 0.0})
+
+        ao = models.repository.annotation_objects.get_all()[-1]
+        self.assertEqual(sorted(av.frame_from for av in ao.annotation_values), [0, 49])
+        self.assertEqual((ao.first_frame, ao.last_frame), (0, 49))
+
+        av = ao.annotation_values_local_interpolate_in_frame(20)[0]
+        self.assertEqual(av.value, (140, 70))
+
+
+if __name__ == '__main__':
+    unittest.main()
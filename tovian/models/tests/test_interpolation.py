@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import tovian.log as log
+
+
+root_dir = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+log.setup_logging(os.path.join(root_dir, 'data', 'log_testing.json'), log_dir=os.path.join(root_dir, 'log'))
+
+import tovian.config as config
+import tovian.models as models
+import tovian.models.interpolation as interpolation
+import tovian.models.tests.fixtures as fixtures
+
+
+class InterpolationTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config.load(os.path.join(root_dir, 'config.ini'))
+
+        models.database.db.open_from_config(config.config, 'testing')
+        models.database.db.recreate_tables()
+
+        models.database.db.session.add_all(fixtures.create_fixtures())
+        models.database.db.session.commit()
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+
+    def assertTrackEqualsInterpolate(self, annotation_object_id):
+        ao = models.repository.annotation_objects.get_one_by_id(annotation_object_id)
+        self.assertIsNotNone(ao)
+
+        for annotation_attribute_id, (frames, avs) in ao.annotation_values_local_sorted().iteritems():
+            data_type = avs[0].annotation_attribute.data_type
+            values = interpolation.decode_track([av._value for av in avs], data_type)
+
+            result = list(interpolation.iterate_track(frames, values, data_type))
+            self.assertEqual(len(result), frames[-1] - frames[0] + 1 - len(frames))
+
+            for frame, value in result:
+                i = [f > frame for f in frames].index(True)
+                av_interpolated = models.entity.AnnotationValue.interpolate(avs[i - 1], avs[i], frame)
+
+                self.assertEqual(value, av_interpolated.value)
+
+    def test_001a_rectangle(self):
+        self.assertTrackEqualsInterpolate(1)
+        self.assertTrackEqualsInterpolate(2)
+
+    def test_001b_circle(self):
+        self.assertTrackEqualsInterpolate(3)
+        self.assertTrackEqualsInterpolate(4)
+
+    def test_001c_point(self):
+        self.assertTrackEqualsInterpolate(5)
+
+    def test_001d_nonvisual(self):
+        self.assertTrackEqualsInterpolate(7)
+
+    def test_002a_int_float(self):
+        values = interpolation.decode_track([u'1', u'5'], u'int')
+        self.assertEqual(list(interpolation.iterate_track([0, 3], values, u'int')), [(1, 2), (2, 3)])
+
+        values = interpolation.decode_track([u'1.0', u'2.0'], u'float')
+        self.assertEqual(list(interpolation.iterate_track([0, 4], values, u'float')), [(1, 1.25), (2, 1.5), (3, 1.75)])
+
+    def test_002b_single_keyframe(self):
+        values = interpolation.decode_track([u'1,2'], u'position_point')
+        self.assertEqual(list(interpolation.iterate_track([10], values, u'position_point')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@
 import unittest
 
 import os
+import sqlalchemy
 import tovian.log as log
 
 
@@ -104,5 +105,172 @@ class RepositoryTestCase(unittest.TestCase):
         self.assertEqual(v1.id, v5.id)
 
 
+    def test_003b_lookup_cache(self):
+        models.repository.lookup_cache.invalidate()
+
+        # one query on a miss
+        sql_count_1 = models.database.db.profiler['sql_count']
+        v1 = models.repository.videos.get_one(u"test_football.mp4")
+        sql_count_2 = models.database.db.profiler['sql_count']
+
+        self.assertEqual(sql_count_2 - sql_count_1, 1)
+
+        # no query on a hit
+        for i in range(10):
+            self.assertIs(models.repository.videos.get_one(u"test_football.mp4"), v1)
+
+        self.assertEqual(models.database.db.profiler['sql_count'], sql_count_2)
+
+        # not found values are not cached
+        self.assertIsNone(models.repository.videos.get_one(u"foo.mp4"))
+        self.assertIsNone(models.repository.annotation_attributes.get_one(u"foo"))
+
+        # renamed entity invalidates the cache
+        a1 = models.repository.annotators.get_one(u"Pavel Campr")
+        a1.name = u"Pavel Campr 2"
+        models.database.db.session.flush()
+
+        self.assertIsNone(models.repository.annotators.get_one(u"Pavel Campr"))
+        self.assertIs(models.repository.annotators.get_one(u"Pavel Campr 2"), a1)
+
+        a1.name = u"Pavel Campr"
+        models.database.db.session.commit()
+
+        # expired entries
+        ttl = models.repository.lookup_cache.ttl
+        models.repository.lookup_cache.ttl = -1
+
+        self.assertIs(models.repository.annotators.get_one(u"Pavel Campr"), a1)
+
+        sql_count_1 = models.database.db.profiler['sql_count']
+        models.repository.annotators.get_one(u"Pavel Campr")
+        self.assertEqual(models.database.db.profiler['sql_count'] - sql_count_1, 1)
+
+        models.repository.lookup_cache.ttl = ttl
+
+    def test_004a_annotation_objects_update_spans(self):
+        t_objects = models.entity.AnnotationObject.__table__
+        models.database.db.session.execute(t_objects.update().values(first_frame=None, last_frame=None))
+
+        models.repository.annotation_objects.update_spans()
+        models.database.db.session.commit()
+
+        ao = models.repository.annotation_objects.get_one_by_id(1)
+        self.assertEqual((ao.first_frame, ao.last_frame), (0, 30))
+
+        video = models.repository.videos.get_one_by_id(1)
+        self.assertEqual(len(video.annotation_objects_all()), 15)
+
+
+    def test_005a_annotation_values_local_duplicates(self):
+        self.assertEqual(len(models.repository.annotation_values.get_local_duplicates()), 0)
+
+        av = models.repository.annotation_values.get_one_by_id(1)
+        self.assertIsNotNone(av.frame_from)
+
+        # second local value in the same frame is refused by the unique index
+        duplicate = {'annotation_object_id': av.annotation_object_id, 'annotation_attribute_id': av.annotation_attribute_id,
+                     'frame_from': av.frame_from, 'value': av._value}
+
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            models.database.db.session.execute(models.entity.AnnotationValue.__table__.insert(), [duplicate])
+
+        models.database.db.session.rollback()
+
+    def test_005b_annotation_values_delete_local_duplicates(self):
+        t_values = models.entity.AnnotationValue.__table__
+        index = [i for i in t_values.indexes if i.name == 'ux_annotation_values_object_id_attribute_id_frame_from'][0]
+
+        # duplicates exist in databases created before the unique index
+        index.drop(models.database.db.session.connection())
+
+        try:
+            av = models.repository.annotation_values.get_one_by_id(1)
+            key = {'annotation_object_id': av.annotation_object_id, 'annotation_attribute_id': av.annotation_attribute_id,
+                   'frame_from': av.frame_from}
+
+            duplicate_id = models.database.db.session.execute(t_values.insert().values(value=av._value, **key)).inserted_primary_key[0]
+
+            self.assertEqual(models.repository.annotation_values.get_local_duplicates(),
+                             [(key['annotation_object_id'], key['annotation_attribute_id'], key['frame_from'], 2)])
+            self.assertEqual(models.repository.annotation_values.delete_local_duplicates(), 1)
+
+            # the most recent value is kept
+            ids = [row[0] for row in models.database.db.session.query(models.entity.AnnotationValue.id).filter_by(**key)]
+            self.assertEqual(ids, [duplicate_id])
+        finally:
+            models.database.db.session.rollback()
+            index.create(models.database.db.engine)
+
+    def test_005c_annotation_values_delete_and_add_in_same_frame(self):
+        av = models.repository.annotation_values.get_one_by_id(1)
+        annotation_object, annotation_attribute, frame_from, value = av.annotation_object, av.annotation_attribute, av.frame_from, av.value
+
+        models.repository.annotation_values.delete(av)
+
+        # new value in the frame of the deleted one
+        models.entity.AnnotationValue(frame_from=frame_from, value=value, annotation_attribute=annotation_attribute,
+                                      annotation_object=annotation_object)
+
+        try:
+            models.database.db.session.flush()
+        except sqlalchemy.exc.IntegrityError:
+            self.fail()
+        else:
+            self.assertEqual(len(models.repository.annotation_values.get_local_duplicates()), 0)
+        finally:
+            models.database.db.session.rollback()
+
+    def test_006a_logs_insert(self):
+        annotator_admin = models.repository.annotators.get_one_enabled_by_name(u"admin")
+        sql_count_before = models.database.db.profiler['sql_count']
+
+        for i in range(0, 5):
+            models.repository.logs.insert('test.insert', {'i': i}, annotator_id=annotator_admin.id)
+
+        # nothing is written by the calling thread
+        self.assertEqual(models.database.db.profiler['sql_count'], sql_count_before)
+
+        self.assertTrue(models.repository.logs.flush(timeout=10))
+
+        logs = [l for l in models.repository.logs.get_by_annotator(annotator_admin) if l.type == u'test.insert']
+        self.assertEqual(len(logs), 5)
+        self.assertEqual(len(set(l.execution_number for l in logs)), 1)
+
+        # values are encoded by the writer
+        self.assertEqual(sorted(l.value for l in logs)[0], u'{"i": 0}')
+
+    def test_006b_log_writer_queue_full(self):
+        writer = models.logwriter.LogWriter(max_queue_size=2, batch_size=10, interval=10)
+
+        for i in range(0, 5):
+            writer.put({'type': u'test.queue_full', 'value': i, 'created_by_id': None})
+
+        self.assertEqual(writer.dropped, 3)
+
+        # flush does not wait for the interval
+        writer.start()
+        self.assertTrue(writer.flush(timeout=10))
+        self.assertEqual((writer.written, writer.failed), (2, 0))
+
+        q = models.database.db.session.query(models.entity.Log).filter_by(type=u'test.queue_full')
+        self.assertEqual(sorted(l.value for l in q.all()), [u'0', u'1'])
+
+    def test_006c_log_writer_reopened_database(self):
+        writer = models.logwriter.LogWriter()
+
+        # engine of previously opened database is replaced
+        writer.engine = models.database.db.create_engine('sqlite://')
+        writer.opened_url = 'sqlite://'
+        writer.execution_number = 1000
+
+        writer.write([{'type': u'test.reopened', 'value': None, 'created_by_id': None}])
+        self.assertEqual((writer.written, writer.failed), (1, 0))
+        self.assertEqual(writer.opened_url, str(models.database.db.engine.url))
+        self.assertNotEqual(writer.execution_number, 1000)
+
+        self.assertEqual(models.database.db.session.query(models.entity.Log).filter_by(type=u'test.reopened').count(), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -20,3 +20,30 @@ def dict_merge(a, b):
         else:
             result[k] = deepcopy(v)
     return result
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict, any modification raises TypeError.
+    Copies (copy, deepcopy) are ordinary mutable dicts.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('FrozenDict cannot be modified')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+
+def dict_freeze(a):
+    """
+    Returns read-only (FrozenDict) copy of a, nested dicts are frozen too
+    """
+    if not isinstance(a, dict):
+        return a
+    return FrozenDict((k, dict_freeze(v)) for k, v in a.iteritems())
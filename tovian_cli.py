@@ -9,6 +9,7 @@ import os
 import sys
 import logging
 import argparse
+import itertools
 import datetime
 import json
 import platform
@@ -34,6 +35,95 @@ def action_video_info(args, root_dir):
 def action_init_db(args, root_dir):
     models.database.db.recreate_tables()
 
+def action_upgrade_db(args, root_dir):
+    # unique index cannot be created when duplicate local annotation values exist
+    duplicates = models.repository.annotation_values.get_local_duplicates()
+
+    if len(duplicates):
+        if not args.remove_duplicates:
+            for annotation_object_id, annotation_attribute_id, frame_from, count in duplicates:
+                print 'object %d, attribute %d, frame %d: %d values' % (annotation_object_id, annotation_attribute_id, frame_from, count)
+
+            raise Exception('Found %d duplicate local annotation values (same object, attribute and frame). Fix them or run with --remove-duplicates.' % (len(duplicates)))
+
+        models.repository.annotation_values.delete_local_duplicates()
+        models.database.db.session.commit()
+
+    models.database.db.upgrade_tables()
+
+    # SQLite foreign keys (sqlite.foreign_keys) cannot be enforced, when rows referencing deleted rows exist
+    violations = models.database.db.foreign_key_violations()
+
+    if len(violations):
+        for table_name, row_id, parent_table_name in violations:
+            print '%s %d: missing row in %s' % (table_name, row_id, parent_table_name)
+
+        if models.database.db.sqlite_pragmas['foreign_keys'] not in (None, '', '0', 'OFF', 'off'):
+            raise Exception('Found %d rows referencing missing rows, delete them or disable sqlite.foreign_keys.' % (len(violations)))
+
+        logger.warning('Found %d rows referencing missing rows, delete them before enabling sqlite.foreign_keys.' % (len(violations)))
+
+    # backfill denormalized columns
+    models.repository.annotation_objects.update_spans()
+    models.database.db.session.commit()
+
+def action_tracks(args, root_dir):
+    # convert positional annotation values of videos to packed tracks and back
+    if args.video is not None:
+        videos = []
+
+        for video_id in args.video:
+            video = models.repository.videos.get_one(video_id)
+
+            if not video:
+                raise Exception('Cannot find video: %s' % (video_id))
+
+            videos.append(video)
+    else:
+        videos = models.repository.videos.get_all()
+
+    for video in videos:
+        count = 0
+
+        for annotation_object in video.annotation_objects:
+            if args.operation == 'pack':
+                count += annotation_object.pack_tracks()
+            else:
+                count += annotation_object.unpack_tracks()
+
+        models.database.db.session.commit()
+
+        print '%s: %d annotation values %s' % (video.name.encode('utf8'), count, 'packed' if args.operation == 'pack' else 'unpacked')
+
+def action_simplify(args, root_dir):
+    # remove keyframes of positional attributes, which interpolation reproduces within tolerance
+    if args.video is not None:
+        videos = []
+
+        for video_id in args.video:
+            video = models.repository.videos.get_one(video_id)
+
+            if not video:
+                raise Exception('Cannot find video: %s' % (video_id))
+
+            videos.append(video)
+    else:
+        videos = models.repository.videos.get_all()
+
+    for video in videos:
+        count = 0
+        max_error = 0.0
+
+        for annotation_object in video.annotation_objects:
+            removed, error = annotation_object.simplify_keyframes(args.tolerance)
+
+            count += removed
+            max_error = max(max_error, error)
+
+        models.database.db.session.commit()
+
+        print '%s: %d keyframes removed, maximum error %1.2f px' % (video.name.encode('utf8'), count, max_error)
+
 def action_init_default_data(args, root_dir):
     models.database.db.insert_default_data()
 
@@ -43,18 +133,16 @@ def action_load_fixtures(args, root_dir):
     models.database.db.session.add_all(fixtures.create_fixtures())
     models.database.db.session.commit()
 
-def action_db_benchmark(args, root_dir):
-    ao_football_rectangle_1 = models.repository.annotation_objects.get_one_by_id(1)
-    assert ao_football_rectangle_1 is not None
-
+def benchmark(title, function, n=100):
     import time
 
-    n = 100
     durations = []
 
+    print title
+
     for i in range(0, n):
         t1 = time.time()
-        ao_football_rectangle_1.annotation_values_local_interpolate_in_frame(8)
+        function()
         t2 = time.time()
         durations.append(t2 - t1)
         print '%s\r' % (20 * (i + 1) / n * '.'),
@@ -64,162 +152,145 @@ def action_db_benchmark(args, root_dir):
     print 'Average: %f ms' % (1000 * sum(durations) / n)
     print 'Min: %f ms' % (1000 * min(durations))
     print 'Max: %f ms' % (1000 * max(durations))
+    print
 
-def action_export(args, root_dir):
-    tables = all_exportable_entities if 'all' in args.tables else args.tables
-    data = {}
-
-    # prepare list of videos, if args.videos is given
-    video_ids = []
-
-    if args.video is not None:
-        for video_id in args.video:
-            video = models.repository.videos.get_one(video_id)
+def action_db_benchmark(args, root_dir):
+    ao_football_rectangle_1 = models.repository.annotation_objects.get_one_by_id(1)
+    assert ao_football_rectangle_1 is not None
 
-            if not video:
-                raise Exception('Cannot find video: %s' % (video_id))
+    benchmark('Interpolation in frame (fixtures object):',
+              lambda: ao_football_rectangle_1.annotation_values_local_interpolate_in_frame(8))
 
-            video_ids.append(video.id)
+    # object with many keyframes, it is not stored in database
+    aa_position_rectangle = models.repository.annotation_attributes.get_one_by_name(u'position_rectangle')
+    ao = models.entity.AnnotationObject(type=u'rectangle', video=ao_football_rectangle_1.video)
 
-    # export data to dict
-    for entity_name in tables:
-        entity = getattr(models.entity, entity_name)
-        query = models.database.db.session.query(entity)
-
-        if len(video_ids):
-            # add special filters to export only data related to given video(s)
-            if entity_name=='Video':
-                query = query.filter(models.entity.Video.id.in_(video_ids))
-            elif entity_name=='Annotator':
-                query = query.join(models.entity.Video.annotators)
-                query = query.filter(models.entity.Video.id.in_(video_ids))
-            elif entity_name=='AnnotationAttribute':
-                query = query.join(models.entity.Video.annotation_attributes)
-                query = query.filter(models.entity.Video.id.in_(video_ids))
-            elif entity_name=='AnnotationObject':
-                query = query.join(models.entity.Video.annotation_objects)
-                query = query.filter(models.entity.Video.id.in_(video_ids))
-            elif entity_name=='AnnotationValue':
-                query = query.join(models.entity.AnnotationObject)
-                query = query.filter(models.entity.AnnotationObject.video_id.in_(video_ids))
-            else:
-                raise Exception("Video filter is not supported for table '%s'" % (entity_name))
+    for i in range(0, args.keyframes):
+        models.entity.AnnotationValue(annotation_object=ao, annotation_attribute=aa_position_rectangle,
+                                      frame_from=2 * i, value=(i, i, i + 10, i + 10))
 
-        if args.filter:
-            query = query.filter(args.filter)
+    frame = args.keyframes + 1 # in the middle, between two keyframes
 
-        items = query.order_by(entity.id).all()
+    def interpolate_linear():
+        # the original algorithm: linear scan of all keyframes of each attribute on each call
+        for annotation_attribute_id, annotation_values in ao.annotation_values_local_grouped().iteritems():
+            nearest_av_before = None
+            nearest_av_after = None
 
-        # interpolate annotation values
-        if args.interpolated and entity_name=='AnnotationValue':
-            # avs structure:
-            #   avs[annotation_object_id][annotation_attribute_id][frame_from] = av
-            avs = defaultdict(lambda: defaultdict(dict))
+            for av in annotation_values:
+                if av.frame_from == frame:
+                    nearest_av_before = nearest_av_after = av
+                    break
+                elif av.frame_from < frame:
+                    if nearest_av_before is None or nearest_av_before.frame_from < av.frame_from:
+                        nearest_av_before = av
+                elif nearest_av_after is None or nearest_av_after.frame_from > av.frame_from:
+                    nearest_av_after = av
 
-            # fill in avs
-            for av in items:
-                frame_from = av.frame_from
+            if nearest_av_before is not nearest_av_after:
+                models.entity.AnnotationValue.interpolate(nearest_av_before, nearest_av_after, frame)
 
-                # ignore global annotation values (they are not interpolated)
-                if frame_from is None:
-                    continue
+    def interpolate_cold():
+        ao.reset_keyframes_cache()
+        ao.annotation_values_local_interpolate_in_frame(frame)
 
-                annotation_object_id = av.annotation_object_id
-                annotation_attribute_id = av.annotation_attribute_id
+    benchmark('Interpolation in frame (%d keyframes, baseline: linear scan on each call):' % (args.keyframes), interpolate_linear)
+    benchmark('Interpolation in frame (%d keyframes, binary search, keyframes sorted on each call):' % (args.keyframes), interpolate_cold)
+    benchmark('Interpolation in frame (%d keyframes, binary search, sorted keyframes cached):' % (args.keyframes),
+              lambda: ao.annotation_values_local_interpolate_in_frame(frame))
 
-                avs[annotation_object_id][annotation_attribute_id][frame_from] = av
+    models.database.db.session.rollback()
 
-            # loop in avs, interpolated values are appended to items
-            for annotation_object_id, avs_of_object in avs.iteritems():
-                for annotation_attribute_id, avs_of_attribute in avs_of_object.iteritems():
-                    frames = sorted(avs_of_attribute.keys())
+def action_db_stats(args, root_dir):
+    # statistics of SQL statements stored by gui.stop or cli.stop log messages
+    log = models.repository.logs.get_last_by_types([u'gui.stop', u'cli.stop'], args.execution)
 
-                    for offset in range(1, len(frames)):
-                        frame_left = frames[offset-1]
-                        frame_right = frames[offset]
+    if log is None:
+        raise Exception('Cannot find any stop log message%s.' % ('' if args.execution is None else ' of execution %d' % (args.execution)))
 
-                        av_left = avs_of_attribute[frame_left]
-                        av_right = avs_of_attribute[frame_right]
+    db_stats = json.loads(log.value).get('db_stats')
 
-                        for frame in range(frame_left+1, frame_right):
-                            av_interpolated = models.entity.AnnotationValue.interpolate(av_left, av_right, frame)
+    if db_stats is None:
+        raise Exception('Log message %d (%s) does not contain SQL statistics.' % (log.id, log.type))
 
-                            if av_interpolated.annotation_attribute_id is None:
-                                raise Exception('annotation_attribute_id cannot be None')
+    db_stats = db_stats[:args.top]
+    db_violations = json.loads(log.value).get('db_violations') or []
 
-                            items.append(av_interpolated)
+    if args.json:
+        print json.dumps({'db_stats': db_stats, 'db_violations': db_violations}, indent=1)
+        return
 
-        data[entity_name] = []
-
-        for item in items:
-            # export attributes
-            # ignore object attributes starting with "_", convert long to int
-            d = {}
+    print 'Execution %s, %s at %s' % (log.execution_number, log.type, log.created_at)
+    print
 
-            for k in item.__dict__.keys():
-                v = item.__dict__[k]
+    for stats in db_stats:
+        print '%6d x  total %9.1f ms  mean %7.2f ms  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  rows %s' % (
+            stats['count'], stats['total_ms'], stats['mean_ms'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            '-' if stats['rows'] is None else stats['rows'])
+        print '    %s' % (stats['fingerprint'].encode('utf8'))
 
-                if k.startswith('_'):
-                    # try if it is not a synonym (i.e. has same attribute without "_")
-                    try:
-                        k2 = k[1:]
-                        d[k2] = getattr(item, k2)
-                    except:
-                        pass
+    if db_violations:
+        print
+        print 'Query violations (instrumentation enabled):'
 
-                    continue
+        for violation in db_violations:
+            if violation['type'] == 'budget':
+                print '  budget: %s executed %d statements (max. %d), call sites: %s' % (
+                    violation['operation'], violation['count'], violation['max_queries'], ', '.join(violation['sites']))
+            else:
+                print '  n+1: %s at %s' % (violation['operation'], violation['site'])
+                print '    %s' % (violation['fingerprint'].encode('utf8'))
 
-                # convert long to int
-                if type(v) is long:
-                    v = int(v)
+def action_export(args, root_dir):
+    import tovian.models.exporter as exporter
 
-                # ignore e.g. "annotation_object" when "annotation_object_id" exists
-                if (k + '_id') in item.__dict__:
-                    continue
+    tables = all_exportable_entities if 'all' in args.tables else args.tables
 
-                d[k] = v
+    # prepare list of videos, if args.videos is given
+    video_ids = []
 
-            # export relations
-            for relation in item.__mapper__.relationships:
-                if relation.direction.name in ['ONETOMANY', 'MANYTOMANY']:
-                    # show primary keys, convert long to int
-                    d[relation.key] = [int(o.id) for o in getattr(item, relation.key)]
+    if args.video is not None:
+        for video_id in args.video:
+            video = models.repository.videos.get_one(video_id)
 
-            data[entity_name].append(d)
+            if not video:
+                raise Exception('Cannot find video: %s' % (video_id))
 
-    # write output
-    if args.format == 'json':
-        # datetime objects cannot be serialized by default
-        dthandler = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
-        print json.dumps(data, default=dthandler)
+            video_ids.append(video.id)
 
-    elif args.format == 'yaml':
-        import yaml
+    if args.format == 'npy':
+        # columnar arrays of annotation values, one directory per video (tables are ignored)
+        if args.filter:
+            raise Exception('Custom filter is not supported for npy format, use --video to select videos')
 
-        print yaml.safe_dump(data, allow_unicode=True, indent=4, width=1000)
+        if not len(video_ids):
+            video_ids = [video.id for video in models.repository.videos.get_all()]
 
-    elif args.format == 'csv':
-        import csv
+        exporter.write_npy(video_ids, args.output, interpolated=args.interpolated)
 
-        for table_name, table_data in data.iteritems():
-            keys = sorted(table_data[0].keys())
+        return
 
-            # encode all strings to utf8
-            dict_writer = csv.DictWriter(sys.stdout, [v.encode('utf8') for v in keys])
+    # rows are read and written one by one, tables are never loaded into memory
+    data = []
 
-            dict_writer.writer.writerow([table_name.encode('utf8')])
-            dict_writer.writer.writerow([v.encode('utf8') for v in keys])
+    for entity_name in tables:
+        rows = exporter.export_rows(entity_name, video_ids=video_ids, custom_filter=args.filter)
 
-            table_data_encoded = [{k: unicode(v).encode('utf8') if isinstance(v, basestring) else v for k,v in line.iteritems()} for line in table_data]
-            dict_writer.writerows(table_data_encoded)
+        # interpolated annotation values are appended to exported data, no AnnotationValue instances are created
+        if args.interpolated and entity_name=='AnnotationValue':
+            rows = itertools.chain(rows, exporter.export_interpolated_rows(video_ids=video_ids, custom_filter=args.filter))
 
-            dict_writer.writer.writerow([])
+        data.append((entity_name, rows))
 
+    # write output
+    if args.format == 'json':
+        exporter.write_json(data, sys.stdout)
+    elif args.format == 'yaml':
+        exporter.write_yaml(data, sys.stdout)
+    elif args.format == 'csv':
+        exporter.write_csv(data, sys.stdout)
     elif args.format == 'print':
-        import pprint
-
-        pprint.pprint(data)
-
+        exporter.write_print(data, sys.stdout)
     else:
         raise Exception('Unsupported export format: %s' % (args.format))
 
@@ -229,18 +300,6 @@ def action_import(args, root_dir):
     else:
         raise Exception('Unsupported type for import: %s' % (args.type))
 
-    # load data
-    if args.format == 'json':
-        with open(args.file) as fr:
-            data = json.load(fr)
-    elif args.format == 'yaml':
-        import yaml
-
-        with open(args.file) as fr:
-            print yaml.load(fr)
-    else:
-        raise Exception('Unsupported format for import: %s' % (args.format))
-
     if args.annotator is not None:
         annotator = models.repository.annotators.get_one(args.annotator)
 
@@ -249,20 +308,34 @@ def action_import(args, root_dir):
     else:
         annotator = None
 
-    for video_id, aos_data in data.iteritems():
-        logger.info("Importing for video: %s" % (video_id))
+    import tovian.models.importer as importer
 
-        # name can be video's name or filename, try to select by both
-        video = models.repository.videos.get_one(video_id)
+    # interrupted import of the same file continues from the checkpoint stored in the database
+    # (unless the file was changed meanwhile)
+    checkpoint = os.path.abspath(args.file).decode(sys.getfilesystemencoding() or 'utf-8')
+    fingerprint = importer.file_fingerprint(args.file)
 
-        if video is None:
-            raise Exception('Video with name or filename not found: %s' % (video_id))
+    with open(args.file, 'rb') as fr:
+        if args.format == 'json':
+            # objects are read one by one, the whole file is never loaded into memory
+            items = importer.iterate_json_annotations(fr)
+        elif args.format == 'yaml':
+            import yaml
 
-        video.import_annotations(aos_data, annotator=annotator)
+            items = importer.iterate_annotations(yaml.load(fr))
+        else:
+            raise Exception('Unsupported format for import: %s' % (args.format))
 
-        logger.info("Data loaded, committing to database.")
+        simplify_stats = {}
 
-        models.database.db.session.commit()
+        with models.database.db.bulk_load(enabled=args.bulk_load):
+            count = importer.import_annotations(items, annotator=annotator, chunk_size=args.chunk_size, checkpoint=checkpoint,
+                                                fingerprint=fingerprint, simplify_tolerance=args.simplify, simplify_stats=simplify_stats)
+
+    logger.info("%d annotation objects were imported." % (count))
+
+    if args.simplify is not None:
+        print '%d keyframes removed, maximum error %1.2f px' % (simplify_stats['removed'], simplify_stats['max_error'])
 
 def print_available_annotation_attributes():
     aas = models.repository.annotation_attributes.get_all()
@@ -521,7 +594,7 @@ if __name__ == "__main__":
     root_dir = unicode(root_dir, sys.getfilesystemencoding())
 
     all_exportable_entities = ['Annotator', 'Video', 'AnnotationAttribute', 'AnnotationObject', 'AnnotationValue']
-    actions_using_database = ['init_db', 'load_fixtures', 'db_benchmark', 'export', 'import', 'add', 'init_default_data']
+    actions_using_database = ['init_db', 'upgrade_db', 'tracks', 'simplify', 'load_fixtures', 'db_benchmark', 'db_stats', 'export', 'import', 'add', 'init_default_data']
 
     version_data, version_info = tovian.version.version(root_dir)
 
@@ -539,6 +612,20 @@ if __name__ == "__main__":
     parser_init_db = subparsers.add_parser('init_db', help="Initialize database structure (drops existing tables!)")
     parser_init_db.add_argument('-e', '--environment', type=str, default='admin')
 
+    parser_upgrade_db = subparsers.add_parser('upgrade_db', help="Add missing tables, columns and indexes to existing database (keeps data) and recompute denormalized columns")
+    parser_upgrade_db.add_argument('-e', '--environment', type=str, default='admin')
+    parser_upgrade_db.add_argument('--remove-duplicates', action='store_true', help="delete duplicate local annotation values, keep the most recent one")
+
+    parser_tracks = subparsers.add_parser('tracks', help="Convert positional annotation values to packed tracks (compact binary storage) and back")
+    parser_tracks.add_argument('operation', choices=['pack', 'unpack'])
+    parser_tracks.add_argument('-e', '--environment', type=str, default='admin')
+    parser_tracks.add_argument('--video', help="Only given video(s) are converted. Video IDs, names or filenames are accepted.", nargs='+')
+
+    parser_simplify = subparsers.add_parser('simplify', help="Remove keyframes of positional attributes, which are reproduced by interpolation of other keyframes")
+    parser_simplify.add_argument('tolerance', type=float, help="maximum allowed difference of coordinates in pixels")
+    parser_simplify.add_argument('-e', '--environment', type=str, default='admin')
+    parser_simplify.add_argument('--video', help="Only given video(s) are simplified. Video IDs, names or filenames are accepted.", nargs='+')
+
     parser_init_default_data = subparsers.add_parser('init_default_data', help="Initialize default database data")
     parser_init_default_data.add_argument('-e', '--environment', type=str, default='admin')
 
@@ -547,12 +634,20 @@ if __name__ == "__main__":
 
     parser_db_benchmark = subparsers.add_parser('db_benchmark', help="Benchmark database speed")
     parser_db_benchmark.add_argument('-e', '--environment', type=str, default='production')
+    parser_db_benchmark.add_argument('-k', '--keyframes', type=int, default=5000, help="number of keyframes of the benchmarked object")
+
+    parser_db_stats = subparsers.add_parser('db_stats', help="Print statistics of SQL statements executed by the last (or given) GUI or CLI execution")
+    parser_db_stats.add_argument('-e', '--environment', type=str, default='production')
+    parser_db_stats.add_argument('--execution', type=int, help="execution number (see logs table)")
+    parser_db_stats.add_argument('-t', '--top', type=int, default=20, help="number of the most expensive statements")
+    parser_db_stats.add_argument('--json', action='store_true', help="print statistics as JSON")
 
     parser_export = subparsers.add_parser('export', help="Export data to console. Redirect output to file by adding e.g. '> file.json' to command")
     parser_export.add_argument('tables', choices=all_exportable_entities + ['all'], nargs='+')
     parser_export.add_argument('-e', '--environment', type=str, default='production')
-    parser_export.add_argument('-f', '--format', choices=['json', 'yaml', 'csv', 'print'], default='json')
-    parser_export.add_argument('--filter', help="Custom filter, e.g. 'id>10'")
+    parser_export.add_argument('-f', '--format', choices=['json', 'yaml', 'csv', 'print', 'npy'], default='json', help="npy: NumPy arrays of annotation values, written into one directory per video (one .npy file per array), tables are ignored")
+    parser_export.add_argument('-o', '--output', default='.', help="Output directory for npy format")
+    parser_export.add_argument('--filter', help="Custom filter, e.g. 'id>10' (not supported for npy format)")
     parser_export.add_argument('--video', help="Only items related to given video(s) will be exported. Video IDs, names or filenames are accepted.", nargs='+')
     parser_export.add_argument('-i', '--interpolated', action='store_true', help='export with interpolated annotation values')
 
@@ -562,6 +657,9 @@ if __name__ == "__main__":
     parser_import.add_argument('-e', '--environment', type=str, default='production')
     parser_import.add_argument('-a', '--annotator', help="Annotator (id, name or email) from database, who will be connected to imported data")
     parser_import.add_argument('-f', '--format', choices=['json', 'yaml'], default='json')
+    parser_import.add_argument('-c', '--chunk-size', type=int, default=1000, help="Number of annotation objects inserted and committed at once")
+    parser_import.add_argument('-b', '--bulk-load', action='store_true', help="faster import into SQLite database, data are not safe against power failure until the import finishes")
+    parser_import.add_argument('-s', '--simplify', type=float, metavar='TOLERANCE', help="do not import keyframes of positional attributes reproduced by interpolation within tolerance in pixels")
 
     parser_add = subparsers.add_parser('add', help="Add data interactively")
     parser_add.add_argument('type', choices=['annotator', 'video', 'video_for_annotator'])
@@ -602,7 +700,7 @@ if __name__ == "__main__":
     except KeyError as e:
         raise Exception("Unsupported action: %s" % (args.action))
 
-    if args.action in actions_using_database and args.action not in ['init_db']:
+    if args.action in actions_using_database and args.action not in ['init_db', 'upgrade_db']:
         # logging
         models.repository.logs.insert('cli.start', {
             'args': vars(args),
@@ -612,7 +710,17 @@ if __name__ == "__main__":
         })
 
     # execute action
-    action_function(args, root_dir)
+    if args.action in actions_using_database:
+        with models.database.db.operation('cli.' + args.action):
+            action_function(args, root_dir)
+    else:
+        action_function(args, root_dir)
 
     if args.action in actions_using_database:
-        models.repository.logs.insert('cli.stop', {'db_sql_count': models.database.db.profiler['sql_count']})
+        models.repository.logs.insert('cli.stop', {'db_sql_count': models.database.db.profiler['sql_count'],
+                                                   'db_stats': models.database.db.statistics.snapshot(),
+                                                   'db_violations': models.database.db.instrumentation.report(),
+                                                   'logs_dropped': models.repository.logs.writer.dropped})
+
+        if not models.repository.logs.flush(timeout=10):
+            logger.warning("Log messages were not written in time.")
@@ -107,6 +107,7 @@ def start(environment='production'):
     from tovian import config
     from tovian.gui import launcher
     from tovian import models
+    from tovian.models import executor
     import tovian.version
     import PySide.QtGui
     import json
@@ -142,9 +143,18 @@ def start(environment='production'):
         models.repository.logs.insert('gui.exception.core.exec_()', sys.exc_info()[0])
         raise e
     finally:
-        models.repository.logs.insert('gui.stop', {'db_sql_count': models.database.db.profiler['sql_count']})
+        models.repository.logs.insert('gui.stop', {'db_sql_count': models.database.db.profiler['sql_count'],
+                                                   'db_stats': models.database.db.statistics.snapshot(),
+                                                   'db_violations': models.database.db.instrumentation.report(),
+                                                   'logs_dropped': models.repository.logs.writer.dropped})
         logger.debug("Stop GUI")
 
+        if not models.repository.logs.flush(timeout=10):
+            logger.warning("Log messages were not written in time.")
+
+        if not executor.executor.stop(timeout=10):
+            logger.warning("Database executor was not stopped in time.")
+
         models.database.db.close()
 
 